@@ -0,0 +1,290 @@
+import os
+import re
+import io
+import time
+import hashlib
+import zipfile
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# テキスト化できる添付の拡張子
+SUPPORTED_EXTS = {".txt", ".srt", ".vtt", ".pdf", ".docx"}
+
+# 抽出ロジックを変えたら上げる（キャッシュが自動で無効になる）
+EXTRACTOR_VERSION = "1"
+
+ATTACHMENT_PROCESSES = int(os.getenv("ATTACHMENT_PROCESSES", str(min(4, os.cpu_count() or 1))))
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+ATTACHMENT_TIMEOUT = float(os.getenv("ATTACHMENT_TIMEOUT", "60"))
+ATTACHMENT_CACHE_DIR = os.getenv("ATTACHMENT_CACHE_DIR", os.path.join(BASE_DIR, ".cache", "attachments"))
+
+# エラー文の頭。サイズ上限超過と、パースそのものの失敗（壊れた DOCX・読めない PDF・pypdf 未導入など）は
+# 何度やっても同じなので再試行しない。時間切れとワーカーの異常終了だけは、やり直せば通りうる
+TOO_LARGE = "attachment too large"
+TIMEOUT = "timeout after"
+CRASHED = "extractor worker crashed"
+
+
+def is_transient_error(error: str) -> bool:
+    """result() のエラーのうち、もう一度抽出すれば通りうるもの（時間切れ・ワーカーの異常終了）。"""
+    return error.startswith((TIMEOUT, CRASHED))
+
+RE_SUB_TIMESTAMP = re.compile(r"^\s*\d{1,2}:\d{2}(:\d{2})?[.,]\d{3}\s*-->")
+RE_SUB_INDEX = re.compile(r"^\s*\d+\s*$")
+RE_SUB_TAG = re.compile(r"<[^<>]*>")
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def is_supported(filename: str) -> bool:
+    return os.path.splitext(filename.lower())[1] in SUPPORTED_EXTS
+
+
+# --------------------
+# Extractors（ワーカープロセス側で動くので top-level 関数にしておく）
+# --------------------
+def extract_txt(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace")
+
+
+def extract_subtitles(data: bytes) -> str:
+    """SRT / WebVTT から番号・タイムスタンプ・装飾タグを落として発話だけ残す。"""
+    lines = []
+    for line in data.decode("utf-8-sig", errors="replace").splitlines():
+        s = line.strip()
+        if not s or s == "WEBVTT" or RE_SUB_INDEX.match(s) or RE_SUB_TIMESTAMP.match(s):
+            continue
+        if s.startswith(("NOTE", "STYLE", "REGION")):
+            continue
+        lines.append(RE_SUB_TAG.sub("", s))
+    return "\n".join(lines)
+
+
+def extract_docx(data: bytes) -> str:
+    """word/document.xml の段落（w:p）ごとに w:t を連結する（標準ライブラリのみ）。"""
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        root = ET.fromstring(z.read("word/document.xml"))
+    paras = []
+    for p in root.iter(f"{W_NS}p"):
+        paras.append("".join(t.text or "" for t in p.iter(f"{W_NS}t")))
+    return "\n".join(paras)
+
+
+def extract_pdf(data: bytes) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("PDF 添付の抽出には pypdf が必要です（pip install pypdf）") from e
+    reader = PdfReader(io.BytesIO(data))
+    return "\n".join((page.extract_text() or "") for page in reader.pages)
+
+
+EXTRACTORS = {
+    ".txt": extract_txt,
+    ".srt": extract_subtitles,
+    ".vtt": extract_subtitles,
+    ".docx": extract_docx,
+    ".pdf": extract_pdf,
+}
+
+
+def extract_text(filename: str, data: bytes) -> str:
+    ext = os.path.splitext(filename.lower())[1]
+    return EXTRACTORS[ext](data).strip()
+
+
+# ワーカー側：パースを始めた時刻と pid を親に知らせる（待ち時間上限はキューに並んでいた時間を含めない。
+# pid はワーカーが落ちたかどうかを見るため）
+_started_q = None
+
+
+def _init_worker(started_q):
+    global _started_q
+    _started_q = started_q
+
+
+def _extract_job(job_id: int, filename: str, data: bytes) -> str:
+    _started_q.put((job_id, time.time(), os.getpid()))
+    return extract_text(filename, data)
+
+
+# --------------------
+# Extractor (pool + cache + limits)
+# --------------------
+class _Job:
+    """submit() のハンドル。プールを作り直したら同じ添付を新しい job_id で投げ直す。"""
+
+    def __init__(self, key, filename=None, data=None, value=None):
+        self.key = key
+        self.filename = filename
+        self.data = data
+        self.value = value      # (text, error)。キャッシュヒット・サイズ超過・その場で抽出したときは最初から入っている
+        self.job_id = None
+        self.async_result = None
+        self.started = None     # ワーカーがパースを始めた時刻（time.time()）
+        self.pid = None         # パースしているワーカーの pid
+
+
+class AttachmentExtractor:
+    """
+    添付のテキスト抽出をネットワーク取得から切り離すためのステージ。
+    - submit() はすぐ返る。重い PDF/DOCX のパースは multiprocessing.Pool 側で走る
+    - 添付バイト列の sha256 をキーにディスクへキャッシュし、再実行ではパースしない
+    - サイズ上限（ATTACHMENT_MAX_BYTES）と1件あたりのパース時間の上限（ATTACHMENT_TIMEOUT）を守る。
+      上限を超えたパースがあればプールごと落として作り直し、終わっていない他の添付は投げ直す
+      （固まったパースがワーカーを塞ぎ続けて、後ろに並んだ添付まで巻き添えでタイムアウトしないように）
+    - パース中にワーカーが落ちた添付（Pool は結果を返さないまま待ち続ける）は、期限を待たずに失敗にする
+    processes=0 ならプロセスを立てずにその場で抽出する（時間上限は効かない）。
+    """
+
+    POLL = 0.2  # 結果待ちの間に、パースの開始通知と他の添付の期限を見る間隔
+
+    def __init__(self, processes: int = ATTACHMENT_PROCESSES, cache_dir: str = ATTACHMENT_CACHE_DIR,
+                 max_bytes: int = ATTACHMENT_MAX_BYTES, timeout: float = ATTACHMENT_TIMEOUT):
+        self.processes = processes
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.pool = None
+        self.started_q = None
+        self.running = {}   # job_id -> _Job（プールに投げて、まだ result() で受け取っていないもの）
+        self.next_job_id = 0
+        self.stats = {"cache_hits": 0, "parsed": 0, "failed": 0, "too_large": 0, "timeouts": 0, "crashed": 0}
+        if processes > 0:
+            self._start_pool()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _start_pool(self):
+        # 固まったワーカーを terminate したキューは壊れうるので、プールごとに新しく作る。
+        # SimpleQueue は put がその場でパイプに書く（Queue の送信スレッドと違い、直後にワーカーが落ちても届く）
+        self.started_q = multiprocessing.SimpleQueue()
+        self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(self.started_q,))
+
+    def _dispatch(self, job: _Job):
+        job.job_id = self.next_job_id
+        self.next_job_id += 1
+        job.started = None
+        job.pid = None
+        job.async_result = self.pool.apply_async(_extract_job, (job.job_id, job.filename, job.data))
+        self.running[job.job_id] = job
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".txt")
+
+    def _write_cache(self, key: str, text: str):
+        # 一時ファイルに書いてから置き換える（途中で落ちても中途半端なキャッシュを残さない）
+        path = self._cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def submit(self, filename: str, data: bytes):
+        """抽出を予約してハンドルを返す。結果は result(handle) で受け取る。"""
+        ext = os.path.splitext(filename.lower())[1]
+        key = hashlib.sha256(data).hexdigest() + f"-{ext.lstrip('.')}-v{EXTRACTOR_VERSION}"
+
+        if len(data) > self.max_bytes:
+            self.stats["too_large"] += 1
+            return _Job(None, value=(None, f"{TOO_LARGE}: {len(data)} bytes"))
+
+        if self.cache_dir and os.path.exists(self._cache_path(key)):
+            self.stats["cache_hits"] += 1
+            with open(self._cache_path(key), encoding="utf-8") as f:
+                return _Job(None, value=(f.read(), None))
+
+        job = _Job(key, filename, data)
+        if self.pool is not None:
+            self._dispatch(job)
+            return job
+        try:
+            job.value = (extract_text(filename, data), None)
+        except Exception as e:
+            job.value = (None, str(e))
+        return job
+
+    def _drain_started(self):
+        while not self.started_q.empty():
+            job_id, t, pid = self.started_q.get()
+            job = self.running.get(job_id)
+            if job is not None and job.started is None:
+                job.started, job.pid = t, pid
+
+    def _expire_overdue(self):
+        """
+        パース中にワーカーが落ちた添付を失敗にする（Pool が代わりのワーカーを立てるので、プールはそのまま）。
+        パースを始めてから timeout を超えた添付を失敗にし、プールを作り直して残りを投げ直す。
+        """
+        # active_children() は生きている子プロセスだけを返す（Windows でも使える。os.kill(pid, 0) は Windows では殺してしまう）
+        alive = {p.pid for p in multiprocessing.active_children()}
+        for job in list(self.running.values()):
+            if job.pid is not None and job.pid not in alive and not job.async_result.ready():
+                del self.running[job.job_id]
+                job.value = (None, f"{CRASHED} (pid {job.pid})")
+                self.stats["crashed"] += 1
+
+        now = time.time()
+        overdue = [j for j in self.running.values()
+                   if j.started is not None and now - j.started > self.timeout and not j.async_result.ready()]
+        if not overdue:
+            return
+        for job in overdue:
+            del self.running[job.job_id]
+            job.value = (None, f"{TIMEOUT} {self.timeout}s")
+            self.stats["timeouts"] += 1
+        pending = [j for j in self.running.values() if not j.async_result.ready()]
+        self.pool.terminate()
+        self.pool.join()
+        self._start_pool()
+        for job in pending:
+            del self.running[job.job_id]
+            self._dispatch(job)
+
+    def result(self, job: _Job):
+        """
+        戻り値: (text, error)。失敗・タイムアウト時は text=None。
+        成功したらキャッシュに書く（キャッシュヒット・サイズ超過は key=None なので書かない）。
+        """
+        while job.value is None:
+            self._drain_started()
+            self._expire_overdue()
+            if job.value is not None:
+                break
+            job.async_result.wait(self.POLL)
+            if not job.async_result.ready():
+                continue
+            del self.running[job.job_id]
+            try:
+                job.value = (job.async_result.get(), None)
+            except Exception as e:
+                job.value = (None, str(e))
+
+        text, error = job.value
+        if error is not None:
+            if not error.startswith(TOO_LARGE):
+                self.stats["failed"] += 1
+            return None, error
+        if job.key is not None:
+            self.stats["parsed"] += 1
+            if self.cache_dir:
+                self._write_cache(job.key, text)
+            job.key = None  # 同じハンドルを2回受け取っても数え直さない
+        job.data = None
+        return text, None
@@ -0,0 +1,180 @@
+"""
+make_chunks_step2 のベンチマーク（合成コーパス・使い捨て DB 専用）。
+
+本番データを壊さないよう、BENCH_PG_DB で指定した別データベースだけを使う
+（接続情報の他の項目は .env の PG_* をそのまま使う）。
+
+    # 1) 使い捨て DB に plaud スキーマと合成文書を作る
+    BENCH_PG_DB=plaud_bench python bench_chunks.py --setup --docs 50000 --doc-len 20000
+    # 2) モードごとに別プロセスで全件チャンク化し、所要時間とピーク RSS を比べる
+    BENCH_PG_DB=plaud_bench python bench_chunks.py --modes legacy,values,copy
+
+モード:
+- legacy : 旧実装と同じく対象文書を fetchall() し、execute_values で1トランザクション処理
+- values : キーセットページング + グループごとの commit、挿入は execute_values（CHUNK_LOADER=values）
+- copy   : キーセットページング + グループごとの commit、挿入は COPY + 1文マージ（既定）
+- wN     : copy を --workers N 相当（id の剰余で N 分割、プロセスプール）で実行。例: w2,w4,w8
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+BENCH_DB = os.getenv("BENCH_PG_DB")
+
+SETUP_SQL = """
+CREATE SCHEMA IF NOT EXISTS plaud;
+DROP TABLE IF EXISTS plaud.chunks CASCADE;
+DROP TABLE IF EXISTS plaud.chunk_texts;
+DROP TABLE IF EXISTS plaud.raw_documents;
+CREATE TABLE plaud.raw_documents (
+    id           bigserial PRIMARY KEY,
+    raw_text     text NOT NULL,
+    content_hash text UNIQUE,
+    chunked_hash text,
+    ingested_at  timestamptz DEFAULT now()
+);
+CREATE TABLE plaud.chunks (
+    id              bigserial PRIMARY KEY,
+    raw_document_id bigint NOT NULL REFERENCES plaud.raw_documents(id),
+    chunk_index     int NOT NULL,
+    start_char      int NOT NULL,
+    end_char        int NOT NULL,
+    text            text,
+    chunker         text,
+    chunker_params  jsonb,
+    text_hash       text,
+    UNIQUE (raw_document_id, chunk_index)
+);
+"""
+
+# md5 を繋いだだけだと圧縮が効きすぎるので、文書ごとに違う日本語っぽい文を混ぜる
+CORPUS_SQL = """
+INSERT INTO plaud.raw_documents (raw_text, content_hash)
+SELECT t, md5(t)
+FROM (
+    SELECT string_agg(
+             '発言' || g || '：' || md5(i::text || '-' || g) || 'について確認しました。',
+             '' ORDER BY g) AS t
+    FROM generate_series(1, %(docs)s) AS i,
+         generate_series(1, %(sentences)s) AS g
+    GROUP BY i
+) s;
+"""
+
+RESET_SQL = """
+TRUNCATE plaud.chunks RESTART IDENTITY;
+TRUNCATE plaud.chunk_texts;
+UPDATE plaud.raw_documents SET chunked_hash = NULL;
+"""
+
+
+def run_legacy(step2):
+    with step2.connect_pg() as conn:
+        with conn.cursor() as cur:
+            cur.execute(step2.TARGET_DOCS_SQL, {"min_len": step2.MIN_LEN, "part": 0, "n_parts": 1, "rebuild": False,
+                                                "after_id": 0, "limit": None})
+            rows = cur.fetchall()
+            step2.chunk_group(cur, rows, loader="values")
+        conn.commit()
+
+
+def run_streaming(step2, loader: str):
+    with step2.connect_pg() as conn:
+        for rows in step2.iter_target_groups(conn):
+            with conn.cursor() as cur:
+                step2.chunk_group(cur, rows, loader=loader)
+            conn.commit()
+
+
+def run_workers(step2, n: int):
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n) as ex:
+        list(ex.map(step2.run_partition, range(n), [n] * n))
+
+
+MODES = {
+    "legacy": run_legacy,
+    "values": lambda step2: run_streaming(step2, "values"),
+    "copy": lambda step2: run_streaming(step2, "copy"),
+}
+
+
+def get_mode(name: str):
+    if name in MODES:
+        return MODES[name]
+    if name.startswith("w") and name[1:].isdigit():
+        return lambda step2: run_workers(step2, int(name[1:]))
+    raise SystemExit(f"unknown mode: {name}")
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1e6
+    # Linux は KB 単位。--workers のモードではワーカーのうち最大のものも見る
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def child(mode: str):
+    import make_chunks_step2 as step2
+    t0 = time.perf_counter()
+    get_mode(mode)(step2)
+    print(f"@@ {time.perf_counter() - t0:.3f} {peak_rss_mb():.1f}", flush=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--setup", action="store_true")
+    ap.add_argument("--docs", type=int, default=50000)
+    ap.add_argument("--doc-len", type=int, default=20000, help="1文書のおおよその文字数")
+    ap.add_argument("--modes", default="legacy,values,copy")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args, _ = ap.parse_known_args()
+
+    if not BENCH_DB:
+        sys.exit("BENCH_PG_DB（使い捨てのベンチ用 DB 名）を指定してください")
+    # make_chunks_step2 は import 時に PG_DB を読むので、先に差し替える
+    os.environ["PG_DB"] = BENCH_DB
+    import make_chunks_step2 as step2
+
+    if args.child:
+        child(args.child)
+        return
+
+    if args.setup:
+        sentences = max(1, args.doc_len // 50)
+        with step2.connect_pg() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SETUP_SQL)
+                step2.ensure_chunk_columns(cur)
+                cur.execute(CORPUS_SQL, {"docs": args.docs, "sentences": sentences})
+        print(f"setup: docs={args.docs} doc_len~{sentences * 50}")
+
+    for mode in args.modes.split(","):
+        with step2.connect_pg() as conn:
+            with conn.cursor() as cur:
+                cur.execute(RESET_SQL)
+                cur.execute("SELECT count(*), coalesce(sum(length(raw_text)), 0) FROM plaud.raw_documents;")
+                docs, chars = cur.fetchone()
+            conn.commit()
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", mode] + sys.argv[1:],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        line = [x for x in out.splitlines() if x.startswith("@@ ")][-1]
+        elapsed, rss = map(float, line.split()[1:])
+        with step2.connect_pg() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*) FROM plaud.chunks;")
+                chunks = cur.fetchone()[0]
+        print(f"{mode:8s}: docs={docs} chars={chars} chunks={chunks} "
+              f"elapsed={elapsed:.2f}s ({chunks / elapsed:.0f} chunks/s) peak_rss={rss:.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+make_embeddings_step3 の EMBED_BACKEND（torch / onnx / onnx-int8）の比較（DB には書かない）。
+
+- 精度: 同じ本文を torch fp32 と各 backend で encode し、コサイン類似度（平均・最小・下位1%）を出す
+- 速度: 各 backend の本文/s（モデルの読み込み・ONNX の export 時間は含めない）
+
+本文は既定で合成した日本語っぽい文。--from-db なら plaud.chunks_with_text から無作為に取る（実データ）。
+
+    python bench_embed_backends.py --backends torch,onnx,onnx-int8 --sample 2000
+    python bench_embed_backends.py --from-db --sample 2000
+"""
+import time
+import argparse
+
+import numpy as np
+
+import make_embeddings_step3 as step3
+from bench_embed_processes import make_texts
+
+
+def load_sample(n: int, from_db: bool, length: int):
+    if not from_db:
+        return make_texts(n, length)
+    with step3.connect_pg() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT text FROM plaud.chunks_with_text ORDER BY random() LIMIT %s;", (n,))
+            return [r[0] or "" for r in cur.fetchall()]
+
+
+def encode_all(model, texts, batch_size: int):
+    model.encode(texts[:batch_size], batch_size=batch_size, show_progress_bar=False)  # ウォームアップ
+    t0 = time.perf_counter()
+    vecs = model.encode(texts, batch_size=batch_size, show_progress_bar=False, normalize_embeddings=True)
+    return np.asarray(vecs, dtype=np.float32), time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backends", default=",".join(step3.BACKENDS))
+    ap.add_argument("--sample", type=int, default=2000)
+    ap.add_argument("--from-db", action="store_true", help="plaud.chunks_with_text から本文を取る")
+    ap.add_argument("--length", type=int, default=1000, help="合成本文の文字数")
+    ap.add_argument("--batch", type=int, default=step3.BATCH)
+    args = ap.parse_args()
+
+    texts = load_sample(args.sample, args.from_db, args.length)
+    print(f"model={step3.MODEL_NAME} texts={len(texts)} batch={args.batch}")
+
+    ref = None
+    for backend in ["torch"] + [b for b in args.backends.split(",") if b != "torch"]:
+        model = step3.load_model(backend=backend)
+        vecs, sec = encode_all(model, texts, args.batch)
+        del model
+        if ref is None:
+            ref = vecs
+        # どちらも正規化済みなので内積 = コサイン類似度
+        cos = np.einsum("ij,ij->i", ref, vecs)
+        print(f"{backend:10s}: {len(texts) / sec:8.1f} texts/s  "
+              f"cos vs torch: mean={cos.mean():.5f} min={cos.min():.5f} p1={np.percentile(cos, 1):.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+make_embeddings_step3 のバッチの組み方の比較（DB には書かない）。
+
+- off    : 読み出した順（chunk id 順）に EMBED_BATCH 件ずつ（従来）
+- tokens : EMBED_SORT_WINDOW 件ずつトークン長で並べ替え、EMBED_TOKEN_BUDGET で詰める（既定）
+
+本文/s、padding 効率（実トークン数 / padding 込みトークン数）と、
+chunk ごとのベクトルが変わっていないこと（id で並べ直して最大差）を出す。
+
+本文は既定で合成（文書ごとに 1000 文字窓 + 短い末尾窓、fixed chunk と同じ形）。
+--from-db なら plaud.chunks_with_text から id 順に取る（実データ）。
+
+    python bench_embed_bucketing.py --texts 4000
+    python bench_embed_bucketing.py --from-db --texts 4000
+"""
+import time
+import random
+import argparse
+
+import numpy as np
+
+import make_embeddings_step3 as step3
+from bench_embed_processes import make_texts
+
+
+def load_texts(n: int, from_db: bool, seed: int = 0):
+    if from_db:
+        with step3.connect_pg() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT text FROM plaud.chunks_with_text ORDER BY id LIMIT %s;", (n,))
+                return [r[0] or "" for r in cur.fetchall()]
+    # 1文書 = 1000 文字窓がいくつか + 末尾の短い窓
+    rnd = random.Random(seed)
+    texts = []
+    while len(texts) < n:
+        texts.extend(make_texts(rnd.randint(1, 8), 1000, seed=len(texts)))
+        texts.extend(make_texts(1, rnd.randint(50, 999), seed=len(texts)))
+    return texts[:n]
+
+
+def run(model, batches, count_tokens):
+    vecs = {}
+    real = padded = 0
+    sec = 0.0
+    for batch in batches:
+        texts = [t for t, _ in batch]
+        t0 = time.perf_counter()
+        out = model.encode(texts, batch_size=len(texts), show_progress_bar=False, normalize_embeddings=True)
+        sec += time.perf_counter() - t0
+        for (_, ids), v in zip(batch, out):
+            vecs[ids[0]] = v
+        lens = count_tokens(texts)
+        real += sum(lens)
+        padded += max(lens) * len(lens)
+    return sec, vecs, real / padded
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--texts", type=int, default=4000)
+    ap.add_argument("--from-db", action="store_true")
+    ap.add_argument("--batch", type=int, default=step3.BATCH)
+    ap.add_argument("--window", type=int, default=step3.SORT_WINDOW)
+    ap.add_argument("--budget", type=int, default=step3.TOKEN_BUDGET)
+    args = ap.parse_args()
+
+    texts = load_texts(args.texts, args.from_db)
+    items = [(t, [i]) for i, t in enumerate(texts)]
+    model = step3.load_model()
+    count_tokens = step3.make_token_counter("tokens", model.tokenizer, model.max_seq_length)
+    model.encode(texts[:args.batch], batch_size=args.batch, show_progress_bar=False)  # ウォームアップ
+
+    fixed = [items[i:i + args.batch] for i in range(0, len(items), args.batch)]
+    sec_off, vec_off, eff_off = run(model, fixed, count_tokens)
+    bucketed = list(step3.bucket_batches(iter(fixed), count_tokens, args.budget, args.window))
+    sec_tok, vec_tok, eff_tok = run(model, bucketed, count_tokens)
+
+    diff = max(float(np.abs(vec_off[i] - vec_tok[i]).max()) for i in vec_off)
+    print(f"model={step3.MODEL_NAME} backend={step3.BACKEND} texts={len(texts)}")
+    print(f"off   : {len(texts) / sec_off:8.1f} texts/s  batches={len(fixed)} padding_eff={eff_off:.1%}")
+    print(f"tokens: {len(texts) / sec_tok:8.1f} texts/s  batches={len(bucketed)} padding_eff={eff_tok:.1%} "
+          f"(x{sec_off / sec_tok:.2f})")
+    print(f"max |vec_off - vec_tokens| = {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+make_embeddings_step3 の --processes のスケーリング計測（DB には書かない）。
+
+合成した日本語っぽい chunk 本文を、ワーカー数 1/2/4/8 で encode して本文/s を比べる。
+torch のスレッド数は全プロセス合計で --threads に固定する（N プロセスなら1プロセスあたり threads // N）。
+モデルの読み込み時間は含めない。import のため .env の PG_* は必要（接続はしない）。
+
+    python bench_embed_processes.py --workers 1,2,4,8 --threads 8 --texts 4000
+"""
+import time
+import random
+import argparse
+
+import make_embeddings_step3 as step3
+
+
+def make_texts(n: int, length: int, seed: int = 0):
+    rnd = random.Random(seed)
+    words = ["確認", "予定", "会議", "資料", "来週", "担当", "共有", "対応", "見積", "進捗", "課題", "顧客"]
+    texts = []
+    for i in range(n):
+        s = []
+        while sum(map(len, s)) < length:
+            s.append(f"{rnd.choice(words)}の{rnd.choice(words)}について{rnd.randint(1, 99)}件あります。")
+        texts.append("".join(s)[:length])
+    return texts
+
+
+def batches_of(texts, batch_size: int):
+    for i in range(0, len(texts), batch_size):
+        yield [(t, [i + j]) for j, t in enumerate(texts[i:i + batch_size])]
+
+
+def bench_serial(texts, threads: int, batch_size: int) -> float:
+    import torch
+    torch.set_num_threads(threads)
+    model = step3.load_model()
+    stream = step3.serial_stream(lambda xs: model.encode(
+        xs, batch_size=batch_size, show_progress_bar=False, normalize_embeddings=True))
+    list(stream(batches_of(texts[:batch_size], batch_size)))  # ウォームアップ
+    t0 = time.perf_counter()
+    for _ in stream(batches_of(texts, batch_size)):
+        pass
+    return time.perf_counter() - t0
+
+
+def bench_pool(texts, processes: int, threads: int, batch_size: int) -> float:
+    pool = step3.PoolEncoder(processes, threads=threads)
+    try:
+        list(pool.stream(batches_of(texts[:batch_size * processes], batch_size)))  # ウォームアップ
+        t0 = time.perf_counter()
+        for _ in pool.stream(batches_of(texts, batch_size)):
+            pass
+        return time.perf_counter() - t0
+    finally:
+        pool.close()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", default="1,2,4,8")
+    ap.add_argument("--threads", type=int, default=step3.THREADS, help="全プロセス合計の torch スレッド数")
+    ap.add_argument("--texts", type=int, default=4000)
+    ap.add_argument("--length", type=int, default=1000, help="1本文の文字数（既定は fixed chunk と同じ）")
+    ap.add_argument("--batch", type=int, default=step3.BATCH)
+    args = ap.parse_args()
+
+    texts = make_texts(args.texts, args.length)
+    print(f"model={step3.MODEL_NAME} texts={len(texts)} length={args.length} "
+          f"threads={args.threads} batch={args.batch}")
+    base = None
+    for n in map(int, args.workers.split(",")):
+        if n <= 1:
+            sec = bench_serial(texts, args.threads, args.batch)
+        else:
+            sec = bench_pool(texts, n, args.threads, args.batch)
+        rate = len(texts) / sec
+        base = base or rate
+        print(f"workers={n}: {sec:.1f}s {rate:.1f} texts/s (x{rate / base:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+embed_server の遅延・スループット計測（DB には書かない）。先に同じ .env で embed_server.py を起動しておく。
+
+- cold   : 新しいプロセスで import + モデル読み込み + 1件 encode（サーバ無しの step3 が毎回払う分）
+- single : 1件ずつの問い合わせを順に --queries 回（検索ツールの1クエリ相当）。サーバ経由 / 読み込み済みモデル直接
+- concurrent : --clients 本のスレッドが同時に1件ずつ問い合わせる（マイクロバッチでまとまる）
+- bulk   : --texts 件を EMBED_BATCH 件ずつ（step3 相当）。サーバ経由 / 読み込み済みモデル直接
+
+    python embed_server.py &
+    python bench_embed_server.py --queries 200 --clients 8 --texts 2000
+"""
+import sys
+import time
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+
+import make_embeddings_step3 as step3
+from embed_server import SERVER_URL, EmbedClient, connect_server
+from bench_embed_processes import make_texts
+
+COLD_START = "import make_embeddings_step3 as s; s.load_model().encode(['x'], show_progress_bar=False)"
+
+
+def latency_line(name: str, lat) -> str:
+    lat = np.asarray(lat) * 1000
+    return (f"{name:22s}: mean={lat.mean():7.2f}ms p50={np.percentile(lat, 50):7.2f}ms "
+            f"p95={np.percentile(lat, 95):7.2f}ms ({len(lat) / lat.sum() * 1000:.0f} q/s)")
+
+
+def timed(fn, items):
+    lat = []
+    for x in items:
+        t0 = time.perf_counter()
+        fn(x)
+        lat.append(time.perf_counter() - t0)
+    return lat
+
+
+def bench_concurrent(queries, clients: int):
+    lat = []
+    lock = threading.Lock()
+
+    def worker(part):
+        client = EmbedClient()
+        mine = timed(lambda q: client.encode([q]), part)
+        client.close()
+        with lock:
+            lat.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(queries[i::clients],)) for i in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return lat, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--texts", type=int, default=2000)
+    ap.add_argument("--batch", type=int, default=step3.BATCH)
+    ap.add_argument("--no-local", action="store_true", help="このプロセスでのモデル読み込み・比較をしない")
+    args = ap.parse_args()
+
+    server = connect_server(step3.MODEL_NAME, step3.backend_params(), mode="auto")
+    if server is None:
+        sys.exit(f"{SERVER_URL} に同じモデル（{step3.MODEL_NAME} {step3.backend_params()}）の embed_server がありません")
+
+    queries = make_texts(args.queries, 40, seed=1)  # 検索クエリ程度の短い文
+    texts = make_texts(args.texts, 1000)
+    print(f"model={step3.MODEL_NAME} backend={step3.BACKEND} server={SERVER_URL}")
+
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", COLD_START], check=True, capture_output=True)
+    print(f"{'cold start (in-process)':22s}: {time.perf_counter() - t0:.2f}s")
+
+    model = None
+    if not args.no_local:
+        model = step3.load_model()
+        model.encode(queries[:1], show_progress_bar=False)
+
+    server.encode(queries[:1])  # 接続を張っておく
+    print(latency_line("single (server)", timed(lambda q: server.encode([q]), queries)))
+    if model is not None:
+        print(latency_line("single (in-process)", timed(
+            lambda q: model.encode([q], show_progress_bar=False, normalize_embeddings=True), queries)))
+
+    before = server.stats()
+    lat, sec = bench_concurrent(queries * max(1, args.clients // 2), args.clients)
+    after = server.stats()
+    batches = after["batches"] - before["batches"]
+    print(latency_line(f"concurrent x{args.clients}", lat) +
+          f" total={len(lat) / sec:.0f} q/s avg_batch={(after['texts'] - before['texts']) / max(batches, 1):.1f}")
+
+    batches = [texts[i:i + args.batch] for i in range(0, len(texts), args.batch)]
+    t0 = time.perf_counter()
+    for b in batches:
+        server.encode(b)
+    sec = time.perf_counter() - t0
+    print(f"{'bulk (server)':22s}: {len(texts) / sec:8.1f} texts/s")
+    if model is not None:
+        t0 = time.perf_counter()
+        for b in batches:
+            model.encode(b, batch_size=len(b), show_progress_bar=False, normalize_embeddings=True)
+        sec_local = time.perf_counter() - t0
+        print(f"{'bulk (in-process)':22s}: {len(texts) / sec_local:8.1f} texts/s")
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+make_embeddings_step3 の埋め込みの書き込み方式・保存形式（EMBED_STORAGE）の比較（使い捨て DB 専用）。
+
+本番データを壊さないよう、BENCH_PG_DB で指定した別データベースに使い捨ての表
+（bench_embed.s_<形式>）を作って書く（接続情報の他の項目は .env の PG_* をそのまま使う）。
+モデルは使わず、正規化済みの乱数ベクトルを入れる。
+
+- legacy  : 旧実装（list(map(float, v)) → execute_values で real[] のテキスト表現）
+- array   : real[] に numpy からバイナリ COPY
+- f32/f16 : bytea に numpy からバイナリ COPY
+- vector / halfvec : pgvector の列に numpy からバイナリ COPY（拡張が必要。halfvec は pgvector 0.7 以降）
+
+書き込みの rows/s、表のサイズ（pg_total_relation_size、TOAST・インデックス込み）、
+読み戻し（embedding_store.load_embeddings）の rows/s と元のベクトルとの最大差を出す。
+
+    BENCH_PG_DB=plaud_bench python bench_embed_storage.py --rows 100000 --dim 384
+    BENCH_PG_DB=plaud_bench python bench_embed_storage.py --storages legacy,array,f16
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+import embedding_store
+
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+
+BENCH_DB = os.getenv("BENCH_PG_DB")
+SCHEMA = "bench_embed"
+
+
+def connect_bench():
+    return psycopg2.connect(
+        dbname=BENCH_DB,
+        user=os.getenv("PG_USER"),
+        password=os.getenv("PG_PASS"),
+        host=os.getenv("PG_HOST", "localhost"),
+        port=int(os.getenv("PG_PORT", "5433")),
+        options="-c client_encoding=UTF8",
+    )
+
+
+def create_table(cur, table: str, storage: str):
+    # 本番の chunk_embeddings と同じ形（外部キーは無し）。列は ensure_storage_column に足させる
+    cur.execute(f"""
+        CREATE SCHEMA IF NOT EXISTS {SCHEMA};
+        DROP TABLE IF EXISTS {table};
+        CREATE TABLE {table} (
+            run_id    int NOT NULL,
+            chunk_id  bigint NOT NULL,
+            embedding real[] NOT NULL,
+            PRIMARY KEY (run_id, chunk_id)
+        );
+    """)
+    embedding_store.ensure_storage_column(cur, storage, table)
+
+
+def write_legacy(cur, table: str, chunk_ids, vecs):
+    rows = []
+    for chunk_id, v in zip(chunk_ids, vecs):
+        rows.append((1, int(chunk_id), list(map(float, v))))
+    execute_values(cur, f"""
+        INSERT INTO {table} (run_id, chunk_id, embedding)
+        VALUES %s
+        ON CONFLICT (run_id, chunk_id) DO NOTHING;
+    """, rows, page_size=500)
+
+
+def bench(conn, storage: str, vecs, batch: int):
+    table = f"{SCHEMA}.s_{storage}"
+    chunk_ids = np.arange(1, len(vecs) + 1, dtype=np.int64)
+    with conn.cursor() as cur:
+        create_table(cur, table, "array" if storage == "legacy" else storage)
+        conn.commit()
+        t0 = time.perf_counter()
+        for i in range(0, len(vecs), batch):
+            if storage == "legacy":
+                write_legacy(cur, table, chunk_ids[i:i + batch], vecs[i:i + batch])
+            else:
+                embedding_store.copy_embeddings(cur, 1, chunk_ids[i:i + batch], vecs[i:i + batch], storage, table)
+        conn.commit()
+        write_sec = time.perf_counter() - t0
+
+        cur.execute("SELECT pg_total_relation_size(%s);", (table,))
+        size = cur.fetchone()[0]
+
+        t0 = time.perf_counter()
+        ids, loaded = embedding_store.load_embeddings(cur, 1, "array" if storage == "legacy" else storage,
+                                                      table=table)
+        read_sec = time.perf_counter() - t0
+        conn.rollback()
+    diff = float(np.abs(loaded - vecs[ids - 1]).max())
+    return write_sec, read_sec, size, diff
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=100000)
+    ap.add_argument("--dim", type=int, default=384, help="既定は all-MiniLM-L6-v2 と同じ")
+    ap.add_argument("--batch", type=int, default=2000, help="1回の書き込みの行数（EMBED_COMMIT_EVERY 相当）")
+    ap.add_argument("--storages", default="legacy,array,f32,f16,vector,halfvec")
+    ap.add_argument("--keep", action="store_true", help="使い捨ての表を消さずに残す")
+    args = ap.parse_args()
+
+    if not BENCH_DB:
+        sys.exit("BENCH_PG_DB（使い捨てのベンチ用 DB 名）を指定してください")
+
+    rnd = np.random.default_rng(0)
+    vecs = rnd.standard_normal((args.rows, args.dim)).astype(np.float32)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+
+    print(f"rows={args.rows} dim={args.dim} batch={args.batch}")
+    base = None
+    with connect_bench() as conn:
+        for storage in args.storages.split(","):
+            try:
+                write_sec, read_sec, size, diff = bench(conn, storage, vecs, args.batch)
+            except psycopg2.Error as e:
+                # pgvector が無い・古い（halfvec）ときはその形式だけ飛ばす
+                conn.rollback()
+                print(f"{storage:8s}: skipped ({str(e).strip().splitlines()[0]})")
+                continue
+            rate = args.rows / write_sec
+            base = base or (rate, size)
+            print(f"{storage:8s}: write {rate:8.0f} rows/s (x{rate / base[0]:.1f})  "
+                  f"size {size / 2**20:7.1f}MB (x{base[1] / size:.1f} smaller)  "
+                  f"read {args.rows / read_sec:8.0f} rows/s  max_diff={diff:.1e}")
+        if not args.keep:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+gmail_to_pg の取得モード比較（serial vs batch）。Gmail には繋がない。
+
+Gmail サービスオブジェクトをまねた FakeGmail で、1往復あたり --latency 秒かかる HTTPS を再現する。
+- serial: messages.get と attachments.get が1件ごとに1往復
+- batch : new_batch_http_request 1回（最大 GMAIL_BATCH 件）で1往復
+一部のリクエストは 429 を返すので、batch 側の再試行も含めて計測される。
+
+    python bench_gmail_fetch.py --messages 50 --attachments 2 --latency 0.15
+"""
+import time
+import base64
+import random
+import argparse
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from gmail_to_pg import fetch_messages
+
+
+class FakeRequest:
+    def __init__(self, gmail, fn):
+        self.gmail = gmail
+        self.fn = fn
+
+    def execute(self):
+        time.sleep(self.gmail.latency)
+        self.gmail.round_trips += 1
+        return self.fn()
+
+
+class FakeBatch:
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.items = []
+
+    def add(self, request, request_id):
+        self.items.append((request_id, request))
+
+    def execute(self):
+        time.sleep(self.gmail.latency)
+        self.gmail.round_trips += 1
+        for request_id, request in self.items:
+            if random.random() < self.gmail.error_rate:
+                exc = HttpError(httplib2.Response({"status": 429}), b'{"error": "rateLimitExceeded"}')
+                self.callback(request_id, None, exc)
+            else:
+                self.callback(request_id, request.fn(), None)
+
+
+class FakeGmail:
+    """users().messages().get / attachments().get / new_batch_http_request だけを持つ Gmail もどき。"""
+
+    def __init__(self, n_attachments: int, latency: float, error_rate: float):
+        self.n_attachments = n_attachments
+        self.latency = latency
+        self.error_rate = error_rate
+        self.round_trips = 0
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return _Attachments(self)
+
+    def get(self, userId, id, format="full"):
+        def make():
+            parts = [{"mimeType": "text/plain", "body": {"data": _b64("PLAUD 通知本文")}}]
+            for i in range(self.n_attachments):
+                parts.append({
+                    "filename": f"文字起こし_{i}.txt" if i else "要約.txt",
+                    "mimeType": "text/plain",
+                    "body": {"attachmentId": f"{id}-att{i}"},
+                })
+            headers = [{"name": "Subject", "value": f"Plaud-AutoFlow {id}"},
+                       {"name": "Date", "value": "Mon, 02 Feb 2026 10:00:00 +0900"}]
+            return {"id": id, "threadId": id, "payload": {"headers": headers, "parts": parts}}
+        return FakeRequest(self, make)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+class _Attachments:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def get(self, userId, messageId, id):
+        return FakeRequest(self.gmail, lambda: {"data": _b64(f"{id} の文字起こし" * 200)})
+
+
+def _b64(s: str) -> str:
+    return base64.urlsafe_b64encode(s.encode("utf-8")).decode("ascii")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=50)
+    ap.add_argument("--attachments", type=int, default=2)
+    ap.add_argument("--latency", type=float, default=0.15)
+    ap.add_argument("--error-rate", type=float, default=0.05)
+    args = ap.parse_args()
+
+    msg_ids = [f"m{i:04d}" for i in range(args.messages)]
+    for mode in ("serial", "batch"):
+        gmail = FakeGmail(args.attachments, args.latency, args.error_rate if mode == "batch" else 0.0)
+        t0 = time.perf_counter()
+        out, errors = fetch_messages(gmail, msg_ids, mode=mode)
+        elapsed = time.perf_counter() - t0
+        print(f"{mode:6s}: {elapsed:6.2f}s round_trips={gmail.round_trips:4d} "
+              f"ok={len(out)} failed={len(errors)}")
+
+
+if __name__ == "__main__":
+    main()
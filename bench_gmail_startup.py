@@ -0,0 +1,60 @@
+"""
+gmail_to_pg の起動コスト計測（Gmail / Postgres には繋がない）。
+
+- import 時間: 遅延 import 後の gmail_to_pg と、従来どおり google 系を先に全部読み込んだ場合
+  （それぞれ新しいプロセスで --repeat 回測って中央値）
+- サービス生成: build("gmail", "v1") と、キャッシュ済み discovery document からの build_from_document
+
+新着が無い定期実行は「import + token.json 読み込み + getProfile 1回」で終わるので、
+import 時間がほぼそのまま起動時間になる。
+
+    python bench_gmail_startup.py --repeat 5
+"""
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+EAGER = ("import google.auth.transport.requests, google.oauth2.credentials, "
+         "google_auth_oauthlib.flow, googleapiclient.discovery, googleapiclient.errors; ")
+
+
+def time_subprocess(code: str, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    base = time_subprocess("pass", args.repeat)
+    lazy = time_subprocess("import gmail_to_pg", args.repeat)
+    eager = time_subprocess(EAGER + "import gmail_to_pg", args.repeat)
+    print(f"python startup       : {base:.3f}s")
+    print(f"import (eager google): {eager:.3f}s")
+    print(f"import (lazy)        : {lazy:.3f}s")
+
+    import httplib2
+    from googleapiclient.discovery import build, build_from_document
+    from gmail_to_pg import load_discovery_document
+
+    load_discovery_document()  # キャッシュを温める
+    t0 = time.perf_counter()
+    build("gmail", "v1", http=httplib2.Http())
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    build_from_document(load_discovery_document(), http=httplib2.Http())
+    t_cached = time.perf_counter() - t0
+    print(f"build()                     : {t_build * 1000:.1f}ms")
+    print(f"build_from_document(cached) : {t_cached * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
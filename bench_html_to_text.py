@@ -0,0 +1,99 @@
+"""
+html_to_text のマイクロベンチマーク：旧実装（バックトラックする正規表現5パス）vs 現行（線形走査のみ）。
+
+PLAUD 通知メールと同程度の HTML（インライン style・テーブルレイアウト・実体参照入り）を合成し、
+- スループット（MB/s）
+- 出力の一致率（旧実装の出力を html.unescape + 空白正規化したものと比較）
+を表示する。最後に、閉じていない <script が大量に並ぶ病的な入力での所要時間も比べる。
+
+    python bench_html_to_text.py --docs 200
+"""
+import re
+import html
+import time
+import random
+import argparse
+
+from gmail_to_pg import html_to_text
+
+
+def html_to_text_legacy(html_: str) -> str:
+    """変更前の gmail_to_pg.html_to_text（比較用にそのまま残す）。"""
+    html_ = re.sub(r"<(script|style)[^>]*>.*?</\1>", "", html_, flags=re.IGNORECASE | re.DOTALL)
+    html_ = re.sub(r"<br\s*/?>", "\n", html_, flags=re.IGNORECASE)
+    html_ = re.sub(r"</p\s*>", "\n\n", html_, flags=re.IGNORECASE)
+    html_ = re.sub(r"</div\s*>", "\n", html_, flags=re.IGNORECASE)
+    html_ = re.sub(r"<[^>]+>", "", html_)
+    text = html_.strip()
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text
+
+
+SENTENCES = [
+    "本日の打ち合わせでは来期の予算について議論しました。",
+    "次回までに見積もりを更新し、関係者へ共有します。",
+    "顧客からの要望 &amp; 課題を整理する必要があります。",
+    "Plaud-AutoFlow&nbsp;により自動送信されました。",
+    "音声の文字起こしと要約は添付ファイルをご確認ください。",
+]
+
+
+def synthetic_email(n_paragraphs: int) -> str:
+    style = "<style>" + "".join(
+        f".c{i}{{color:#{i:06x};margin:{i % 7}px}}" for i in range(200)) + "</style>"
+    script = "<script>var x = 1 < 2 && 3 > 2; /* tracking */</script>"
+    rows = []
+    for i in range(n_paragraphs):
+        body = "".join(random.choice(SENTENCES) for _ in range(random.randint(2, 6)))
+        rows.append(
+            f'<tr><td class="c{i % 200}" style="padding:8px;font-family:sans-serif">'
+            f'<div><p>{body}</p><br/>項目{i}</div></td></tr>'
+        )
+    return (
+        "<!DOCTYPE html><html><head>" + style + script + "</head><body>"
+        '<table width="100%" cellpadding="0" cellspacing="0">' + "".join(rows) + "</table>"
+        "</body></html>"
+    )
+
+
+def normalize(s: str) -> str:
+    return re.sub(r"\s+", " ", html.unescape(s).replace("\xa0", " ")).strip()
+
+
+def throughput(fn, corpus) -> float:
+    total = sum(len(d) for d in corpus)
+    t0 = time.perf_counter()
+    for d in corpus:
+        fn(d)
+    return total / (time.perf_counter() - t0) / 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=200)
+    ap.add_argument("--paragraphs", type=int, default=300)
+    ap.add_argument("--pathological", type=int, default=3000)
+    args = ap.parse_args()
+
+    random.seed(0)
+    corpus = [synthetic_email(random.randint(args.paragraphs // 2, args.paragraphs)) for _ in range(args.docs)]
+    avg_kb = sum(len(d) for d in corpus) / len(corpus) / 1024
+    print(f"docs={len(corpus)} avg_size={avg_kb:.0f}KB")
+
+    print(f"legacy : {throughput(html_to_text_legacy, corpus):6.1f} MB/s")
+    # 旧実装は実体参照をデコードしないので、同じ仕事をさせた場合も並べる
+    print(f"legacy+unescape: {throughput(lambda d: html.unescape(html_to_text_legacy(d)), corpus):6.1f} MB/s")
+    print(f"current: {throughput(html_to_text, corpus):6.1f} MB/s")
+
+    same = sum(normalize(html_to_text_legacy(d)) == normalize(html_to_text(d)) for d in corpus)
+    print(f"equivalent output (entities decoded, whitespace normalized): {same}/{len(corpus)}")
+
+    bad = "<script>" * args.pathological + "x" * 1000
+    for name, fn in (("legacy", html_to_text_legacy), ("current", html_to_text)):
+        t0 = time.perf_counter()
+        fn(bad)
+        print(f"pathological ({args.pathological} unclosed <script>) {name:7s}: {time.perf_counter() - t0:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
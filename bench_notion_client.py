@@ -0,0 +1,125 @@
+"""
+NotionClient のベンチマーク（Notion 本体には繋がない）。
+
+ローカルに Notion API もどきの HTTP サーバを立て、
+- databases/{id}/query のページング
+- pages/{id} の並列取得
+を流して pages/s を測り、1秒窓の最大リクエスト数が設定レートを超えないことを確認する。
+一定割合で 429(Retry-After) / 503 を返して、再試行が効いていることも見る。
+
+    python bench_notion_client.py --pages 60 --rps 10 --workers 4
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from notion_api import NotionClient
+
+
+class StubState:
+    def __init__(self, total_pages: int, error_rate: float):
+        self.total_pages = total_pages
+        self.error_rate = error_rate
+        self.hits = []            # リクエスト到着時刻（monotonic）
+        self.lock = threading.Lock()
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code: int, body: dict, headers: dict = None):
+            raw = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _maybe_fail(self) -> bool:
+            with state.lock:
+                state.hits.append(time.monotonic())
+            r = random.random()
+            if r < state.error_rate / 2:
+                self._send(429, {"code": "rate_limited"}, {"Retry-After": "0.2"})
+                return True
+            if r < state.error_rate:
+                self._send(503, {"code": "service_unavailable"})
+                return True
+            return False
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", "0"))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if self._maybe_fail():
+                return
+            size = int(payload.get("page_size", 100))
+            start = int(payload.get("start_cursor") or 0)
+            end = min(start + size, state.total_pages)
+            results = [{"object": "page", "id": f"page-{i}"} for i in range(start, end)]
+            more = end < state.total_pages
+            self._send(200, {"results": results, "has_more": more,
+                             "next_cursor": str(end) if more else None})
+
+        def do_GET(self):
+            if self._maybe_fail():
+                return
+            page_id = urlparse(self.path).path.rsplit("/", 1)[-1]
+            self._send(200, {"object": "page", "id": page_id})
+
+    return Handler
+
+
+def max_in_window(ts, window: float = 1.0) -> int:
+    ts = sorted(ts)
+    best = 0
+    j = 0
+    for i, t in enumerate(ts):
+        while ts[j] <= t - window:
+            j += 1
+        best = max(best, i - j + 1)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, default=60)
+    ap.add_argument("--rps", type=float, default=10.0)
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--error-rate", type=float, default=0.1)
+    args = ap.parse_args()
+
+    state = StubState(args.pages, args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    with NotionClient("dummy", base_url=base_url, rps=args.rps,
+                      max_workers=args.workers) as notion:
+        t0 = time.perf_counter()
+        ids = [p["id"] for p in notion.iter_database("db", {"page_size": 10})]
+        pages = notion.retrieve_pages(ids)
+        elapsed = time.perf_counter() - t0
+        retries = notion.retries
+
+    server.shutdown()
+
+    peak = max_in_window(state.hits)
+    # バケット容量 1 なので、任意の1秒窓で許されるのは rps + 1 件まで
+    limit = int(args.rps) + 1
+    print(f"pages={len(pages)} requests={len(state.hits)} retries={retries}")
+    print(f"elapsed={elapsed:.2f}s pages/s={len(pages) / elapsed:.2f}")
+    print(f"peak requests in 1s window={peak} (limit {limit}) -> {'OK' if peak <= limit else 'EXCEEDED'}")
+
+
+if __name__ == "__main__":
+    main()
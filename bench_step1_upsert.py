@@ -0,0 +1,69 @@
+"""
+step1 の DB 書き込みベンチマーク：1件ずつ（upsert_raw_document + insert_raw_source）vs 一括（flush_pending）。
+
+.env の Postgres（plaud スキーマ作成済み）に対して合成データを流し、最後に ROLLBACK する。
+リモートの Postgres ほど往復回数の差がそのまま効く。
+
+    python bench_step1_upsert.py --docs 1000 --text-len 4000
+"""
+import time
+import uuid
+import random
+import argparse
+
+from notion_to_postgres_step1 import (
+    connect_pg, upsert_raw_document, insert_raw_source, flush_pending, DB_BATCH,
+    ensure_raw_sources_columns,
+)
+
+
+def synthetic_pages(n: int, text_len: int):
+    chars = "あいうえおかきくけこさしすせそ。、PLAUD録音テキスト "
+    run = uuid.uuid4().hex
+    for i in range(n):
+        body = "".join(random.choice(chars) for _ in range(text_len))
+        yield (f"bench-{run}-{i}\n{body}", f"bench-{run}-{i}", "2026-01-01T00:00:00.000Z",
+               f"bench {i}", "2026-01-01T00:00:00.000Z", "property")
+
+
+def bench_row_at_a_time(cur, pages) -> float:
+    t0 = time.perf_counter()
+    for raw_text, page_id, created_time, title, *_ in pages:
+        raw_document_id, _ = upsert_raw_document(cur, raw_text)
+        insert_raw_source(cur, raw_document_id, page_id, created_time, title)
+    return time.perf_counter() - t0
+
+
+def bench_batched(cur, pages) -> float:
+    t0 = time.perf_counter()
+    for i in range(0, len(pages), DB_BATCH):
+        flush_pending(cur, pages[i:i + DB_BATCH])
+    return time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=1000)
+    ap.add_argument("--text-len", type=int, default=4000)
+    args = ap.parse_args()
+
+    conn = connect_pg()
+    try:
+        with conn.cursor() as cur:
+            ensure_raw_sources_columns(cur)
+            a = list(synthetic_pages(args.docs, args.text_len))
+            b = list(synthetic_pages(args.docs, args.text_len))
+            t_row = bench_row_at_a_time(cur, a)
+            t_batch = bench_batched(cur, b)
+    finally:
+        conn.rollback()
+        conn.close()
+
+    print(f"docs={args.docs} text_len={args.text_len}")
+    print(f"row-at-a-time: {t_row:.3f}s ({args.docs / t_row:.0f} docs/s)")
+    print(f"batched:       {t_batch:.3f}s ({args.docs / t_batch:.0f} docs/s)")
+    print(f"speedup: x{t_row / t_batch:.1f}")
+
+
+if __name__ == "__main__":
+    main()
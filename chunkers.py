@@ -0,0 +1,202 @@
+import os
+import re
+import hashlib
+
+# 既定の分割方式。fixed: 従来の固定長窓 / sentence: 文境界で切り、埋め込みモデルのトークン上限まで詰める
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "fixed")
+
+CHUNK_SIZE = 1000
+CHUNK_STRIDE = 800
+
+# sentence 方式の既定値。all-MiniLM-L6-v2 は 256 word piece で切り捨てるので、それに合わせる
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+CHUNK_OVERLAP_SENTENCES = int(os.getenv("CHUNK_OVERLAP_SENTENCES", "1"))
+
+# 文末（。！？!? と閉じ括弧）と改行を区切りとみなす。PLAUD の文字起こしは発話ごとに改行される
+RE_SENTENCE_END = re.compile(r"[。！？!?]+[」』）)\]]*|\n+")
+
+
+def iter_chunks(text: str, size: int, stride: int):
+    n = len(text)
+    idx = 0
+    start = 0
+    while start < n:
+        end = min(start + size, n)
+        yield idx, start, end, text[start:end]
+        idx += 1
+        if end == n:
+            break
+        start += stride
+
+
+def split_sentences(text: str):
+    """文（発話）ごとの (start, end) を返す。空白だけの区間は捨てる。"""
+    spans = []
+    start = 0
+    for m in RE_SENTENCE_END.finditer(text):
+        end = m.end()
+        if text[start:end].strip():
+            spans.append((start, end))
+        start = end
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+def text_hash(text: str) -> str:
+    """chunk 本文のハッシュ（Postgres の md5(text) と同じ値）。"""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+class FixedChunker:
+    """従来どおりの固定長窓（size 文字、stride 文字ずつずらす）。"""
+
+    name = "fixed"
+
+    def __init__(self, size: int = CHUNK_SIZE, stride: int = CHUNK_STRIDE):
+        self.size = size
+        self.stride = stride
+        # 差分再分割で、残した chunk と作り直した chunk の継ぎ目に持たせる重なり（文字数）
+        self.seam_overlap = size - stride
+
+    @property
+    def params(self) -> dict:
+        return {"size": self.size, "stride": self.stride}
+
+    def chunk(self, text: str):
+        return iter_chunks(text, self.size, self.stride)
+
+
+class SentenceChunker:
+    """
+    文境界で切り、埋め込みモデルのトークナイザで数えて max_tokens に収まるまで文を詰める。
+    - トークン数は文書ごとに1回の batched 呼び出し（fast tokenizer）でまとめて数える
+    - 1文だけで上限を超える場合は、offset_mapping を使ってトークン境界で割る
+    - 隣のチャンクと overlap 文だけ重ねる
+    chunk() は iter_chunks と同じ (chunk_index, start_char, end_char, text) を返す。
+    """
+
+    name = "sentence"
+
+    def __init__(self, model_name: str = EMBED_MODEL, max_tokens: int = CHUNK_MAX_TOKENS,
+                 overlap: int = CHUNK_OVERLAP_SENTENCES, tokenizer=None):
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        # 継ぎ目は文境界なので、文字単位の重なりは持たせない
+        self.seam_overlap = 0
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.tokenizer = tokenizer
+        # [CLS] / [SEP] などの分を引いた、本文に使えるトークン数
+        self.budget = max_tokens - tokenizer.num_special_tokens_to_add(pair=False)
+
+    @property
+    def params(self) -> dict:
+        return {"model": self.model_name, "max_tokens": self.max_tokens, "overlap": self.overlap}
+
+    def _units(self, text: str):
+        """文を (start, end, n_tokens) に。上限を超える文はトークン境界で分割しておく。"""
+        spans = split_sentences(text)
+        if not spans:
+            return []
+        enc = self.tokenizer(
+            [text[s:e] for s, e in spans],
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        units = []
+        for (s, e), offsets in zip(spans, enc["offset_mapping"]):
+            n = len(offsets)
+            if n <= self.budget:
+                units.append((s, e, n))
+                continue
+            for i in range(0, n, self.budget):
+                piece = offsets[i:i + self.budget]
+                # 先頭は文頭から、最後は文末まで含める（トークン化されない空白を落とさない）
+                ps = s if i == 0 else s + piece[0][0]
+                pe = e if i + self.budget >= n else s + offsets[i + self.budget][0]
+                units.append((ps, pe, len(piece)))
+        return units
+
+    def chunk(self, text: str):
+        units = self._units(text)
+        idx = 0
+        i = 0
+        done = 0  # ここまでの文はどれかのチャンクに入った
+        while i < len(units):
+            j = i
+            used = 0
+            while j < len(units) and (j == i or used + units[j][2] <= self.budget):
+                used += units[j][2]
+                j += 1
+            if j <= done:
+                # 重ねた文だけで埋まって新しい文が入らない → 重ねずに詰め直す
+                i = done
+                continue
+            done = j
+            start, end = units[i][0], units[j - 1][1]
+            yield idx, start, end, text[start:end]
+            idx += 1
+            if j >= len(units):
+                break
+            i = max(i + 1, j - self.overlap)
+
+
+def diff_chunks(chunker, text: str, old_chunks):
+    """
+    内容が変わった文書を、変わっていない chunk を残したまま分割し直す。
+    old_chunks: 前回の chunk を chunk_index 順に [(chunk_id, text_hash, text), ...]
+                text=None（本文を持たない virtual の行）は 3) のハッシュ一致だけで使い回す
+    戻り値: 新しい並び順の [(chunk_id or None, start_char, end_char, text), ...]
+            chunk_id があるものは前回の行をそのまま使う（埋め込みも再計算不要）
+
+    1) 前回の chunk 本文を新しい本文の先頭から順に探し、見つかったものを残す（順序は保つ）
+    2) 残した chunk の間の隙間だけを chunker で分割し直す（継ぎ目は seam_overlap 文字重ねる）
+    3) 作り直した chunk でも、本文ハッシュが前回のどれかと一致すればその行を使い回す
+    """
+    n = len(text)
+    kept = []
+    pos = 0
+    leftover = {}
+    for chunk_id, h, old_text in old_chunks:
+        i = text.find(old_text, pos) if old_text else -1
+        if i < 0:
+            leftover.setdefault(h, []).append(chunk_id)
+            continue
+        kept.append((chunk_id, i, i + len(old_text), old_text))
+        pos = i + 1
+
+    ov = chunker.seam_overlap
+    out = []
+    prev_end = 0
+    prev_start = -1
+    for k in kept + [None]:
+        next_start = n if k is None else k[1]
+        if next_start > prev_end:
+            lo = max(prev_start + 1, prev_end - ov, 0)
+            hi = n if k is None else min(next_start + ov, n)
+            for _, s, e, chunk_text in chunker.chunk(text[lo:hi]):
+                ids = leftover.get(text_hash(chunk_text))
+                out.append((ids.pop() if ids else None, lo + s, lo + e, chunk_text))
+        if k is not None:
+            out.append(k)
+            prev_start, prev_end = k[1], k[2]
+    return out
+
+
+CHUNKERS = {
+    FixedChunker.name: FixedChunker,
+    SentenceChunker.name: SentenceChunker,
+}
+
+
+def get_chunker(name: str = CHUNK_STRATEGY):
+    try:
+        return CHUNKERS[name]()
+    except KeyError:
+        raise RuntimeError(f"CHUNK_STRATEGY={name} は未対応です（{', '.join(CHUNKERS)}）") from None
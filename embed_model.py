@@ -0,0 +1,86 @@
+"""
+埋め込みモデルの読み込み（make_embeddings_step3 と embed_server で共用）。
+
+DB には触らないので、.env に PG_* が無くても import できる（embed_server を単独で動かす用）。
+設定は step3 と同じ環境変数（EMBED_MODEL / EMBED_BACKEND / EMBED_ONNX_QUANT / EMBED_ONNX_DIR）。
+"""
+import os
+
+from dotenv import load_dotenv
+
+# sentence-transformers / torch は import だけで重いので、load_model の中で import する
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+load_dotenv(os.path.join(BASE_DIR, ".env"))
+
+MODEL_NAME = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# 推論の実装。torch: PyTorch fp32 / onnx: ONNX Runtime / onnx-int8: ONNX Runtime + 動的量子化（int8）
+BACKEND = os.getenv("EMBED_BACKEND", "torch")
+ONNX_QUANT = os.getenv("EMBED_ONNX_QUANT", "avx2")  # onnx-int8 の量子化設定（arm64 / avx2 / avx512 / avx512_vnni）
+ONNX_DIR = os.getenv("EMBED_ONNX_DIR", os.path.join(BASE_DIR, ".cache", "onnx"))  # 量子化済みモデルの置き場
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def backend_params(backend: str = BACKEND) -> dict:
+    """run の params_json に入れる backend の情報（backend が違えば別の run になる）。"""
+    params = {"backend": backend}
+    if backend == "onnx-int8":
+        params["onnx_quantization"] = ONNX_QUANT
+    return params
+
+def load_model(model_name: str = MODEL_NAME, backend: str = BACKEND, threads: int = 0):
+    """
+    backend に応じてモデルを読み込む（CPUでOK。device指定なしで大丈夫（勝手にcpu））。
+    - onnx: sentence-transformers の ONNX backend（モデルに ONNX が無ければその場で export される）
+    - onnx-int8: ONNX を動的量子化したものを ONNX_DIR に1回だけ作って使い回す
+    threads > 0 なら ONNX Runtime のスレッド数をそれに絞る（--processes 用）。
+    """
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    if backend not in BACKENDS:
+        raise RuntimeError(f"EMBED_BACKEND={backend} は未対応です（{', '.join(BACKENDS)}）")
+
+    model_kwargs = {}
+    if threads > 0:
+        import onnxruntime as ort
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = threads
+        so.inter_op_num_threads = 1
+        model_kwargs["session_options"] = so
+
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+
+    local_dir = os.path.join(ONNX_DIR, model_name.replace("/", "__"))
+    file_name = f"onnx/model_qint8_{ONNX_QUANT}.onnx"
+    if not os.path.exists(os.path.join(local_dir, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        print(f"exporting int8 ONNX model to {local_dir} ...")
+        model = SentenceTransformer(model_name, backend="onnx")
+        model.save(local_dir)
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANT, local_dir)
+    return SentenceTransformer(local_dir, backend="onnx", model_kwargs={"file_name": file_name, **model_kwargs})
+
+
+def make_token_counter(bucket: str = "tokens", tokenizer=None, max_seq_length: int = 0):
+    """
+    bucket_batches 用の長さ関数。tokens ならトークナイザで（batched・max_seq_length で切り詰め）、
+    chars なら文字数で数える。off なら None（並べ替えない）。
+    """
+    if bucket == "off":
+        return None
+    if bucket == "chars" or tokenizer is None:
+        cap = max_seq_length or None
+        return lambda texts: [min(len(t), cap) if cap else len(t) for t in texts]
+
+    def count(texts):
+        enc = tokenizer(
+            texts,
+            truncation=bool(max_seq_length),
+            max_length=max_seq_length or None,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return [len(ids) for ids in enc["input_ids"]]
+    return count
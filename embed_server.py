@@ -0,0 +1,326 @@
+"""
+埋め込みモデルを読み込んだまま待ち受けるローカルサーバ（と、そのクライアント）。
+
+make_embeddings_step3 は毎回 torch / sentence-transformers の import とモデルの読み込みから始まるので、
+1日分の新しい chunk を埋め込むより起動の方が長くかかる。このサーバを立てておけば、step3（や検索などのツール）は
+起動時に EMBED_SERVER_URL を確認し、同じモデル・backend のサーバが動いていればそれを使う（無ければ従来どおり自前で読み込む）。
+
+    python embed_server.py                      # EMBED_MODEL / EMBED_BACKEND のモデルで待ち受け
+    python embed_server.py --port 8765 --wait-ms 5
+
+- POST /embed  {"texts": [...], "normalize": true} → float32 リトルエンディアンの行列（X-Embedding-Dim ヘッダ）
+- POST /tokens {"texts": [...]}                    → {"counts": [...]}（step3 のバッチの組み立て用）
+- GET  /health → モデル名・params・次元数
+- GET  /stats  → リクエスト数・本文数・平均バッチサイズ・本文/s・待ち時間込みの遅延（p50 / p95）
+
+同時に来たリクエストは EMBED_SERVER_WAIT_MS だけ待って1回の encode にまとめる（マイクロバッチ）。
+認証は無いので 127.0.0.1 以外では待ち受けないこと。
+"""
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import http.client
+from collections import deque
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# auto: サーバが動いていて同じモデルなら使う / off: 使わない（常に自前で読み込む）
+SERVER = os.getenv("EMBED_SERVER", "auto")
+SERVER_URL = os.getenv("EMBED_SERVER_URL", "http://127.0.0.1:8765")
+WAIT_MS = float(os.getenv("EMBED_SERVER_WAIT_MS", "5"))          # 最初のリクエストからこれだけ待って相乗りを集める
+MAX_BATCH = int(os.getenv("EMBED_SERVER_MAX_BATCH", "256"))      # 1回の encode にまとめる本文数の上限
+CONNECT_TIMEOUT = 0.5  # サーバの有無の確認はすぐ諦めて自前の読み込みに切り替える
+
+
+# --------------------
+# Server
+# --------------------
+class _Request:
+    def __init__(self, texts, normalize: bool):
+        self.texts = texts
+        self.normalize = normalize
+        self.t0 = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """リクエストをキューで受け、encode は専用スレッドで1本ずつ（モデルを複数スレッドから同時に呼ばない）。"""
+
+    def __init__(self, model, wait_ms: float = WAIT_MS, max_batch: int = MAX_BATCH):
+        self.model = model
+        self.wait = wait_ms / 1000
+        self.max_batch = max_batch
+        self.q = queue.Queue()
+        self.started = time.time()
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.encode_sec = 0.0
+        self.latencies = deque(maxlen=2000)  # 直近のリクエストの遅延（キュー待ち込み）
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, texts, normalize: bool = True) -> np.ndarray:
+        req = _Request(texts, normalize)
+        self.q.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _collect(self):
+        reqs = [self.q.get()]
+        n = len(reqs[0].texts)
+        deadline = time.perf_counter() + self.wait
+        while n < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                req = self.q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            reqs.append(req)
+            n += len(req.texts)
+        return reqs
+
+    def _loop(self):
+        while True:
+            reqs = self._collect()
+            for normalize in (True, False):
+                group = [r for r in reqs if r.normalize == normalize]
+                if group:
+                    self._encode(group, normalize)
+
+    def _encode(self, group, normalize: bool):
+        texts = [t for r in group for t in r.texts]
+        t0 = time.perf_counter()
+        try:
+            vecs = np.asarray(self.model.encode(
+                texts,
+                batch_size=max(1, min(len(texts), self.max_batch)),
+                show_progress_bar=False,
+                normalize_embeddings=normalize,
+            ), dtype=np.float32)
+        except Exception as e:
+            for r in group:
+                r.error = e
+                r.done.set()
+            return
+        now = time.perf_counter()
+        self.encode_sec += now - t0
+        self.batches += 1
+        i = 0
+        for r in group:
+            r.result = vecs[i:i + len(r.texts)]
+            i += len(r.texts)
+            self.requests += 1
+            self.texts += len(r.texts)
+            self.latencies.append(now - r.t0)
+            r.done.set()
+
+    def stats(self) -> dict:
+        lat = sorted(self.latencies)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(len(lat) * p))] * 1000, 2) if lat else None
+        return {
+            "uptime_sec": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "texts": self.texts,
+            "batches": self.batches,
+            "avg_batch": round(self.texts / self.batches, 1) if self.batches else 0.0,
+            "encode_sec": round(self.encode_sec, 2),
+            "texts_per_sec": round(self.texts / self.encode_sec, 1) if self.encode_sec else 0.0,
+            "latency_ms_p50": pct(0.5),
+            "latency_ms_p95": pct(0.95),
+            "queued": self.q.qsize(),
+        }
+
+
+def make_handler(batcher: MicroBatcher, info: dict, count_tokens):
+    tokenizer_lock = threading.Lock()  # fast tokenizer は複数スレッドから同時に呼べない
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive（1件ずつの問い合わせで毎回接続し直さない）
+        disable_nagle_algorithm = True  # ヘッダと本体を分けて書くので、Nagle + 遅延 ACK で 40ms 待たされないように
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: bytes, content_type: str = "application/json", headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, status: int, obj):
+            self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._json(200, {"status": "ok", **info})
+            elif self.path == "/stats":
+                self._json(200, batcher.stats())
+            else:
+                self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                texts = body["texts"]
+                if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                    raise ValueError("texts は文字列のリスト")
+            except (ValueError, KeyError) as e:
+                self._json(400, {"error": str(e)})
+                return
+            try:
+                if self.path == "/embed":
+                    vecs = batcher.submit(texts, bool(body.get("normalize", True))) if texts else \
+                        np.zeros((0, info["dim"]), dtype=np.float32)
+                    self._send(200, vecs.astype("<f4").tobytes(), "application/octet-stream",
+                               {"X-Embedding-Dim": str(info["dim"]), "X-Embedding-Count": str(len(texts))})
+                elif self.path == "/tokens":
+                    with tokenizer_lock:
+                        counts = count_tokens(texts) if texts else []
+                    self._json(200, {"counts": counts})
+                else:
+                    self._json(404, {"error": "not found"})
+            except Exception as e:
+                self._json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    return Handler
+
+
+def serve(host: str, port: int, wait_ms: float, max_batch: int):
+    # step3 は import 時に PG_* を読むので、DB を使わない embed_model から読み込む
+    import embed_model
+
+    t0 = time.perf_counter()
+    model = embed_model.load_model()
+    info = {
+        "model_name": embed_model.MODEL_NAME,
+        "params": embed_model.backend_params(),
+        "dim": model.get_sentence_embedding_dimension(),
+        "max_seq_length": model.max_seq_length,
+    }
+    count_tokens = embed_model.make_token_counter("tokens", model.tokenizer, model.max_seq_length)
+    model.encode(["warmup"], show_progress_bar=False)
+    batcher = MicroBatcher(model, wait_ms, max_batch)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, info, count_tokens))
+    server.daemon_threads = True
+    print(f"embed_server: model={info['model_name']} backend={embed_model.BACKEND} dim={info['dim']} "
+          f"loaded in {time.perf_counter() - t0:.1f}s; listening on http://{host}:{port} "
+          f"(wait={wait_ms}ms max_batch={max_batch})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"embed_server: stopped. {json.dumps(batcher.stats())}")
+
+
+# --------------------
+# Client
+# --------------------
+class EmbedClient:
+    """
+    embed_server のクライアント（接続は使い回す）。1つのインスタンスを複数スレッドから同時に使わないこと。
+    encode / count_tokens は make_embeddings_step3 の model.encode / make_token_counter の代わりに使える。
+    """
+
+    def __init__(self, url: str = SERVER_URL, timeout: float = 600):
+        u = urlparse(url)
+        self.host, self.port = u.hostname or "127.0.0.1", u.port or 80
+        self.timeout = timeout
+        self.conn = None
+        self.info = None
+
+    def _request(self, method: str, path: str, body=None, timeout=None):
+        payload = None if body is None else json.dumps(body, ensure_ascii=False).encode("utf-8")
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout or self.timeout)
+            try:
+                self.conn.request(method, path, body=payload,
+                                  headers={"Content-Type": "application/json"} if payload is not None else {})
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # サーバ側で keep-alive が切れていたら1回だけ繋ぎ直す
+                self.close()
+                if attempt:
+                    raise
+        if resp.status != 200:
+            raise RuntimeError(f"embed_server {path}: {resp.status} {data[:200].decode('utf-8', 'replace')}")
+        return resp, data
+
+    def health(self, timeout: float = CONNECT_TIMEOUT) -> dict:
+        _, data = self._request("GET", "/health", timeout=timeout)
+        self.info = json.loads(data)
+        return self.info
+
+    def stats(self) -> dict:
+        return json.loads(self._request("GET", "/stats")[1])
+
+    def encode(self, texts, normalize: bool = True) -> np.ndarray:
+        resp, data = self._request("POST", "/embed", {"texts": list(texts), "normalize": normalize})
+        dim = int(resp.getheader("X-Embedding-Dim"))
+        return np.frombuffer(data, dtype="<f4").reshape(-1, dim)
+
+    def count_tokens(self, texts):
+        return json.loads(self._request("POST", "/tokens", {"texts": list(texts)})[1])["counts"]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def connect_server(model_name: str, params: dict, url: str = SERVER_URL, mode: str = SERVER):
+    """
+    mode=auto で、url のサーバが動いていて model_name / backend の params が同じなら EmbedClient を返す。
+    動いていない・違うモデルなら None（呼び出し側は自前でモデルを読み込む）。
+    """
+    if mode == "off":
+        return None
+    if mode != "auto":
+        raise RuntimeError(f"EMBED_SERVER={mode} は未対応です（auto, off）")
+    client = EmbedClient(url)
+    try:
+        info = client.health()
+    except (OSError, http.client.HTTPException, RuntimeError, ValueError):
+        client.close()
+        return None
+    if info.get("model_name") != model_name or info.get("params") != params:
+        print(f"embed_server at {url} serves {info.get('model_name')} {info.get('params')}; "
+              f"loading {model_name} {params} in-process instead")
+        client.close()
+        return None
+    client.timeout = 600
+    client.close()  # health は短いタイムアウトで繋いだので、次のリクエストで繋ぎ直す
+    return client
+
+
+def main():
+    u = urlparse(SERVER_URL)
+    ap = argparse.ArgumentParser(description="埋め込みモデルを読み込んだまま待ち受ける")
+    ap.add_argument("--host", default=u.hostname or "127.0.0.1")
+    ap.add_argument("--port", type=int, default=u.port or 8765)
+    ap.add_argument("--wait-ms", type=float, default=WAIT_MS, help="マイクロバッチの待ち時間")
+    ap.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    args = ap.parse_args()
+    serve(args.host, args.port, args.wait_ms, args.max_batch)
+
+
+if __name__ == "__main__":
+    main()
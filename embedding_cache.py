@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+# run をまたいで使う埋め込みキャッシュ（キー: (sha256(本文), model_name, params)）
+# pg   : plaud.embedding_cache 表（既定。どのホストの step3 からも共有される）
+# local: CACHE_DIR 以下のローカルファイル（sqlite の索引 + memmap のベクトル）。CACHE_MAX_MB を超えたら LRU で追い出す
+# off  : 使わない（モデルの中身が同じ名前のまま変わったときなど、全件 encode し直したいとき）
+CACHE = os.getenv("EMBED_CACHE", "pg")
+CACHES = ("pg", "local", "off")
+CACHE_DIR = os.getenv("EMBED_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings"))
+CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "1024"))
+
+LOOKUP_PAGE = 500  # 1回の問い合わせに入れるキー数
+
+
+def text_sha256(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def cache_params(params: dict) -> str:
+    """
+    キャッシュのキーに入れる params（正規化した JSON 文字列）。
+    storage は保存する列の違いだけでベクトル（float32）は同じなので外す。
+    """
+    return json.dumps({k: v for k, v in params.items() if k != "storage"}, sort_keys=True)
+
+
+class _CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        # lookup は step3 の読み出しスレッド、put は書き込みスレッドから呼ばれるので、時間も別々に数える
+        self.lookup_sec = 0.0
+        self.put_sec = 0.0
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        s = f"cache={self.kind} hits={self.hits} misses={self.misses} hit_rate={rate:.1%} stored={self.stored}"
+        if self.kind == "local":
+            s += f" evicted={self.evicted}"
+        return s + f" lookup={self.lookup_sec:.1f}s put={self.put_sec:.1f}s"
+
+
+class PgEmbeddingCache(_CacheStats):
+    """
+    plaud.embedding_cache に float32 の bytea で持つ。接続は専用（autocommit）で、step3 の run の commit とは独立。
+    lookup 用と put 用に接続を1本ずつ持つ（読み出しスレッドと書き込みスレッドが同時に使っても待ち合わない）。
+    追い出しはしない（要らなくなったモデルの分は DELETE ... WHERE model_name = ... で消す）。
+    """
+    kind = "pg"
+
+    def __init__(self, connect, model_name: str, params: dict):
+        super().__init__()
+        self.read_conn = connect()
+        self.write_conn = connect()
+        for conn in (self.read_conn, self.write_conn):
+            conn.autocommit = True
+        self.model_name = model_name
+        self.params_key = cache_params(params)
+        with self.write_conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS plaud.embedding_cache (
+                    model_name  text NOT NULL,
+                    params_key  text NOT NULL,
+                    text_sha256 bytea NOT NULL,
+                    embedding   bytea NOT NULL,
+                    created_at  timestamptz NOT NULL DEFAULT now(),
+                    PRIMARY KEY (model_name, params_key, text_sha256)
+                );
+            """)
+
+    def lookup(self, texts):
+        """texts と同じ並びで、キャッシュにあればベクトル、無ければ None を返す。"""
+        t0 = time.perf_counter()
+        keys = [text_sha256(t) for t in texts]
+        found = {}
+        with self.read_conn.cursor() as cur:
+            for i in range(0, len(keys), LOOKUP_PAGE):
+                cur.execute("""
+                    SELECT text_sha256, embedding
+                    FROM plaud.embedding_cache
+                    WHERE model_name = %s AND params_key = %s AND text_sha256 = ANY(%s);
+                """, (self.model_name, self.params_key, keys[i:i + LOOKUP_PAGE]))
+                for key, emb in cur.fetchall():
+                    found[bytes(key)] = np.frombuffer(emb, dtype="<f4")
+        out = [found.get(k) for k in keys]
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        self.lookup_sec += time.perf_counter() - t0
+        return out
+
+    def put(self, texts, vecs):
+        t0 = time.perf_counter()
+        vecs = np.asarray(vecs, dtype="<f4")
+        rows = [(self.model_name, self.params_key, text_sha256(t), v.tobytes()) for t, v in zip(texts, vecs)]
+        with self.write_conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO plaud.embedding_cache (model_name, params_key, text_sha256, embedding)
+                VALUES %s
+                ON CONFLICT DO NOTHING;
+            """, rows, page_size=500)
+        self.stored += len(rows)
+        self.put_sec += time.perf_counter() - t0
+
+    def close(self):
+        self.read_conn.close()
+        self.write_conn.close()
+
+
+class LocalEmbeddingCache(_CacheStats):
+    """
+    (model_name, params) ごとのディレクトリに
+      index.db    : sqlite（sha256 → 行番号、最後に使った順番）
+      vectors.f32 : (行数, dim) の float32 を memmap したファイル
+    を置く。行数の上限は max_mb から決め、満杯なら最後に使ったのが古いものから行を再利用する（LRU）。
+    同じディレクトリを同時に使うのは1プロセスだけの前提。
+    プロセス内では lookup（読み出しスレッド）と put（書き込みスレッド）をロックで直列にする
+    （put が LRU で行を再利用している途中の memmap を lookup が読まないように）。
+    """
+    kind = "local"
+
+    def __init__(self, model_name: str, params: dict, dim: int, cache_dir: str = CACHE_DIR,
+                 max_mb: int = CACHE_MAX_MB):
+        super().__init__()
+        key = hashlib.sha256(f"{model_name}\n{cache_params(params)}".encode("utf-8")).hexdigest()[:16]
+        self.dir = os.path.join(cache_dir, key)
+        os.makedirs(self.dir, exist_ok=True)
+        self.dim = dim
+        self.capacity = max(1, max_mb * 2**20 // (dim * 4))
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.dir, "index.db"), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+            CREATE TABLE IF NOT EXISTS entries (sha BLOB PRIMARY KEY, slot INTEGER NOT NULL UNIQUE,
+                                                used INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS entries_used_idx ON entries (used);
+        """)
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('model_name', ?), ('params', ?), ('dim', ?);",
+                        (model_name, cache_params(params), str(dim)))
+        if int(self.db.execute("SELECT v FROM meta WHERE k = 'dim';").fetchone()[0]) != dim:
+            raise RuntimeError(f"{self.dir} の次元数がモデル（dim={dim}）と違います（ディレクトリを消してください）")
+        # 上限を下げたときは、はみ出した行を捨てる
+        self.evicted += self.db.execute("DELETE FROM entries WHERE slot >= ?;", (self.capacity,)).rowcount
+        self.db.commit()
+        self.tick, self.next_slot = self.db.execute(
+            "SELECT coalesce(max(used), 0) + 1, coalesce(max(slot), -1) + 1 FROM entries;").fetchone()
+
+        path = os.path.join(self.dir, "vectors.f32")
+        size = self.capacity * dim * 4
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)  # 未使用部分は疎ファイルなのでディスクは使った分だけ
+        self.vectors = np.memmap(path, dtype="<f4", mode="r+", shape=(self.capacity, dim))
+
+    def lookup(self, texts):
+        t0 = time.perf_counter()
+        keys = [text_sha256(t) for t in texts]
+        slots = {}
+        with self.lock:
+            for i in range(0, len(keys), LOOKUP_PAGE):
+                page = keys[i:i + LOOKUP_PAGE]
+                marks = ",".join("?" * len(page))
+                slots.update(self.db.execute(f"SELECT sha, slot FROM entries WHERE sha IN ({marks});", page))
+            if slots:
+                self.db.executemany("UPDATE entries SET used = ? WHERE sha = ?;", [(self.tick, k) for k in slots])
+                self.db.commit()
+                self.tick += 1
+            # memmap からコピーして返す（後で行が再利用されても呼び出し側の値は変わらない）
+            out = [np.array(self.vectors[slots[k]]) if k in slots else None for k in keys]
+        self.hits += len(slots)
+        self.misses += len(keys) - len(slots)
+        self.lookup_sec += time.perf_counter() - t0
+        return out
+
+    def _take_slots(self, n: int):
+        """空き行を n 個確保する。足りなければ LRU で追い出す。"""
+        fresh = list(range(self.next_slot, min(self.next_slot + n, self.capacity)))
+        self.next_slot += len(fresh)
+        need = n - len(fresh)
+        if need <= 0:
+            return fresh
+        old = self.db.execute("SELECT sha, slot FROM entries ORDER BY used LIMIT ?;", (need,)).fetchall()
+        self.db.executemany("DELETE FROM entries WHERE sha = ?;", [(sha,) for sha, _ in old])
+        self.evicted += len(old)
+        return fresh + [slot for _, slot in old]
+
+    def put(self, texts, vecs):
+        t0 = time.perf_counter()
+        keys = {}
+        for t, v in zip(texts, vecs):
+            keys.setdefault(text_sha256(t), v)
+        items = list(keys)
+        with self.lock:
+            known = set()
+            for i in range(0, len(items), LOOKUP_PAGE):
+                page = items[i:i + LOOKUP_PAGE]
+                marks = ",".join("?" * len(page))
+                known.update(r[0] for r in self.db.execute(f"SELECT sha FROM entries WHERE sha IN ({marks});", page))
+            # 1回に上限を超える分は入れない（入れてもすぐ追い出されるだけ）
+            new = [k for k in items if k not in known][:self.capacity]
+            if new:
+                slots = self._take_slots(len(new))
+                self.vectors[slots] = np.asarray([keys[k] for k in new], dtype="<f4")
+                self.db.executemany("INSERT INTO entries (sha, slot, used) VALUES (?, ?, ?);",
+                                    [(k, s, self.tick) for k, s in zip(new, slots)])
+                self.db.commit()
+                self.tick += 1
+        self.stored += len(new)
+        self.put_sec += time.perf_counter() - t0
+
+    def close(self):
+        self.vectors.flush()
+        self.db.close()
+
+
+def open_cache(kind: str, connect, model_name: str, params: dict, dim: int):
+    """kind に応じたキャッシュを返す（off なら None）。connect は pg 用の接続を作る関数（lookup 用と put 用に2回呼ぶ）。"""
+    if kind not in CACHES:
+        raise RuntimeError(f"EMBED_CACHE={kind} は未対応です（{', '.join(CACHES)}）")
+    if kind == "pg":
+        return PgEmbeddingCache(connect, model_name, params)
+    if kind == "local":
+        return LocalEmbeddingCache(model_name, params, dim)
+    return None
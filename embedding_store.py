@@ -0,0 +1,164 @@
+import io
+import os
+import struct
+
+import numpy as np
+
+# 埋め込みの保存形式
+# array  : 従来どおり chunk_embeddings.embedding（real[]）
+# f32    : chunk_embeddings.embedding_bin（bytea、float32 リトルエンディアン。np.frombuffer でそのまま読める）
+# f16    : chunk_embeddings.embedding_bin（bytea、float16。サイズ半分、正規化済みベクトルなら誤差 ~1e-3）
+# vector : chunk_embeddings.embedding_vec（pgvector の vector。DB 側で距離検索・インデックスが使える）
+# halfvec: chunk_embeddings.embedding_half（pgvector 0.7 以降の halfvec）
+STORAGE = os.getenv("EMBED_STORAGE", "array")
+STORAGES = ("array", "f32", "f16", "vector", "halfvec")
+
+COLUMNS = {
+    "array": ("embedding", "real[]"),
+    "f32": ("embedding_bin", "bytea"),
+    "f16": ("embedding_bin", "bytea"),
+    "vector": ("embedding_vec", "vector"),
+    "halfvec": ("embedding_half", "halfvec"),
+}
+
+# bytea に入れるときの numpy dtype（読むときも同じ dtype で frombuffer する）
+BYTEA_DTYPES = {"f32": "<f4", "f16": "<f2"}
+
+# Postgres バイナリ COPY のヘッダとトレーラ
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+
+FLOAT4_OID = 700
+
+
+def check_storage(storage: str):
+    if storage not in STORAGES:
+        raise RuntimeError(f"EMBED_STORAGE={storage} は未対応です（{', '.join(STORAGES)}）")
+
+
+def ensure_storage_column(cur, storage: str = STORAGE, table: str = "plaud.chunk_embeddings"):
+    """
+    保存形式に応じた列を追加する（無ければ）。
+    array 以外では embedding（real[]）は入れないので NOT NULL を外しておく。
+    vector / halfvec は pgvector 拡張（CREATE EXTENSION vector）が入っている必要がある。
+    """
+    check_storage(storage)
+    column, sql_type = COLUMNS[storage]
+    if storage == "array":
+        return
+    cur.execute(f"""
+        ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {sql_type};
+        ALTER TABLE {table} ALTER COLUMN embedding DROP NOT NULL;
+    """)
+
+
+def _payload_dtype(storage: str, dim: int):
+    """1行分の埋め込み列（長さの前置きを除く）のバイナリ表現。"""
+    if storage == "array":
+        # 1次元配列: ndim, hasnull, 要素型, 要素数, 下限 + 要素ごとに (長さ, 値)
+        return [("ndim", ">i4"), ("hasnull", ">i4"), ("oid", ">i4"), ("n", ">i4"), ("lbound", ">i4"),
+                ("el", [("len", ">i4"), ("v", ">f4")], (dim,))]
+    if storage in BYTEA_DTYPES:
+        return [("v", BYTEA_DTYPES[storage], (dim,))]
+    if storage == "vector":
+        return [("dim", ">i2"), ("unused", ">i2"), ("v", ">f4", (dim,))]
+    return [("dim", ">i2"), ("unused", ">i2"), ("v", ">f2", (dim,))]  # halfvec
+
+
+def build_copy_payload(run_id: int, chunk_ids, vecs, storage: str = STORAGE) -> bytes:
+    """
+    (run_id, chunk_id, 埋め込み) の行をバイナリ COPY 形式にする。
+    1行の長さは次元数だけで決まるので、構造化 dtype の配列に numpy のまま流し込んで tobytes() するだけ
+    （Python で float をリストにしたり文字列にしたりしない）。
+    """
+    vecs = np.asarray(vecs, dtype=np.float32)
+    n, dim = vecs.shape
+    payload = _payload_dtype(storage, dim)
+    row = np.zeros(n, dtype=[
+        ("nfields", ">i2"),
+        ("run_len", ">i4"), ("run_id", ">i4"),
+        ("chunk_len", ">i4"), ("chunk_id", ">i8"),
+        ("emb_len", ">i4"), ("emb", payload),
+    ])
+    row["nfields"] = 3
+    row["run_len"] = 4
+    row["run_id"] = run_id
+    row["chunk_len"] = 8
+    row["chunk_id"] = np.asarray(chunk_ids, dtype=np.int64)
+    row["emb_len"] = np.dtype(payload).itemsize
+    emb = row["emb"]
+    if storage == "array":
+        emb["ndim"] = 1
+        emb["oid"] = FLOAT4_OID
+        emb["n"] = dim
+        emb["lbound"] = 1
+        emb["el"]["len"] = 4
+        emb["el"]["v"] = vecs
+    else:
+        if storage in ("vector", "halfvec"):
+            emb["dim"] = dim
+        emb["v"] = vecs
+    return COPY_HEADER + row.tobytes() + COPY_TRAILER
+
+
+def copy_embeddings(cur, run_id: int, chunk_ids, vecs, storage: str = STORAGE,
+                    table: str = "plaud.chunk_embeddings") -> int:
+    """
+    バイナリ COPY で一時表に流し込み、1文で table にマージする（既にある (run_id, chunk_id) は飛ばす）。
+    vecs: shape (len(chunk_ids), dim) の numpy 配列
+    """
+    if len(chunk_ids) == 0:
+        return 0
+    column, sql_type = COLUMNS[storage]
+    stage = f"embeddings_stage_{storage}"
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {stage} (
+            run_id   int,
+            chunk_id bigint,
+            {column} {sql_type}
+        );
+    """)
+    cur.copy_expert(f"COPY {stage} (run_id, chunk_id, {column}) FROM STDIN WITH (FORMAT binary)",
+                    io.BytesIO(build_copy_payload(run_id, chunk_ids, vecs, storage)))
+    cur.execute(f"""
+        INSERT INTO {table} (run_id, chunk_id, {column})
+        SELECT run_id, chunk_id, {column} FROM {stage}
+        ON CONFLICT (run_id, chunk_id) DO NOTHING;
+        TRUNCATE {stage};
+    """)
+    return len(chunk_ids)
+
+
+def decode_embedding(value, storage: str = STORAGE) -> np.ndarray:
+    """
+    1行分の値を numpy にする。bytea は np.frombuffer で DB から受け取ったバッファをそのまま使う（コピーしない）。
+    vector / halfvec は SELECT で ::real[] にキャストしたものを受け取る前提（load_embeddings 参照）。
+    """
+    if storage in BYTEA_DTYPES:
+        return np.frombuffer(value, dtype=BYTEA_DTYPES[storage])
+    return np.asarray(value, dtype=np.float32)
+
+
+def load_embeddings(cur, run_id: int, storage: str = STORAGE, chunk_ids=None,
+                    table: str = "plaud.chunk_embeddings"):
+    """
+    run の埋め込みをまとめて読む（検索など後段用）。
+    戻り値: (chunk_ids の int64 配列, shape (n, dim) の行列)
+    bytea は全行のバッファを1回つなげて frombuffer するので、行ごとの Python オブジェクトを作らない。
+    """
+    column = COLUMNS[storage][0]
+    select = column if storage in ("array",) + tuple(BYTEA_DTYPES) else f"{column}::real[]"
+    sql = f"SELECT chunk_id, {select} FROM {table} WHERE run_id = %s"
+    args = [run_id]
+    if chunk_ids is not None:
+        sql += " AND chunk_id = ANY(%s)"
+        args.append(list(chunk_ids))
+    cur.execute(sql + " ORDER BY chunk_id;", args)
+    rows = cur.fetchall()
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    if not rows:
+        return ids, np.zeros((0, 0), dtype=np.float32)
+    if storage in BYTEA_DTYPES:
+        buf = b"".join(r[1] for r in rows)
+        return ids, np.frombuffer(buf, dtype=BYTEA_DTYPES[storage]).reshape(len(rows), -1)
+    return ids, np.asarray([r[1] for r in rows], dtype=np.float32)
@@ -1,26 +1,58 @@
 import os
 import re
 import json
+import time
 import base64
+import random
 import hashlib
+import argparse
+import urllib.request
 from datetime import datetime, timezone
 from email.utils import parsedate_to_datetime
+from html import unescape
 
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import DictCursor, Json
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+# google-auth / googleapiclient は重いので、実際に Gmail を叩くときに関数内で import する
+# （新着が無い定期実行を1秒未満で終わらせるため）
+
+from attachment_extract import AttachmentExtractor, is_supported, is_transient_error
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# batch: Gmail のバッチエンドポイントでまとめて取得 / serial: 1件ずつ（従来どおり）
+FETCH_MODE = os.getenv("GMAIL_FETCH_MODE", "batch")
+# 1バッチあたりの件数。API 上限は 100 だが、大きいほど 429 を食らいやすいので既定は 50
+BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH", "50")), 100)
+MAX_RETRIES = 5
+# 添付の抽出が時間切れ・ワーカー異常終了で失敗したメッセージを、後の実行で取り直す回数の上限
+ATTACHMENT_RETRIES = int(os.getenv("GMAIL_ATTACHMENT_RETRIES", "3"))
+
+# history API の差分から PLAUD のメールだけを拾うための条件（GMAIL_QUERY の from / subject に合わせる）
+HISTORY_FROM = os.getenv("GMAIL_HISTORY_FROM", "no-reply@plaud.ai")
+HISTORY_SUBJECT = os.getenv("GMAIL_HISTORY_SUBJECT", "Plaud-AutoFlow")
+SYNC_KEY = "gmail:me"
+
+GMAIL_API = "https://gmail.googleapis.com/gmail/v1"
+# discovery document のローカルキャッシュ（build_from_document で使う）
+DISCOVERY_CACHE = os.getenv(
+    "GMAIL_DISCOVERY_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "gmail_v1_discovery.json"),
+)
+DISCOVERY_MAX_AGE = 7 * 24 * 3600
+
 # --------------------
 # Gmail auth
 # --------------------
-def get_gmail_service():
+def get_credentials():
+    """
+    token.json から認証情報を読む。期限切れなら refresh、無ければブラウザ認可。
+    token.json を書き直すのは中身が変わったときだけ。
+    """
+    from google.oauth2.credentials import Credentials
+
     load_dotenv()
     token_path = os.getenv("GMAIL_TOKEN_JSON", "token.json")
     cred_path = os.getenv("GMAIL_CREDENTIALS_JSON", "credentials.json")
@@ -31,14 +63,58 @@ def get_gmail_service():
 
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(cred_path, SCOPES)
             creds = flow.run_local_server(port=0)
         with open(token_path, "w", encoding="utf-8") as f:
             f.write(creds.to_json())
 
-    return build("gmail", "v1", credentials=creds)
+    return creds
+
+def load_discovery_document():
+    """
+    Gmail v1 の discovery document をローカルキャッシュから読む。
+    無い・古いときだけ googleapiclient 同梱の静的ドキュメント（無ければ API）から取り直して保存する。
+    """
+    try:
+        if time.time() - os.path.getmtime(DISCOVERY_CACHE) < DISCOVERY_MAX_AGE:
+            with open(DISCOVERY_CACHE, encoding="utf-8") as f:
+                return f.read()
+    except OSError:
+        pass
+
+    from googleapiclient.discovery_cache import get_static_doc
+    doc = get_static_doc("gmail", "v1")
+    if doc is None:
+        url = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+        with urllib.request.urlopen(url, timeout=30) as r:
+            doc = r.read().decode("utf-8")
+
+    os.makedirs(os.path.dirname(DISCOVERY_CACHE), exist_ok=True)
+    with open(DISCOVERY_CACHE, "w", encoding="utf-8") as f:
+        f.write(doc)
+    return doc
+
+def get_gmail_service(creds=None):
+    from googleapiclient.discovery import build_from_document
+
+    creds = creds or get_credentials()
+    return build_from_document(load_discovery_document(), credentials=creds)
+
+def probe_history_id(creds) -> str:
+    """
+    users.getProfile だけを素の HTTPS で叩いて現在の historyId を返す（googleapiclient を読み込まない）。
+    メールボックスに何か変化があれば historyId は必ず増えるので、前回値と同じなら新着は無い。
+    """
+    req = urllib.request.Request(
+        f"{GMAIL_API}/users/me/profile",
+        headers={"Authorization": f"Bearer {creds.token}"},
+    )
+    with urllib.request.urlopen(req, timeout=30) as r:
+        return str(json.loads(r.read())["historyId"])
 
 # --------------------
 # PostgreSQL
@@ -81,21 +157,60 @@ def b64url_decode(data: str) -> bytes:
         return b""
     return base64.urlsafe_b64decode(data.encode("utf-8"))
 
+# script/style/コメントの開始。中身は閉じタグまで str 検索で読み飛ばす（バックトラック無し）
+RE_HTML_SKIP_START = re.compile(r"<(script|style)\b|<!--", re.IGNORECASE)
+RE_HTML_SKIP_END = {
+    "script": re.compile(r"</script\s*>", re.IGNORECASE),
+    "style": re.compile(r"</style\s*>", re.IGNORECASE),
+}
+RE_HTML_BR = re.compile(r"<br\b[^<>]*>", re.IGNORECASE)
+RE_HTML_P_END = re.compile(r"</p\s*>", re.IGNORECASE)
+RE_HTML_BLOCK_END = re.compile(r"</(?:div|li|tr|table|h[1-6])\s*>", re.IGNORECASE)
+# [^<>]* なので、閉じていない "<" があっても次の "<" で打ち切られる
+RE_HTML_TAG = re.compile(r"<[^<>]*>")
+RE_MANY_NEWLINES = re.compile(r"\n{3,}")
+
+def strip_skipped_html(html: str) -> str:
+    """script/style は中身ごと、コメントも丸ごと消す。閉じていなければ末尾まで捨てる。"""
+    out = []
+    pos = 0
+    n = len(html)
+    while True:
+        m = RE_HTML_SKIP_START.search(html, pos)
+        if not m:
+            out.append(html[pos:])
+            break
+        out.append(html[pos:m.start()])
+        if m.group(1):
+            end = RE_HTML_SKIP_END[m.group(1).lower()].search(html, m.end())
+            pos = n if end is None else end.end()
+        else:
+            end = html.find("-->", m.end())
+            pos = n if end < 0 else end + 3
+    return "".join(out)
+
 def html_to_text(html: str) -> str:
+    """
+    HTML → テキスト。走査位置が前に進むだけのパターンしか使わないので、
+    巨大・壊れた HTML でも入力長に比例した時間で終わる。実体参照（&amp; &nbsp; 等）もデコードする。
+    """
     # style/script は中身ごと消す（ここが重要）
-    html = re.sub(r"<(script|style)[^>]*>.*?</\1>", "", html, flags=re.IGNORECASE | re.DOTALL)
+    html = strip_skipped_html(html)
 
     # 改行っぽいものだけ整形
-    html = re.sub(r"<br\s*/?>", "\n", html, flags=re.IGNORECASE)
-    html = re.sub(r"</p\s*>", "\n\n", html, flags=re.IGNORECASE)
-    html = re.sub(r"</div\s*>", "\n", html, flags=re.IGNORECASE)
+    html = RE_HTML_BR.sub("\n", html)
+    html = RE_HTML_P_END.sub("\n\n", html)
+    html = RE_HTML_BLOCK_END.sub("\n", html)
 
     # 残りタグ除去
-    html = re.sub(r"<[^>]+>", "", html)
+    html = RE_HTML_TAG.sub("", html)
+
+    # &nbsp; は普通の空白に寄せる
+    text = unescape(html).replace("\xa0", " ")
 
     # 余分な空行を軽く整理
-    text = html.strip()
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = text.strip()
+    text = RE_MANY_NEWLINES.sub("\n\n", text)
     return text
 
 def walk_parts(part):
@@ -134,17 +249,13 @@ def extract_body_text(payload) -> str:
         return "\n\n".join([c.strip() for c in html_chunks if c.strip()]).strip()
     return ""
 
-def fetch_txt_attachments(gmail, msg_id: str, payload):
+def list_attachment_parts(payload):
     """
-    .txt 添付を取り出して返す:
-    - attachments: [{"filename":..., "mimeType":..., "text":...}, ...]
-    - summary_text: 要約.txt があればそこだけ別取り
+    テキスト化できる添付（.txt / .srt / .vtt / .pdf / .docx）の part を列挙する:
+    [(filename, mimeType, attachmentId), ...]
     """
-    attachments = []
-    summary_text = ""
-
-    all_parts = walk_parts(payload)
-    for p in all_parts:
+    found = []
+    for p in walk_parts(payload):
         filename = (p.get("filename") or "").strip()
         if not filename:
             continue
@@ -153,26 +264,38 @@ def fetch_txt_attachments(gmail, msg_id: str, payload):
         body = p.get("body", {}) or {}
         att_id = body.get("attachmentId")
 
-        # 今回は .txt だけ対象（必要なら later で pdf/docx も）
-        if not filename.lower().endswith(".txt"):
+        if not is_supported(filename):
             continue
         if not att_id:
             continue
 
-        att = gmail.users().messages().attachments().get(
-            userId="me",
-            messageId=msg_id,
-            id=att_id,
-        ).execute()
+        found.append((filename, mime, att_id))
+    return found
 
-        data = att.get("data")
-        text = b64url_decode(data).decode("utf-8", errors="replace").strip()
+def build_attachments(parts, extracted):
+    """
+    抽出済みの添付テキスト extracted: {attachmentId: (text, error)} から
+    - attachments: [{"filename":..., "mimeType":..., "text":...}, ...]
+    - summary_text: 要約.txt があればそこだけ別取り
+    を組み立てる。取得できなかった添付（extracted に無い）は飛ばし、
+    抽出に失敗した添付は meta に error を残して本文には混ぜない（取り直すかどうかは build_document が決める）。
+    """
+    attachments = []
+    summary_text = ""
+
+    for filename, mime, att_id in parts:
+        if att_id not in extracted:
+            continue
+        text, error = extracted[att_id]
 
         attachments.append({
             "filename": filename,
             "mimeType": mime,
-            "text_len": len(text),
+            "text_len": len(text or ""),
         })
+        if error:
+            attachments[-1]["error"] = error
+            continue
 
         # 要約.txt は summary_text に格納、それ以外は raw_text に混ぜる
         if "要約" in filename:
@@ -184,107 +307,531 @@ def fetch_txt_attachments(gmail, msg_id: str, payload):
 
     return attachments, summary_text
 
+def collect_attachments(extractor: AttachmentExtractor, parts, handles):
+    """handles: {attachmentId: extractor.submit(...) の戻り値} を待って build_attachments に渡す。"""
+    extracted = {att_id: extractor.result(h) for att_id, h in handles.items()}
+    return build_attachments(parts, extracted)
+
+def fetch_attachments(gmail, extractor: AttachmentExtractor, msg_id: str, payload):
+    """
+    添付を1件ずつ取得して抽出ステージに投げる（serial モード）。
+    """
+    parts = list_attachment_parts(payload)
+    handles = {}
+    for filename, _, att_id in parts:
+        att = gmail.users().messages().attachments().get(
+            userId="me",
+            messageId=msg_id,
+            id=att_id,
+        ).execute()
+        handles[att_id] = extractor.submit(filename, b64url_decode(att.get("data")))
+    return collect_attachments(extractor, parts, handles)
+
+# --------------------
+# Batch fetch
+# --------------------
+def is_retryable(exc) -> bool:
+    """429 / 5xx / 403 rateLimitExceeded はクォータ・一時障害なので再試行する。"""
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(exc, HttpError):
+        return False
+    status = exc.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        reason = str(exc.error_details or exc.content or "")
+        return "rateLimitExceeded" in reason or "userRateLimitExceeded" in reason
+    return False
+
+def is_transient(exc) -> bool:
+    """batch.execute() 自体が投げた例外のうち、送り直せば通りうるもの（通信エラー・バッチ端点の 429 / 5xx）。"""
+    import httplib2
+
+    return is_retryable(exc) or isinstance(exc, (OSError, httplib2.HttpLib2Error))
+
+def batch_execute(gmail, makers: dict, batch_size: int = BATCH_SIZE, on_result=None):
+    """
+    makers: {key: () -> HttpRequest}
+    new_batch_http_request で batch_size 件ずつまとめて送り、
+    ({key: response}, {key: exception}) を返す。
+    on_result(key, response) を渡すと、成功した件ごとにその場で呼ぶ（後段の処理を通信と重ねる用）。
+    1件ごとの失敗はその件だけ記録し、再試行可能なものはジッター付き指数バックオフで送り直す
+    （HttpRequest は使い回せないので makers から作り直す）。
+    batch.execute() 自体が通信エラー等で落ちたときは、そのバッチでまだ結果の来ていない件を全部送り直す
+    （再試行を使い切ったらその件の失敗として返す。呼び出し側は historyId を進めない）。
+    """
+    results = {}
+    errors = {}
+    pending = dict(makers)
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+                if on_result is not None:
+                    on_result(request_id, response)
+            elif is_retryable(exception) and attempt < MAX_RETRIES:
+                retry[request_id] = pending[request_id]
+            else:
+                errors[request_id] = exception
+
+        keys = list(pending)
+        for i in range(0, len(keys), batch_size):
+            chunk = keys[i:i + batch_size]
+            batch = gmail.new_batch_http_request(callback=callback)
+            for key in chunk:
+                batch.add(pending[key](), request_id=key)
+            try:
+                batch.execute()
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                for key in chunk:
+                    if key in results or key in errors or key in retry:
+                        continue
+                    if attempt < MAX_RETRIES:
+                        retry[key] = pending[key]
+                    else:
+                        errors[key] = e
+
+        if not retry:
+            break
+        time.sleep(random.uniform(0, min(32, 2 ** attempt)))
+        pending = retry
+
+    return results, errors
+
+def fetch_messages_batch(gmail, extractor: AttachmentExtractor, msg_ids):
+    """
+    messages.get(format=full) と添付を batch でまとめて取得する。
+    添付は届いたバッチから順に抽出ステージへ投げるので、パースは後続バッチの通信と並行して進む。
+    戻り値: ({msg_id: (full, attachments_meta, summary_text)}, {msg_id: exception})
+    """
+    fulls, errors = batch_execute(gmail, {
+        msg_id: (lambda m=msg_id: gmail.users().messages().get(userId="me", id=m, format="full"))
+        for msg_id in msg_ids
+    })
+
+    # 添付は全メッセージ分をまとめて1回の batch_execute に流す
+    parts_by_msg = {}
+    att_makers = {}
+    att_keys = {}
+    for msg_id, full in fulls.items():
+        parts = list_attachment_parts(full.get("payload", {}) or {})
+        parts_by_msg[msg_id] = parts
+        for filename, _, att_id in parts:
+            key = f"a{len(att_makers)}"
+            att_keys[key] = (msg_id, att_id, filename)
+            att_makers[key] = (lambda m=msg_id, a=att_id: gmail.users().messages().attachments().get(
+                userId="me", messageId=m, id=a))
+
+    handles_by_msg = {}
+
+    def on_attachment(key, att):
+        msg_id, att_id, filename = att_keys[key]
+        handles_by_msg.setdefault(msg_id, {})[att_id] = extractor.submit(filename, b64url_decode(att.get("data")))
+
+    _, att_errors = batch_execute(gmail, att_makers, on_result=on_attachment)
+
+    for key, exc in att_errors.items():
+        # 添付が1つでも取れなかったメッセージは中途半端に保存せず失敗扱い
+        errors[att_keys[key][0]] = exc
+
+    out = {}
+    for msg_id, full in fulls.items():
+        if msg_id in errors:
+            continue
+        attachments_meta, summary_text = collect_attachments(
+            extractor, parts_by_msg[msg_id], handles_by_msg.get(msg_id, {}))
+        out[msg_id] = (full, attachments_meta, summary_text)
+    return out, errors
+
+def fetch_messages_serial(gmail, extractor: AttachmentExtractor, msg_ids):
+    out = {}
+    for msg_id in msg_ids:
+        full = gmail.users().messages().get(
+            userId="me",
+            id=msg_id,
+            format="full",
+        ).execute()
+        attachments_meta, summary_text = fetch_attachments(gmail, extractor, msg_id, full.get("payload", {}) or {})
+        out[msg_id] = (full, attachments_meta, summary_text)
+    return out, {}
+
+def fetch_messages(gmail, msg_ids, mode: str = FETCH_MODE, extractor: AttachmentExtractor = None):
+    """
+    extractor を渡さなければ、プロセスもキャッシュも使わずその場で抽出する。
+    """
+    if extractor is None:
+        extractor = AttachmentExtractor(processes=0, cache_dir=None)
+    if mode == "serial":
+        return fetch_messages_serial(gmail, extractor, msg_ids)
+    return fetch_messages_batch(gmail, extractor, msg_ids)
+
+# --------------------
+# Listing (full / history)
+# --------------------
+def list_message_ids_full(gmail, query: str):
+    """
+    GMAIL_QUERY にヒットするメッセージを nextPageToken で最後まで辿る（初回・history 失効時）。
+    """
+    ids = []
+    page_token = None
+    while True:
+        res = gmail.users().messages().list(
+            userId="me", q=query, maxResults=500, pageToken=page_token,
+        ).execute()
+        ids.extend(m["id"] for m in res.get("messages", []))
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            break
+    return ids
+
+def list_added_message_ids(gmail, start_history_id: str):
+    """
+    users.history.list で start_history_id 以降に追加されたメッセージIDを返す。
+    戻り値: (ids, 最新の historyId)
+    start_history_id が古すぎる（約1週間で失効）と 404 の HttpError になる。
+    """
+    ids = []
+    seen = set()
+    page_token = None
+    latest = start_history_id
+    while True:
+        res = gmail.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            maxResults=500,
+            pageToken=page_token,
+        ).execute()
+        latest = res.get("historyId", latest)
+        for h in res.get("history", []) or []:
+            for added in h.get("messagesAdded", []) or []:
+                msg = added.get("message", {})
+                labels = msg.get("labelIds", []) or []
+                # 検索と同じく迷惑メール・ゴミ箱は対象外
+                if "SPAM" in labels or "TRASH" in labels:
+                    continue
+                if msg.get("id") and msg["id"] not in seen:
+                    seen.add(msg["id"])
+                    ids.append(msg["id"])
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            break
+    return ids, latest
+
+def filter_plaud_messages(gmail, msg_ids):
+    """
+    history の差分には PLAUD 以外のメールも混ざるので、
+    format=metadata（From / Subject だけ）を batch で引いて絞り込む。
+    戻り値: (PLAUD のメッセージID, {metadata を取れなかった msg_id: exception})
+    """
+    if not msg_ids:
+        return [], {}
+    metas, errors = batch_execute(gmail, {
+        msg_id: (lambda m=msg_id: gmail.users().messages().get(
+            userId="me", id=m, format="metadata", metadataHeaders=["From", "Subject"]))
+        for msg_id in msg_ids
+    })
+    out = []
+    for msg_id in msg_ids:
+        meta = metas.get(msg_id)
+        if not meta:
+            continue
+        headers = (meta.get("payload", {}) or {}).get("headers", []) or []
+        from_ = (header_value(headers, "From") or "").lower()
+        subject = header_value(headers, "Subject") or ""
+        if HISTORY_FROM.lower() in from_ and HISTORY_SUBJECT in subject:
+            out.append(msg_id)
+    return out, errors
+
+def current_history_id(gmail) -> str:
+    return str(gmail.users().getProfile(userId="me").execute()["historyId"])
+
+# --------------------
+# Sync state
+# --------------------
+def ensure_sync_state_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS plaud.sync_state (
+            sync_key   text PRIMARY KEY,
+            watermark  text,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        );
+    """)
+
+def load_watermark(cur, sync_key: str):
+    cur.execute("SELECT watermark FROM plaud.sync_state WHERE sync_key = %s;", (sync_key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def save_watermark(cur, sync_key: str, watermark: str):
+    cur.execute(
+        """
+        INSERT INTO plaud.sync_state (sync_key, watermark, updated_at)
+        VALUES (%s, %s, now())
+        ON CONFLICT (sync_key) DO UPDATE
+        SET watermark = EXCLUDED.watermark, updated_at = EXCLUDED.updated_at;
+        """,
+        (sync_key, watermark),
+    )
+
+def list_target_message_ids(gmail, query: str, history_id, full: bool):
+    """
+    前回の historyId があれば差分（history.list）、無ければ / 失効していれば全件（messages.list）。
+    戻り値: (msg_ids, 次回用の historyId, "incremental" | "full", {絞り込みで取れなかった msg_id: exception})
+    """
+    from googleapiclient.errors import HttpError
+
+    if history_id and not full:
+        try:
+            added, latest = list_added_message_ids(gmail, history_id)
+            plaud, errors = filter_plaud_messages(gmail, added)
+            return plaud, latest, "incremental", errors
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print(f"historyId={history_id} expired -> full backfill")
+
+    # 一覧を取る前に historyId を押さえておけば、一覧中に届いたメールも次回の差分に入る
+    latest = current_history_id(gmail)
+    return list_message_ids_full(gmail, query), latest, "full", {}
+
+# --------------------
+# Document / upsert
+# --------------------
+def build_document(msg_id: str, full: dict, attachments_meta, summary_text: str, attempt: int = 1) -> dict:
+    """
+    messages.get(full) の結果と添付から raw_documents 1行分を組み立てる。
+    attempt: このメッセージを取るのが何回目か（前回までに添付の抽出で時間切れ等があったときに 2 以上）。
+    時間切れ・ワーカー異常終了で取れなかった添付には、ATTACHMENT_RETRIES 回までは retry を立てる
+    （load_retry_ids が次回また取り直す）。壊れたファイルなどパースの失敗は何度やっても同じなので立てない。
+    """
+    payload = full.get("payload", {}) or {}
+    headers = payload.get("headers", []) or []
+
+    subject = header_value(headers, "Subject") or ""
+    from_ = header_value(headers, "From") or ""
+    to_ = header_value(headers, "To") or ""
+    date_ = header_value(headers, "Date") or ""
+    recorded_at = parse_date_to_utc(date_)
+
+    body_text = extract_body_text(payload)
+
+    # 添付本文（要約以外）を raw_text に混ぜる
+    attachment_texts = []
+    for a in attachments_meta:
+        t = a.pop("text", None)  # metaからは外す
+        if t:
+            attachment_texts.append(f"--- attachment: {a['filename']} ---\n{t}")
+
+    combined_raw = "\n\n".join([x for x in [body_text, *attachment_texts] if x]).strip()
+
+    # 念のため（raw_text が NOT NULL 対策）
+    combined_raw = combined_raw or ""
+
+    meta = {
+        "from": from_,
+        "to": to_,
+        "threadId": full.get("threadId"),
+        "attachments": attachments_meta,
+    }
+    transient = [a for a in attachments_meta if a.get("error") and is_transient_error(a["error"])]
+    if transient:
+        meta["extract_attempts"] = attempt
+        if attempt <= ATTACHMENT_RETRIES:
+            for a in transient:
+                a["retry"] = True
+
+    return {
+        "source_id": msg_id,
+        "recorded_at": recorded_at,
+        "gmail_received_at": recorded_at,
+        "title": subject,
+        "raw_text": combined_raw,
+        "summary_text": summary_text,
+        "content_hash": sha256_text(combined_raw),
+        "ingested_at": datetime.now(timezone.utc),
+        "meta": meta,
+    }
+
+def load_known_hashes(cur, msg_ids) -> dict:
+    """
+    取り込み済みメッセージの {source_id: content_hash} を1クエリで返す。
+    添付の抽出をやり直す必要があるもの（retry 付き）は取り込み済みに数えない。
+    """
+    if not msg_ids:
+        return {}
+    cur.execute(
+        """
+        SELECT source_id, content_hash
+        FROM plaud.raw_documents
+        WHERE source_type = 'gmail'
+          AND source_id = ANY(%s)
+          AND NOT jsonb_path_exists(meta_json, '$.attachments[*].retry ? (@ == true)');
+        """,
+        (list(msg_ids),),
+    )
+    return {r[0]: r[1] for r in cur.fetchall()}
+
+
+def load_retry_ids(cur) -> dict:
+    """
+    添付の抽出に失敗して retry が付いたまま取り込まれたメッセージの {source_id: これまでに取った回数}。
+    history の差分にはもう出てこないので、こちらから拾って取り直す（回数は build_document の attempt に使う）。
+    """
+    cur.execute(
+        """
+        SELECT source_id, coalesce((meta_json->>'extract_attempts')::int, 1)
+        FROM plaud.raw_documents
+        WHERE source_type = 'gmail'
+          AND jsonb_path_exists(meta_json, '$.attachments[*].retry ? (@ == true)')
+        ORDER BY source_id;
+        """
+    )
+    return {r[0]: r[1] for r in cur.fetchall()}
+
+def upsert_document(cur, doc: dict):
+    """
+    ★既存行を育てる：DO UPDATE にする。戻り値: "new" / "changed" / "unchanged"
+    保存する列（本文・要約・件名・meta など）が全部同じなら何も書かない（dead tuple を作らない）。
+    content_hash は raw_text だけのハッシュ（step2 の作り直し判定・一意化に使う）なので、それだけでは比べない。
+    """
+    cur.execute(
+        """
+        INSERT INTO plaud.raw_documents
+        (source_type, source_id, recorded_at, gmail_received_at, title, raw_text,
+        summary_text, content_hash, ingested_at, meta_json)
+        VALUES
+        (%s, %s, %s, %s, %s, %s,
+        %s, %s, %s, %s)
+        ON CONFLICT (source_type, source_id)
+        DO UPDATE SET
+        recorded_at       = EXCLUDED.recorded_at,
+        gmail_received_at = EXCLUDED.gmail_received_at,
+        title             = EXCLUDED.title,
+        raw_text          = EXCLUDED.raw_text,
+        summary_text      = EXCLUDED.summary_text,
+        content_hash      = EXCLUDED.content_hash,
+        ingested_at       = EXCLUDED.ingested_at,
+        meta_json         = EXCLUDED.meta_json
+        WHERE (plaud.raw_documents.content_hash, plaud.raw_documents.raw_text, plaud.raw_documents.summary_text,
+               plaud.raw_documents.title, plaud.raw_documents.recorded_at, plaud.raw_documents.meta_json)
+              IS DISTINCT FROM
+              (EXCLUDED.content_hash, EXCLUDED.raw_text, EXCLUDED.summary_text,
+               EXCLUDED.title, EXCLUDED.recorded_at, EXCLUDED.meta_json)
+        RETURNING (xmax = 0)
+        """,
+        (
+            "gmail",
+            doc["source_id"],
+            doc["recorded_at"],
+            doc["gmail_received_at"],
+            doc["title"],
+            doc["raw_text"],
+            doc["summary_text"],
+            doc["content_hash"],
+            doc["ingested_at"],
+            Json(doc["meta"]),
+        ),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return "unchanged"
+    return "new" if row[0] else "changed"
+
 # --------------------
 # Main
 # --------------------
+def parse_args():
+    ap = argparse.ArgumentParser(description="Gmail (PLAUD) -> plaud.raw_documents 取り込み")
+    ap.add_argument("--full", action="store_true",
+                    help="historyId を無視して GMAIL_QUERY の全件を取り直す")
+    ap.add_argument("--refetch", action="store_true",
+                    help="取り込み済みメッセージも本文・添付を取り直して hash を比較する")
+    return ap.parse_args()
+
 def main():
+    args = parse_args()
     load_dotenv()
     query = os.getenv("GMAIL_QUERY", 'from:no-reply@plaud.ai subject:"Plaud-AutoFlow" newer_than:30d')
 
-    gmail = get_gmail_service()
+    creds = get_credentials()
     pg = get_pg_conn()
     cur = pg.cursor()
 
-    res = gmail.users().messages().list(userId="me", q=query, maxResults=50).execute()
-    msgs = res.get("messages", [])
-    print(f"hit={len(msgs)} query={query}")
+    ensure_sync_state_table(cur)
+    history_id = load_watermark(cur, SYNC_KEY)
+    retry_ids = load_retry_ids(cur)
+
+    # 新着も取り直しも無ければ googleapiclient を読み込む前に終わる
+    if history_id and not args.full and not retry_ids:
+        try:
+            current = probe_history_id(creds)
+        except OSError as e:  # urllib の通信エラーは OSError 系。通常経路に任せる
+            print("probe failed:", e)
+            current = None
+        if current == history_id:
+            print(f"no new mail (historyId={history_id})")
+            pg.commit()
+            cur.close()
+            pg.close()
+            return
+
+    gmail = get_gmail_service(creds)
+
+    msg_ids, latest_history_id, sync_mode, list_errors = list_target_message_ids(
+        gmail, query, history_id, args.full)
+    for msg_id, exc in list_errors.items():
+        # PLAUD のメールかどうか分からないまま捨てると二度と拾えないので、historyId を進めない
+        print("metadata failed:", msg_id, exc)
+    print(f"hit={len(msg_ids)} sync={sync_mode} query={query} mode={FETCH_MODE}")
+
+    # 前回までに添付の抽出が時間切れ等で失敗したメッセージも取り直す（historyId の進み方には関係させない）
+    seen = set(msg_ids)
+    extra = [m for m in retry_ids if m not in seen]
+    if retry_ids:
+        print(f"retry={len(retry_ids)} (attachment extraction timed out or crashed before)")
+        msg_ids = msg_ids + extra
+
+    # Gmail のメッセージは不変なので、取り込み済みなら本文・添付のダウンロード自体を省く
+    known = load_known_hashes(cur, msg_ids)
+    to_fetch = msg_ids if args.refetch else [m for m in msg_ids if m not in known]
+    counts = {"new": 0, "changed": 0, "unchanged": len(msg_ids) - len(to_fetch)}
+
+    with AttachmentExtractor() as extractor:
+        fetched, errors = fetch_messages(gmail, to_fetch, extractor=extractor)
+    print("attachments:", " ".join(f"{k}={v}" for k, v in extractor.stats.items()))
+
+    for msg_id in to_fetch:
+        if msg_id in errors:
+            print("failed:", msg_id, errors[msg_id])
+            continue
 
-    for m in msgs:
-        msg_id = m["id"]
+        full, attachments_meta, summary_text = fetched[msg_id]
+        doc = build_document(msg_id, full, attachments_meta, summary_text, attempt=retry_ids.get(msg_id, 0) + 1)
 
-        # ★ここがポイント：full で取る
-        full = gmail.users().messages().get(
-            userId="me",
-            id=msg_id,
-            format="full",
-        ).execute()
+        # 文字起こし（content_hash）が同じでも、要約や meta だけ変わっていることがあるので DB 側で比べる
+        status = upsert_document(cur, doc)
+        counts[status] += 1
+        if status != "unchanged":
+            print(f"upserted({status}):", msg_id, doc["title"])
 
-        payload = full.get("payload", {}) or {}
-        headers = payload.get("headers", []) or []
+    print(f"new={counts['new']} changed={counts['changed']} unchanged={counts['unchanged']}")
 
-        subject = header_value(headers, "Subject") or ""
-        from_ = header_value(headers, "From") or ""
-        to_ = header_value(headers, "To") or ""
-        date_ = header_value(headers, "Date") or ""
-        recorded_at = parse_date_to_utc(date_)
-
-        body_text = extract_body_text(payload)
-
-        attachments_meta, summary_text = fetch_txt_attachments(gmail, msg_id, payload)
-
-        # 添付本文（要約以外）を raw_text に混ぜる
-        attachment_texts = []
-        for a in attachments_meta:
-            t = a.pop("text", None)  # metaからは外す
-            if t:
-                attachment_texts.append(f"--- attachment: {a['filename']} ---\n{t}")
-
-        combined_raw = "\n\n".join([x for x in [body_text, *attachment_texts] if x]).strip()
-
-        ingested_at = datetime.now(timezone.utc)
-        gmail_received_at = recorded_at
-        content_hash = sha256_text(combined_raw)
-
-        meta = {
-            "from": from_,
-            "to": to_,
-            "threadId": full.get("threadId"),
-            "attachments": attachments_meta,
-        }
-
-        # ★既存行を育てる：DO UPDATE にする
-
-        # 念のため（raw_text が NOT NULL 対策）
-        combined_raw = combined_raw or ""
-
-        cur.execute(
-            """
-            INSERT INTO plaud.raw_documents
-            (source_type, source_id, recorded_at, gmail_received_at, title, raw_text,
-            summary_text, content_hash, ingested_at, meta_json)
-            VALUES
-            (%s, %s, %s, %s, %s, %s,
-            %s, %s, %s, %s)
-            ON CONFLICT (source_type, source_id)
-            DO UPDATE SET
-            recorded_at       = EXCLUDED.recorded_at,
-            gmail_received_at = EXCLUDED.gmail_received_at,
-            title             = EXCLUDED.title,
-            raw_text          = EXCLUDED.raw_text,
-            summary_text      = EXCLUDED.summary_text,
-            content_hash      = EXCLUDED.content_hash,
-            ingested_at       = EXCLUDED.ingested_at,
-            meta_json         = EXCLUDED.meta_json
-            """,
-            (
-                "gmail",
-                msg_id,
-                recorded_at,
-                gmail_received_at,
-                subject,
-                combined_raw,
-                summary_text,
-                content_hash,
-                ingested_at,
-                Json(meta),
-            ),
-        )
-
-        print("upserted:", msg_id, subject)
+    # 取れなかったメッセージがあるときは historyId を進めない（次回の差分で拾い直す）
+    if errors or list_errors:
+        print(f"failed={len(errors) + len(list_errors)} (historyId not advanced)")
+    else:
+        save_watermark(cur, SYNC_KEY, latest_history_id)
 
     pg.commit()
     cur.close()
     pg.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
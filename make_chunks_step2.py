@@ -1,7 +1,13 @@
+import io
 import os
+import json
+import argparse
 import psycopg2
 from psycopg2.extras import execute_values
 from dotenv import load_dotenv
+from concurrent.futures import ProcessPoolExecutor
+
+from chunkers import CHUNK_STRATEGY, CHUNKERS, FixedChunker, diff_chunks, get_chunker, text_hash
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
@@ -18,10 +24,18 @@ PG_PASS = require_env("PG_PASS")
 PG_HOST = os.getenv("PG_HOST", "localhost")
 PG_PORT = int(os.getenv("PG_PORT", "5433"))
 
-CHUNK_SIZE = 1000
-CHUNK_STRIDE = 800
 MIN_LEN = 50
 BATCH = 200
+# 対象文書は id 順に GROUP_DOCS 件ずつ（キーセットページングで）受け取り、グループごとに commit する
+GROUP_DOCS = int(os.getenv("CHUNK_GROUP_DOCS", "100"))
+# copy: COPY でステージング表に流し込み、1文で plaud.chunks にマージ / values: 従来の execute_values
+LOADER = os.getenv("CHUNK_LOADER", "copy")
+# 内容が変わった文書は、変わっていない chunk（id・埋め込み）を残して差分だけ作り直す
+INCREMENTAL = os.getenv("CHUNK_INCREMENTAL", "1") == "1"
+# inline: 従来どおり chunks.text / dedup: 本文は plaud.chunk_texts に text_hash ごと1行だけ置き、chunks.text は NULL
+# virtual: 本文はどこにも持たず (raw_document_id, start_char, end_char) だけ。読むときに raw_text から切り出す
+# dedup / virtual は chunks.text を直接読む処理を plaud.chunks_with_text に移してから使う
+TEXT_STORE = os.getenv("CHUNK_TEXT_STORE", "inline")
 
 def connect_pg():
     return psycopg2.connect(
@@ -33,93 +47,427 @@ def connect_pg():
         options="-c client_encoding=UTF8",
     )
 
-def iter_chunks(text: str, size: int, stride: int):
-    n = len(text)
-    idx = 0
-    start = 0
-    while start < n:
-        end = min(start + size, n)
-        yield idx, start, end, text[start:end]
-        idx += 1
-        if end == n:
-            break
-        start += stride
-
 def bulk_insert(cur, to_insert):
     sql = """
         INSERT INTO plaud.chunks
-            (raw_document_id, chunk_index, start_char, end_char, text)
+            (raw_document_id, chunk_index, start_char, end_char, text, chunker, chunker_params, text_hash)
         VALUES %s
         ON CONFLICT (raw_document_id, chunk_index) DO NOTHING;
     """
     execute_values(cur, sql, to_insert)
     return len(to_insert)
 
+CHUNK_COLUMNS = ("raw_document_id", "chunk_index", "start_char", "end_char", "text",
+                 "chunker", "chunker_params", "text_hash")
+
+def ensure_chunk_columns(cur):
+    """
+    分割方式・パラメータと本文ハッシュ（md5）の列、重複排除した本文の置き場、
+    本文を解決済みで読むためのビュー（無ければ作る）。
+    dedup / virtual の行は chunks.text が NULL になるので、NOT NULL 制約を外しておく。
+    後段（埋め込み・検索）は plaud.chunks ではなく plaud.chunks_with_text から text を読む。
+    virtual の行は substr で切り出すので、大量に読むときは文書ごとにまとめて切り出す方が速い
+    （make_embeddings_step3.fill_virtual_texts）。
+    """
+    cur.execute("""
+        ALTER TABLE plaud.chunks
+        ADD COLUMN IF NOT EXISTS chunker text,
+        ADD COLUMN IF NOT EXISTS chunker_params jsonb,
+        ADD COLUMN IF NOT EXISTS text_hash text;
+
+        ALTER TABLE plaud.chunks ALTER COLUMN text DROP NOT NULL;
+
+        CREATE INDEX IF NOT EXISTS chunks_text_hash_idx ON plaud.chunks (text_hash);
+
+        CREATE TABLE IF NOT EXISTS plaud.chunk_texts (
+            text_hash text PRIMARY KEY,
+            text      text NOT NULL
+        );
+
+        CREATE OR REPLACE VIEW plaud.chunks_with_text AS
+        SELECT c.id, c.raw_document_id, c.chunk_index, c.start_char, c.end_char,
+               c.chunker, c.chunker_params,
+               coalesce(c.text_hash, md5(c.text)) AS text_hash,
+               coalesce(c.text, t.text,
+                        substr(rd.raw_text, c.start_char + 1, c.end_char - c.start_char)) AS text
+        FROM plaud.chunks c
+        LEFT JOIN plaud.chunk_texts t ON t.text_hash = c.text_hash
+        LEFT JOIN plaud.raw_documents rd ON rd.id = c.raw_document_id;
+    """)
+
+def prune_chunk_texts(cur, hashes) -> int:
+    """
+    今回消した chunk の本文（hashes）のうち、どの chunk からも参照されなくなったものを消す。
+    chunk_texts 全体は見ない（text_hash のインデックスで1件ずつ確かめる）。
+    """
+    if not hashes:
+        return 0
+    cur.execute("""
+        DELETE FROM plaud.chunk_texts t
+        WHERE t.text_hash = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM plaud.chunks c WHERE c.text_hash = t.text_hash);
+    """, (list(hashes),))
+    return cur.rowcount
+
+def copy_escape(s: str) -> str:
+    """COPY の text 形式用エスケープ（\\ と タブ・改行）。"""
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def ensure_chunk_stage(cur):
+    """セッション内だけのステージング表（無ければ作る）。"""
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS chunks_stage (
+            raw_document_id bigint,
+            chunk_index     int,
+            start_char      int,
+            end_char        int,
+            text            text,
+            chunker         text,
+            chunker_params  jsonb,
+            text_hash       text
+        );
+    """)
+
+def copy_chunks(cur, rows, store: str = TEXT_STORE):
+    """
+    rows: iterable of (raw_document_id, chunk_index, start_char, end_char, text, chunker, chunker_params, text_hash)
+    chunker_params は JSON 文字列。COPY FROM STDIN でステージング表に流し込み、plaud.chunks へ1文でマージする。
+    store=dedup なら本文は plaud.chunk_texts に（既にある text_hash は使い回し）、chunks.text は NULL。
+    store=virtual なら本文はどこにも書かない（text_hash と位置だけ）。
+    戻り値: (挿入した chunk 数, 新しく増えた本文の数)
+    """
+    buf = io.StringIO()
+    n = 0
+    for doc_id, chunk_index, start_char, end_char, text, chunker, params, h in rows:
+        buf.write(f"{doc_id}\t{chunk_index}\t{start_char}\t{end_char}\t{copy_escape(text)}"
+                  f"\t{chunker}\t{copy_escape(params)}\t{h}\n")
+        n += 1
+    if n == 0:
+        return 0, 0
+    buf.seek(0)
+
+    ensure_chunk_stage(cur)
+    cur.copy_expert(f"COPY chunks_stage ({', '.join(CHUNK_COLUMNS)}) FROM STDIN", buf)
+    new_texts = 0 if store == "virtual" else n
+    if store == "dedup":
+        # --workers 同士で同じ本文を入れてもデッドロックしないよう text_hash 順に入れる
+        cur.execute("""
+            INSERT INTO plaud.chunk_texts (text_hash, text)
+            SELECT DISTINCT ON (text_hash) text_hash, text FROM chunks_stage
+            ORDER BY text_hash
+            ON CONFLICT (text_hash) DO NOTHING;
+        """)
+        new_texts = cur.rowcount
+    select = ", ".join("NULL" if store != "inline" and c == "text" else c for c in CHUNK_COLUMNS)
+    cur.execute(f"""
+        INSERT INTO plaud.chunks ({', '.join(CHUNK_COLUMNS)})
+        SELECT {select} FROM chunks_stage
+        ON CONFLICT (raw_document_id, chunk_index) DO NOTHING;
+        TRUNCATE chunks_stage;
+    """)
+    return n, new_texts
+
+def delete_chunks(cur, raw_document_ids=(), chunk_ids=()) -> set:
+    """作り直し対象の古い chunk をまとめて削除し、消した chunk の text_hash を返す（prune_chunk_texts 用）。"""
+    dropped = set()
+    if raw_document_ids:
+        cur.execute("DELETE FROM plaud.chunks WHERE raw_document_id = ANY(%s) RETURNING text_hash;",
+                    (list(raw_document_ids),))
+        dropped.update(r[0] for r in cur.fetchall() if r[0])
+    if chunk_ids:
+        cur.execute("DELETE FROM plaud.chunks WHERE id = ANY(%s) RETURNING text_hash;", (list(chunk_ids),))
+        dropped.update(r[0] for r in cur.fetchall() if r[0])
+    return dropped
+
+def load_old_chunks(cur, raw_document_ids) -> dict:
+    """
+    差分再分割用に、前回の chunk を文書ごとにまとめて読む（グループにつき1文）。
+    戻り値: {raw_document_id: ([(chunker, chunker_params), ...], [(chunk_id, text_hash, text), ...])}
+    chunker 列が無かった頃の行は、当時の固定長窓（FixedChunker の既定値）として扱う。
+    virtual の行は前回の本文が残っていない（raw_text はもう新しい内容）ので text=None。
+    diff_chunks はその場合 text_hash の一致だけで id を使い回す。
+    """
+    old = {}
+    if not raw_document_ids:
+        return old
+    legacy = (FixedChunker.name, FixedChunker().params)
+    # ビューは virtual の行を今の raw_text から切り出してしまうので、ここでは使わない
+    cur.execute("""
+        SELECT c.raw_document_id, c.id, c.chunker, c.chunker_params,
+               coalesce(c.text_hash, md5(c.text)), coalesce(c.text, t.text)
+        FROM plaud.chunks c
+        LEFT JOIN plaud.chunk_texts t ON t.text_hash = c.text_hash
+        WHERE c.raw_document_id = ANY(%s)
+        ORDER BY c.raw_document_id, c.chunk_index;
+    """, (list(raw_document_ids),))
+    for doc_id, chunk_id, chunker, params, h, text in cur:
+        specs, chunks = old.setdefault(doc_id, ([], []))
+        specs.append((chunker, params) if chunker else legacy)
+        chunks.append((chunk_id, h, text))
+    return old
+
+def apply_kept_chunks(cur, kept):
+    """
+    kept: [(chunk_id, chunk_index, start_char, end_char), ...]
+    残す chunk の位置を更新する。(raw_document_id, chunk_index) の UNIQUE とぶつからないよう、
+    いったん -1 - chunk_index に退避しておき、新しい chunk の挿入後に finalize_chunk_index で戻す。
+    """
+    if not kept:
+        return
+    execute_values(cur, """
+        UPDATE plaud.chunks AS c
+        SET chunk_index = -1 - v.chunk_index, start_char = v.start_char, end_char = v.end_char
+        FROM (VALUES %s) AS v(id, chunk_index, start_char, end_char)
+        WHERE c.id = v.id;
+    """, kept, page_size=len(kept))
+
+def finalize_chunk_index(cur, raw_document_ids):
+    if raw_document_ids:
+        cur.execute("""
+            UPDATE plaud.chunks SET chunk_index = -1 - chunk_index
+            WHERE raw_document_id = ANY(%s) AND chunk_index < 0;
+        """, (list(raw_document_ids),))
+
+def mark_chunked(cur, done):
+    """done: [(raw_document_id, content_hash), ...] の chunked_hash をまとめて更新する。"""
+    if not done:
+        return
+    execute_values(cur, """
+        UPDATE plaud.raw_documents AS rd
+        SET chunked_hash = v.content_hash
+        FROM (VALUES %s) AS v(id, content_hash)
+        WHERE rd.id = v.id;
+    """, done, page_size=len(done))
+
 # def ensure_chunked_hash_column(cur):
 #     cur.execute("""
 #         ALTER TABLE plaud.raw_documents
 #         ADD COLUMN IF NOT EXISTS chunked_hash text;
 #     """)
 
-def main():
-    inserted_total = 0
-    skipped_short = 0
-    rebuilt_docs = 0
+TARGET_DOCS_SQL = """
+    SELECT rd.id, rd.raw_text, rd.content_hash, rd.chunked_hash
+    FROM plaud.raw_documents rd
+    WHERE rd.raw_text IS NOT NULL
+    AND rd.content_hash IS NOT NULL
+    AND length(rd.raw_text) >= %(min_len)s
+    AND (%(rebuild)s OR rd.chunked_hash IS NULL OR rd.chunked_hash <> rd.content_hash)
+    AND (%(n_parts)s <= 1 OR rd.id %% %(n_parts)s = %(part)s)
+    AND rd.id > %(after_id)s
+    ORDER BY rd.id
+    LIMIT %(limit)s;
+"""
 
-    with connect_pg() as conn:
-        with conn.cursor() as cur:
-            # 1回だけ（無ければ追加）
-            # ensure_chunked_hash_column(cur)
-
-            # ✅ chunk未作成 or 内容更新（hash差分）を対象にする
-            cur.execute("""
-                SELECT rd.id, rd.raw_text, rd.content_hash, rd.chunked_hash
-                FROM plaud.raw_documents rd
-                WHERE rd.raw_text IS NOT NULL
-                AND rd.content_hash IS NOT NULL
-                AND length(rd.raw_text) >= %s
-                AND (rd.chunked_hash IS NULL OR rd.chunked_hash <> rd.content_hash)
-                ORDER BY rd.id;
-            """, (MIN_LEN,))
-            rows = cur.fetchall()
-
-            if not rows:
-                print("No raw_documents to (re)chunk. (already up to date)")
-                return
-
-            for raw_document_id, raw_text, content_hash, chunked_hash in rows:
-                if raw_text is None or len(raw_text) < MIN_LEN:
-                    skipped_short += 1
-                    continue
-
-                # ✅ 既にchunked_hashがある＝作り直し対象なので、古いchunkを削除
-                if chunked_hash is not None:
-                    cur.execute("DELETE FROM plaud.chunks WHERE raw_document_id = %s;", (raw_document_id,))
-                    rebuilt_docs += 1
+def iter_target_groups(conn, group_docs: int = GROUP_DOCS,
+                       part: int = 0, n_parts: int = 1, rebuild: bool = False):
+    """
+    chunk未作成 or 内容更新（hash差分）の文書を、id 順に group_docs 件ずつのリストにして yield する。
+    1グループごとに「前のグループの最後の id より後ろ」を LIMIT 付きで取り直すキーセットページングなので、
+    呼び出し側がグループごとに commit しても、残りの結果（raw_text）をサーバ側に抱え込まない。
+    クライアント側に載るのは常に group_docs 件だけ。
+    n_parts > 1 のときは id % n_parts = part の文書だけを対象にする（--workers 用）。
+    rebuild=True なら hash に関係なく全文書を対象にする（分割方式を変えたとき用）。
+    """
+    after_id = 0
+    while True:
+        with conn.cursor() as rcur:
+            rcur.execute(TARGET_DOCS_SQL, {"min_len": MIN_LEN, "part": part, "n_parts": n_parts,
+                                           "rebuild": rebuild, "after_id": after_id, "limit": group_docs})
+            group = rcur.fetchall()
+        if not group:
+            return
+        after_id = group[-1][0]
+        yield group
+        if len(group) < group_docs:
+            return
 
+def chunk_group(cur, rows, loader: str = LOADER, chunker=None, incremental: bool = INCREMENTAL) -> dict:
+    """
+    1グループ分の文書をチャンク化する（commit は呼び出し側）。
+    copy ローダでは、削除・挿入・chunked_hash 更新がそれぞれグループにつき1文になる。
+    chunker: chunkers.get_chunker() の戻り値（省略時は CHUNK_STRATEGY）。
+    incremental: 作り直し対象の文書は diff_chunks で差分だけ入れ替え、変わっていない chunk の id を残す
+                 （前回と分割方式・パラメータが違う文書は全部作り直す）。
+    stats["dropped_hashes"] は消した chunk の text_hash の集合（全ワーカーが終わってから prune_chunk_texts に渡す）。
+    """
+    if chunker is None:
+        chunker = get_chunker()
+    if loader != "copy":
+        return chunk_group_values(cur, rows, chunker)
+    params = json.dumps(chunker.params, sort_keys=True)
+    spec = (chunker.name, chunker.params)
+
+    stats = {"inserted": 0, "rebuilt_docs": 0, "skipped_short": 0, "kept_chunks": 0, "new_texts": 0}
+    targets = []
+    for raw_document_id, raw_text, content_hash, chunked_hash in rows:
+        if raw_text is None or len(raw_text) < MIN_LEN:
+            stats["skipped_short"] += 1
+            continue
+        targets.append((raw_document_id, raw_text, content_hash, chunked_hash))
+
+    # ✅ 既にchunked_hashがある＝作り直し対象
+    rebuilt = [t[0] for t in targets if t[3] is not None]
+    stats["rebuilt_docs"] = len(rebuilt)
+    old = load_old_chunks(cur, rebuilt) if incremental else {}
+
+    new_rows = []
+    kept = []
+    drop_ids = []
+    drop_docs = []
+    for raw_document_id, raw_text, _, _ in targets:
+        specs, old_chunks = old.get(raw_document_id, ([], []))
+        if old_chunks and all(x == spec for x in specs):
+            planned = diff_chunks(chunker, raw_text, old_chunks)
+            reused = {p[0] for p in planned if p[0] is not None}
+            drop_ids.extend(c[0] for c in old_chunks if c[0] not in reused)
+        else:
+            planned = [(None, *chunk[1:]) for chunk in chunker.chunk(raw_text)]
+            if raw_document_id in rebuilt:
+                drop_docs.append(raw_document_id)
+        for chunk_index, (chunk_id, start_char, end_char, chunk_text) in enumerate(planned):
+            if chunk_id is not None:
+                kept.append((chunk_id, chunk_index, start_char, end_char))
+            else:
+                new_rows.append((raw_document_id, chunk_index, start_char, end_char, chunk_text,
+                                 chunker.name, params, text_hash(chunk_text)))
+
+    # 古い chunk の削除 → 残す chunk の退避 → 新しい chunk の挿入 → 残した chunk の index を確定
+    stats["dropped_hashes"] = delete_chunks(cur, drop_docs, drop_ids)
+    apply_kept_chunks(cur, kept)
+    stats["kept_chunks"] = len(kept)
+    stats["inserted"], stats["new_texts"] = copy_chunks(cur, new_rows)
+    finalize_chunk_index(cur, rebuilt)
+
+    # ✅ chunk完了の印としてchunked_hashを更新
+    mark_chunked(cur, [(t[0], t[2]) for t in targets])
+    return stats
+
+def chunk_group_values(cur, rows, chunker) -> dict:
+    """
+    従来の1文書ずつの経路（CHUNK_LOADER=values）。差分再分割はせず、作り直し文書は全部入れ替える。
+    本文は常に chunks.text に持つ（CHUNK_TEXT_STORE は copy ローダのみ）。
+    """
+    params = json.dumps(chunker.params, sort_keys=True)
+    stats = {"inserted": 0, "rebuilt_docs": 0, "skipped_short": 0, "dropped_hashes": set()}
+
+    for raw_document_id, raw_text, content_hash, chunked_hash in rows:
+        if raw_text is None or len(raw_text) < MIN_LEN:
+            stats["skipped_short"] += 1
+            continue
+
+        # ✅ 既にchunked_hashがある＝作り直し対象なので、古いchunkを削除
+        if chunked_hash is not None:
+            stats["dropped_hashes"] |= delete_chunks(cur, [raw_document_id])
+            stats["rebuilt_docs"] += 1
+
+        to_insert = []
+        for chunk_index, start_char, end_char, chunk_text in chunker.chunk(raw_text):
+            to_insert.append((raw_document_id, chunk_index, start_char, end_char, chunk_text,
+                              chunker.name, params, text_hash(chunk_text)))
+
+            if len(to_insert) >= BATCH:
+                stats["inserted"] += bulk_insert(cur, to_insert)
                 to_insert = []
-                for chunk_index, start_char, end_char, chunk_text in iter_chunks(raw_text, CHUNK_SIZE, CHUNK_STRIDE):
-                    to_insert.append((raw_document_id, chunk_index, start_char, end_char, chunk_text))
 
-                    if len(to_insert) >= BATCH:
-                        inserted_total += bulk_insert(cur, to_insert)
-                        to_insert = []
+        if to_insert:
+            stats["inserted"] += bulk_insert(cur, to_insert)
+
+        # ✅ chunk完了の印としてchunked_hashを更新
+        cur.execute(
+            "UPDATE plaud.raw_documents SET chunked_hash = %s WHERE id = %s;",
+            (content_hash, raw_document_id)
+        )
 
-                if to_insert:
-                    inserted_total += bulk_insert(cur, to_insert)
+    return stats
 
-                # ✅ chunk完了の印としてchunked_hashを更新
-                cur.execute(
-                    "UPDATE plaud.raw_documents SET chunked_hash = %s WHERE id = %s;",
-                    (content_hash, raw_document_id)
-                )
+def run_partition(part: int = 0, n_parts: int = 1, strategy: str = CHUNK_STRATEGY, rebuild: bool = False,
+                  incremental: bool = INCREMENTAL):
+    """
+    1パーティション分を自前の接続で処理する。グループごとに commit し、
+    完了した文書は chunked_hash で印が付くので、途中で落ちても再実行で続きからやり直せる。
+    chunker（トークナイザ込み）はプロセスごとに1回だけ作る。
+    戻り値: (totals, groups, 消した chunk の text_hash の集合)
+    """
+    chunker = get_chunker(strategy)
+    totals = {"inserted": 0, "rebuilt_docs": 0, "skipped_short": 0, "kept_chunks": 0, "new_texts": 0}
+    groups = 0
+    dropped = set()
+
+    with connect_pg() as conn:
+        # 1回だけ（無ければ追加）
+        # with conn.cursor() as cur:
+        #     ensure_chunked_hash_column(cur)
+
+        for rows in iter_target_groups(conn, part=part, n_parts=n_parts, rebuild=rebuild):
+            with conn.cursor() as cur:
+                stats = chunk_group(cur, rows, chunker=chunker, incremental=incremental)
+            # ✅ グループごとに確定（途中で落ちても完了分は残り、次回は chunked_hash で飛ばされる）
+            conn.commit()
+            groups += 1
+            dropped |= stats.pop("dropped_hashes")
+            for k, v in stats.items():
+                totals[k] = totals.get(k, 0) + v
 
         conn.commit()
 
+    return totals, groups, dropped
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="plaud.raw_documents -> plaud.chunks")
+    ap.add_argument("--workers", type=int, default=int(os.getenv("CHUNK_WORKERS", "1")),
+                    help="並列プロセス数（raw_documents.id の剰余で分割、1プロセス1接続）")
+    ap.add_argument("--strategy", default=CHUNK_STRATEGY, choices=sorted(CHUNKERS),
+                    help="分割方式（fixed: 1000文字窓 / sentence: 文境界で埋め込みモデルのトークン上限まで詰める）")
+    ap.add_argument("--rebuild", action="store_true",
+                    help="hash が変わっていない文書も含めて全部作り直す（分割方式を変えたとき）")
+    ap.add_argument("--incremental", action=argparse.BooleanOptionalAction, default=INCREMENTAL,
+                    help="内容が変わった文書は変わっていない chunk を残して差分だけ作り直す（既定: 有効、CHUNK_INCREMENTAL）")
+    return ap.parse_args()
+
+def main():
+    args = parse_args()
+
+    # 列追加はワーカーを立てる前に1回だけ
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            ensure_chunk_columns(cur)
+
+    if args.workers <= 1:
+        results = [run_partition(strategy=args.strategy, rebuild=args.rebuild, incremental=args.incremental)]
+    else:
+        n = args.workers
+        with ProcessPoolExecutor(max_workers=n) as ex:
+            results = list(ex.map(run_partition, range(n), [n] * n, [args.strategy] * n, [args.rebuild] * n,
+                                  [args.incremental] * n))
+
+    totals = {"inserted": 0, "rebuilt_docs": 0, "skipped_short": 0, "kept_chunks": 0, "new_texts": 0}
+    groups = 0
+    dropped = set()
+    for t, g, d in results:
+        groups += g
+        dropped |= d
+        for k, v in t.items():
+            totals[k] = totals.get(k, 0) + v
+
+    if groups == 0:
+        print("No raw_documents to (re)chunk. (already up to date)")
+        return
+
+    # 作り直しで参照されなくなった本文を片付ける（ワーカーが全部終わってから、今回消した分だけ1回）
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            pruned = prune_chunk_texts(cur, dropped)
+
     print(
-        f"Inserted chunks: {inserted_total} "
-        f"(rebuilt_docs: {rebuilt_docs}, skipped_short_docs: {skipped_short})"
+        f"Inserted chunks: {totals['inserted']} "
+        f"(rebuilt_docs: {totals['rebuilt_docs']}, kept_chunks: {totals['kept_chunks']}, "
+        f"skipped_short_docs: {totals['skipped_short']}, "
+        f"groups: {groups}, workers: {max(args.workers, 1)}, strategy: {args.strategy})"
     )
+    if LOADER == "copy" and TEXT_STORE == "dedup" and totals["inserted"]:
+        ratio = 1 - totals["new_texts"] / totals["inserted"]
+        print(f"Chunk texts: {totals['new_texts']} new for {totals['inserted']} chunks "
+              f"(dedup ratio: {ratio:.1%}, pruned: {pruned})")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,13 +1,29 @@
 import os
 import json
 import math
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 
 import psycopg2
-from psycopg2.extras import execute_values
+import numpy as np
 from dotenv import load_dotenv
 
-from sentence_transformers import SentenceTransformer
+# sentence-transformers / torch は import だけで重いので、モデルを読み込むときに関数内で import する
+# （embed_server が動いていれば step3 では読み込まない）
+
+from chunkers import text_hash
+from embedding_store import STORAGE, check_storage, ensure_storage_column, copy_embeddings
+from embedding_cache import CACHE, open_cache
+from embed_server import SERVER_URL, connect_server
+# モデル名・backend・読み込みは DB を使わない embed_model に置く（embed_server も同じものを使う）
+from embed_model import (MODEL_NAME, BACKEND, BACKENDS, ONNX_QUANT, ONNX_DIR,
+                         backend_params, load_model, make_token_counter)
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -26,9 +42,20 @@ PG_HOST = os.getenv("PG_HOST", "localhost")
 PG_PORT = int(os.getenv("PG_PORT", "5433"))
 
 # ===== 設定（まずはこれで十分）=====
-MODEL_NAME = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
 BATCH = int(os.getenv("EMBED_BATCH", "64"))       # CPUなら 32〜128 あたり
 MAX_CHUNKS = int(os.getenv("EMBED_MAX", "0"))     # 0なら制限なし（テスト時は100など）
+VIRTUAL_DOC_BATCH = 100                           # virtual chunk の本文を切り出すとき、1回に読む raw_documents 数
+READ_PAGE = int(os.getenv("EMBED_READ_PAGE", "4096"))  # 未埋め込みの chunk を id 順にこの件数ずつ読み、ページ内で同じ本文をまとめる
+QUEUE_DEPTH = int(os.getenv("EMBED_QUEUE", "4"))  # 読み出し・書き込みと encode の間に溜めるバッチ数
+COMMIT_EVERY = int(os.getenv("EMBED_COMMIT_EVERY", "2000"))  # この chunk 数ごとに commit（途中で落ちても続きから）
+PROCESSES = int(os.getenv("EMBED_PROCESSES", "1"))           # 2以上なら encode をプロセスプールで並列に
+THREADS = int(os.getenv("EMBED_THREADS", str(os.cpu_count() or 1)))  # 全プロセス合計の torch スレッド数
+# バッチの組み方。tokens: 未処理の本文を EMBED_SORT_WINDOW 件ずつトークン長で並べ替え、
+# 「最長トークン数 × 件数」が EMBED_TOKEN_BUDGET に収まるように詰める（padding を減らす）
+# chars: トークン数の代わりに文字数で並べる / off: 読み出した順に EMBED_BATCH 件ずつ（従来）
+BUCKET = os.getenv("EMBED_BUCKET", "tokens")
+SORT_WINDOW = int(os.getenv("EMBED_SORT_WINDOW", "1024"))
+TOKEN_BUDGET = int(os.getenv("EMBED_TOKEN_BUDGET", str(BATCH * 128)))
 
 def connect_pg():
     return psycopg2.connect(
@@ -51,81 +78,504 @@ def create_run(cur, model_name: str, dim: int, params: dict) -> int:
     )
     return cur.fetchone()[0]
 
-def fetch_target_chunks(cur, run_id: int):
-    # まだembeddingが無いchunkだけを対象にする
+def find_run(cur, model_name: str, dim: int, params: dict):
+    """
+    同じ (model_name, dim, params_json) の run のうち最新のものを返す（無ければ None）。
+    以前の run は params_json に batch_size を持っているが、ベクトルには影響しないので比較から外す。
+    backend が無い run は torch で作ったものとして比べる（別の backend のベクトルとは混ぜない）。
+    storage が無い run は array（real[]）で保存したものとして比べる。
+    """
     cur.execute(
         """
-        SELECT c.id, c.text
-        FROM plaud.chunks c
-        LEFT JOIN plaud.chunk_embeddings e
-          ON e.chunk_id = c.id AND e.run_id = %s
-        WHERE e.chunk_id IS NULL
-        ORDER BY c.id;
+        SELECT id
+        FROM plaud.embedding_runs
+        WHERE model_name = %s AND dim = %s
+          AND (params_json - 'batch_size')
+              || jsonb_build_object('backend', coalesce(params_json->>'backend', 'torch'),
+                                    'storage', coalesce(params_json->>'storage', 'array')) = %s::jsonb
+        ORDER BY id DESC
+        LIMIT 1;
         """,
-        (run_id,)
+        (model_name, dim, json.dumps(params)),
     )
-    return cur.fetchall()
+    row = cur.fetchone()
+    return row[0] if row else None
 
-def insert_embeddings(cur, run_id: int, rows):
-    sql = """
-        INSERT INTO plaud.chunk_embeddings (run_id, chunk_id, embedding)
-        VALUES %s
-        ON CONFLICT (run_id, chunk_id) DO NOTHING;
+def get_or_create_run(cur, model_name: str, dim: int, params: dict, new_run: bool = False):
+    """
+    戻り値: (run_id, created)
+    既存の run を使い回すので、再実行では未埋め込みの chunk（新しく増えた分）だけが対象になる。
+    new_run=True なら必ず新しい run を作る（意図的に全件作り直すとき）。
     """
-    execute_values(cur, sql, rows, page_size=500)
+    # 同時に2本走っても同じ run が2つできないよう、run の検索・作成を直列化する
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('plaud.embedding_runs'));")
+    if not new_run:
+        run_id = find_run(cur, model_name, dim, params)
+        if run_id is not None:
+            return run_id, False
+    return create_run(cur, model_name, dim, params), True
 
-def main():
-    # CPUでOK。device指定なしで大丈夫（勝手にcpu）
-    model = SentenceTransformer(MODEL_NAME)
-    dim = model.get_sentence_embedding_dimension()
+# まだembeddingが無いchunkを id 順に読む（キーセットページング）。chunks の主キー順に流して
+# chunk_embeddings の主キーで1件ずつ突き合わせるので、全件を集計・並べ替えしないまま最初のページが返る
+# 本文は chunks.text（inline）か chunk_texts（dedup）。virtual の行は text=NULL で返し、
+# fill_virtual_texts で文書ごとにまとめて切り出す（chunk ごとの substr だと raw_text を何度も展開するため）
+TARGET_CHUNKS_SQL = """
+    SELECT c.id,
+           coalesce(c.text_hash, md5(c.text)) AS text_hash,
+           coalesce(c.text, t.text) AS text,
+           c.raw_document_id, c.start_char, c.end_char
+    FROM plaud.chunks c
+    LEFT JOIN plaud.chunk_texts t ON t.text_hash = c.text_hash
+    WHERE c.id > %(after_id)s
+      AND NOT EXISTS (
+        SELECT 1 FROM plaud.chunk_embeddings e
+        WHERE e.run_id = %(run_id)s AND e.chunk_id = c.id
+      )
+    ORDER BY c.id
+    LIMIT %(limit)s;
+"""
 
-    params = {
-        "normalize_embeddings": True,   # 距離が扱いやすくなるので最初はTrue推奨
-        "batch_size": BATCH,
-    }
+def group_by_text(chunks):
+    """
+    chunks: TARGET_CHUNKS_SQL の結果 (id, text_hash, text, raw_document_id, start_char, end_char)
+    同じ本文（text_hash）の chunk を最初の chunk の位置に1行にまとめる（1回だけ encode するため）。
+    戻り値: [(text_hash, [chunk_id, ...], text, raw_document_id, start_char, end_char), ...]
+    """
+    rows = {}
+    for chunk_id, h, text, doc_id, start_char, end_char in chunks:
+        row = rows.get(h)
+        if row is None:
+            rows[h] = (h, [chunk_id], text, doc_id, start_char, end_char)
+        else:
+            row[1].append(chunk_id)
+    return list(rows.values())
 
-    with connect_pg() as conn:
-        with conn.cursor() as cur:
-            run_id = create_run(cur, MODEL_NAME, dim, params)
+def iter_target_batches(conn, run_id: int, batch_size: int = BATCH, limit: int = MAX_CHUNKS,
+                        page_size: int = READ_PAGE):
+    """
+    未埋め込みの chunk を id 順に page_size 件ずつ読み（前のページの最後の id から取り直す）、
+    ページ内で同じ本文をまとめて batch_size 本文ずつ [(text, [chunk_id, ...]), ...] にして yield する。
+    ページをまたいだ同じ本文はもう一度 encode に回る（埋め込みキャッシュが有効なら、書き込み済みの分はそこで拾う）。
+    limit > 0 なら本文数で打ち切る（テスト用）。
+    """
+    after_id = 0
+    sent = 0
+    with conn.cursor() as cur:
+        while True:
+            cur.execute(TARGET_CHUNKS_SQL, {"run_id": run_id, "after_id": after_id, "limit": page_size})
+            chunks = cur.fetchall()
+            if not chunks:
+                return
+            after_id = chunks[-1][0]
+            rows = group_by_text(chunks)
+            if limit > 0:
+                rows = rows[:limit - sent]
+            for i in range(0, len(rows), batch_size):
+                batch = fill_virtual_texts(cur, rows[i:i + batch_size])
+                if batch:
+                    yield batch
+            sent += len(rows)
+            if len(chunks) < page_size or (limit > 0 and sent >= limit):
+                return
 
-            targets = fetch_target_chunks(cur, run_id)
-            if MAX_CHUNKS > 0:
-                targets = targets[:MAX_CHUNKS]
+def fill_virtual_texts(cur, rows):
+    """
+    rows: group_by_text の結果 (text_hash, chunk_ids, text, raw_document_id, start_char, end_char)
+    本文を持たない行は、raw_text を VIRTUAL_DOC_BATCH 文書ずつ1回だけ読んで切り出す。
+    切り出した本文の md5 が text_hash と合わない行（step1 で raw_text が変わり、step2 がまだ分割し直していない）は
+    別の本文を埋め込んでしまうので飛ばす。埋め込まれないまま残り、step2 の後の実行で拾われる。
+    戻り値: [(text, [chunk_id, ...]), ...]
+    """
+    by_doc = {}
+    for i, (_, _, text, doc_id, _, _) in enumerate(rows):
+        if text is None:
+            by_doc.setdefault(doc_id, []).append(i)
+
+    texts = [r[2] for r in rows]
+    doc_ids = list(by_doc)
+    for i in range(0, len(doc_ids), VIRTUAL_DOC_BATCH):
+        cur.execute(
+            "SELECT id, raw_text FROM plaud.raw_documents WHERE id = ANY(%s);",
+            (doc_ids[i:i + VIRTUAL_DOC_BATCH],)
+        )
+        for doc_id, raw_text in cur.fetchall():
+            for j in by_doc[doc_id]:
+                start_char, end_char = rows[j][4], rows[j][5]
+                texts[j] = (raw_text or "")[start_char:end_char]
+
+    out = []
+    stale = 0
+    for r, t in zip(rows, texts):
+        if r[2] is None and (t is None or text_hash(t) != r[0]):
+            stale += 1
+            continue
+        out.append((t or "", r[1]))
+    if stale:
+        print(f"virtual: skipped {stale} stale texts (raw_text changed; run step2 first)", flush=True)
+    return out
+
+# --------------------
+# Pipeline（読み出し → encode → 書き込み を重ねる）
+# --------------------
+class Stage:
+    """1段ぶんの処理件数と、実際に手を動かしていた時間（待ち時間を除く）。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+
+    def report(self) -> str:
+        rate = self.items / self.busy if self.busy > 0 else 0.0
+        return f"{self.name}={self.items} in {self.busy:.1f}s ({rate:.0f}/s)"
+
+_DONE = object()
+
+def q_put(q, item, stop: threading.Event) -> bool:
+    """満杯なら待つ。他の段が落ちたら（stop）諦めて False。"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def q_get(q, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _DONE
+
+def reader_loop(run_id: int, out_q, stop, stage: Stage, errors: list, cache=None, write_q=None):
+    """
+    対象の本文をバッチにして out_q に流す（自前の接続・id 順のキーセットページング）。
+    cache があればここでまとめて引き、当たった本文は encode を通さずに write_q（writer）へ直接回す。
+    """
+    try:
+        with connect_pg() as conn:
+            it = iter_target_batches(conn, run_id)
+            while True:
+                t0 = time.perf_counter()
+                batch = next(it, None)
+                if batch is None:
+                    stage.busy += time.perf_counter() - t0
+                    break
+                hits = []
+                if cache is not None:
+                    found = cache.lookup([t for t, _ in batch])
+                    hits = [(item, v) for item, v in zip(batch, found) if v is not None]
+                    batch = [item for item, v in zip(batch, found) if v is None]
+                stage.busy += time.perf_counter() - t0
+                stage.items += len(hits) + len(batch)
+                if hits and not q_put(write_q, ([item for item, _ in hits], np.stack([v for _, v in hits]), False),
+                                      stop):
+                    break
+                if batch and not q_put(out_q, batch, stop):
+                    break
+            it.close()
+            conn.rollback()
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        q_put(out_q, _DONE, stop)
+
+def writer_loop(run_id: int, in_q, stop, stage: Stage, errors: list, commit_every: int, storage: str,
+                cache=None):
+    """
+    encode 済みのバッチを書き込み、commit_every chunk ごとに commit する（チェックポイント）。
+    run は使い回されるので、途中で落ちても再実行で未埋め込みの分から続く。
+    書き込みは numpy のままバイナリ COPY（embedding_store.copy_embeddings、列は storage で決まる）。
+    in_q の要素は (batch, vecs, encoded)。cache があれば encode した分（encoded=True）をここでキャッシュに足す。
+    """
+    try:
+        with connect_pg() as conn:
+            with conn.cursor() as cur:
+                since_commit = 0
+                while True:
+                    item = q_get(in_q, stop)
+                    if item is _DONE:
+                        break
+                    batch, vecs, encoded = item
+                    t0 = time.perf_counter()
+                    # 同じ本文の chunk には同じベクトルを（行を複製して）入れる
+                    chunk_ids = [c for _, ids in batch for c in ids]
+                    rows = np.repeat(np.asarray(vecs, dtype=np.float32), [len(ids) for _, ids in batch], axis=0)
+                    n = copy_embeddings(cur, run_id, chunk_ids, rows, storage)
+                    if cache is not None and encoded:
+                        cache.put([t for t, _ in batch], vecs)
+                    stage.items += n
+                    since_commit += n
+                    if since_commit >= commit_every:
+                        conn.commit()
+                        since_commit = 0
+                        print(f"checkpoint: {stage.items} chunks committed", flush=True)
+                    stage.busy += time.perf_counter() - t0
+            conn.commit()
+    except Exception as e:
+        errors.append(e)
+        stop.set()
 
-            total = len(targets)
-            if total == 0:
-                print("No chunks to embed.")
-                conn.commit()
+def bucket_batches(batches, count_tokens, token_budget: int = TOKEN_BUDGET, window: int = SORT_WINDOW):
+    """
+    batches を window 本文ずつ溜めて長さ順（長い方から）に並べ、
+    「バッチ内の最長トークン数 × 件数」が token_budget を超えないところで切り直す。
+    長さの近い本文が同じバッチに入るので padding がほとんど無くなり、短い本文はまとめて大きなバッチになる。
+    chunk_id は本文と一緒に運ぶので、並べ替えても書き込み先は変わらない。
+    count_tokens: list[str] -> list[int]
+    """
+    buf = []
+    for batch in batches:
+        buf.extend(batch)
+        if len(buf) >= window:
+            yield from _cut_by_budget(buf, count_tokens, token_budget)
+            buf = []
+    if buf:
+        yield from _cut_by_budget(buf, count_tokens, token_budget)
+
+def _cut_by_budget(items, count_tokens, token_budget: int):
+    lens = count_tokens([text for text, _ in items])
+    order = sorted(range(len(items)), key=lambda i: -lens[i])
+    out = []
+    longest = 0
+    for i in order:
+        n = max(lens[i], 1)
+        if out and max(longest, n) * (len(out) + 1) > token_budget:
+            yield out
+            out = []
+            longest = 0
+        out.append(items[i])
+        longest = max(longest, n)
+    if out:
+        yield out
+
+def run_pipeline(run_id: int, encode_stream, queue_depth: int = QUEUE_DEPTH, commit_every: int = COMMIT_EVERY,
+                 count_tokens=None, storage: str = STORAGE, cache=None):
+    """
+    reader スレッド → [キュー] → encode（このスレッド）→ [キュー] → writer スレッド。
+    メモリに載るのはキューの深さ × バッチ分だけで、コーパスの大きさに依存しない。
+    encode_stream: バッチの iterable を受け取り、(batch, vecs) を入力と同じ順に yield する
+                   （serial_stream(encode) か PoolEncoder.stream）
+    count_tokens: 指定があれば encode の前に bucket_batches で長さ順に組み直す
+    cache: 指定があれば reader スレッドが読み出したバッチをまとめて引き、当たった本文は encode せずに writer へ回す。
+           encode した本文は writer スレッドがキャッシュに足す（embedding_cache。encode 段では触らない）
+    戻り値: (reader, encoder, writer) の Stage
+    """
+    in_q = queue.Queue(maxsize=queue_depth)
+    out_q = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    errors = []
+    reader = Stage("read_texts")
+    encoder = Stage("encode_texts")
+    writer = Stage("write_chunks")
+
+    threads = [
+        threading.Thread(target=reader_loop, args=(run_id, in_q, stop, reader, errors, cache, out_q), daemon=True),
+        threading.Thread(target=writer_loop, args=(run_id, out_q, stop, writer, errors, commit_every, storage, cache),
+                         daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    waited = [0.0]
+
+    def batches():
+        while True:
+            t0 = time.perf_counter()
+            batch = q_get(in_q, stop)
+            waited[0] += time.perf_counter() - t0
+            if batch is _DONE:
                 return
+            yield batch
+
+    # encode 段の busy は、前後のキュー待ちを除いた時間
+    t_start = time.perf_counter()
+    source = batches() if count_tokens is None else bucket_batches(batches(), count_tokens)
+    try:
+        for batch, vecs in encode_stream(source):
+            encoder.items += len(batch)
+            t0 = time.perf_counter()
+            ok = q_put(out_q, (batch, vecs, True), stop)
+            waited[0] += time.perf_counter() - t0
+            if not ok:
+                break
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        encoder.busy = time.perf_counter() - t_start - waited[0]
+        q_put(out_q, _DONE, stop)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return reader, encoder, writer
+
+# --------------------
+# Encoders
+# --------------------
+def serial_stream(encode):
+    """このプロセスで1バッチずつ encode する（既定）。"""
+    def stream(batches):
+        for batch in batches:
+            yield batch, encode([text for text, _ in batch])
+    return stream
+
+_worker_model = None
+
+def _init_worker(model_name: str, backend: str, threads: int):
+    """ワーカーごとに1回だけ：スレッド数を絞ってモデルを読み込む。"""
+    global _worker_model
+    import torch
+    torch.set_num_threads(threads)
+    _worker_model = load_model(model_name, backend, threads=threads if backend != "torch" else 0)
+
+def _worker_info():
+    return _worker_model.get_sentence_embedding_dimension(), _worker_model.max_seq_length
+
+def _worker_encode(texts, normalize: bool):
+    return _worker_model.encode(
+        texts,
+        batch_size=len(texts),
+        show_progress_bar=False,
+        normalize_embeddings=normalize,
+    )
+
+class PoolEncoder:
+    """
+    encode を processes 個のワーカープロセスに分ける（--processes N）。
+    - モデルはワーカーごとに1回だけ読み込み、torch のスレッド数は合計 threads を等分する
+    - バッチは投げた順に結果を返す（writer には元の並びのまま渡る）
+    - 同時に投げておくのは processes * 2 バッチまで（メモリはコーパスに依存しない）
+    読み出し・書き込みスレッドが動いている中で fork しないよう、spawn でワーカーを起こす。
+    """
 
-            print(f"run_id={run_id} model={MODEL_NAME} dim={dim} targets={total}")
+    def __init__(self, processes: int, model_name: str = MODEL_NAME, threads: int = THREADS,
+                 normalize: bool = True, backend: str = BACKEND):
+        self.processes = processes
+        self.normalize = normalize
+        self.pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_name, backend, max(1, threads // processes)),
+        )
+        # 全ワーカーをここで起こしてモデルを読み込ませる（最初のバッチで待たされないように）
+        infos = [f.result() for f in [self.pool.submit(_worker_info) for _ in range(processes)]]
+        self.dim, self.max_seq_length = infos[0]
 
-            # バッチで回す
-            inserted = 0
-            for i in range(0, total, BATCH):
-                batch = targets[i:i+BATCH]
-                chunk_ids = [r[0] for r in batch]
-                texts = [r[1] or "" for r in batch]
+    def stream(self, batches):
+        pending = deque()
+        for batch in batches:
+            texts = [text for text, _ in batch]
+            pending.append((batch, self.pool.submit(_worker_encode, texts, self.normalize)))
+            if len(pending) >= self.processes * 2:
+                b, fut = pending.popleft()
+                yield b, fut.result()
+        while pending:
+            b, fut = pending.popleft()
+            yield b, fut.result()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="plaud.chunks -> plaud.chunk_embeddings")
+    ap.add_argument("--new-run", action="store_true",
+                    help="同じモデル・パラメータの run があっても新しい run を作って全件埋め込み直す")
+    ap.add_argument("--processes", type=int, default=PROCESSES,
+                    help="encode のワーカープロセス数（モデルはプロセスごとに1回読み込み、"
+                         "torch スレッドは EMBED_THREADS を等分）")
+    return ap.parse_args()
+
+def main():
+    args = parse_args()
 
-                vecs = model.encode(
-                    texts,
-                    batch_size=BATCH,
-                    show_progress_bar=False,
-                    normalize_embeddings=params["normalize_embeddings"],
-                )
+    # run の同一性はこの params で決まる（ベクトルに影響するものだけを入れる。batch_size は入れない）
+    params = {
+        "normalize_embeddings": True,   # 距離が扱いやすくなるので最初はTrue推奨
+        **backend_params(),             # backend が違うベクトルは別の run にする
+        "storage": STORAGE,             # 保存列・精度が違うので別の run にする（f16 / halfvec は丸めが入る）
+    }
+    check_storage(STORAGE)
 
-                rows = []
-                for chunk_id, v in zip(chunk_ids, vecs):
-                    # numpy array -> python list（psycopg2がreal[]として入れてくれる）
-                    rows.append((run_id, chunk_id, list(map(float, v))))
+    pool = None
+    # 同じモデル・backend の embed_server が動いていれば、モデルを読み込まずにそちらで encode する
+    server = connect_server(MODEL_NAME, backend_params())
+    if server is not None:
+        dim = server.info["dim"]
+        if BUCKET == "tokens":
+            count_tokens = server.count_tokens
+        else:
+            count_tokens = make_token_counter(BUCKET, None, server.info["max_seq_length"])
+        encode_stream = serial_stream(lambda texts: server.encode(texts, params["normalize_embeddings"]))
+    elif args.processes > 1:
+        pool = PoolEncoder(args.processes, normalize=params["normalize_embeddings"])
+        dim = pool.dim
+        encode_stream = pool.stream
+        # 長さを数えるためだけに、このプロセスではトークナイザだけ読む
+        tokenizer = None
+        if BUCKET == "tokens":
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        count_tokens = make_token_counter(BUCKET, tokenizer, pool.max_seq_length)
+    else:
+        model = load_model()
+        dim = model.get_sentence_embedding_dimension()
+        count_tokens = make_token_counter(BUCKET, model.tokenizer, model.max_seq_length)
 
-                insert_embeddings(cur, run_id, rows)
-                inserted += len(rows)
-                print(f"embedded {min(i+BATCH, total)}/{total}")
+        # 渡されたバッチをそのまま1回の forward にする（組み方は bucket_batches が決める）
+        def encode(texts):
+            return model.encode(
+                texts,
+                batch_size=len(texts),
+                show_progress_bar=False,
+                normalize_embeddings=params["normalize_embeddings"],
+            )
+        encode_stream = serial_stream(encode)
 
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            ensure_storage_column(cur, STORAGE)
+            run_id, created = get_or_create_run(cur, MODEL_NAME, dim, params, new_run=args.new_run)
+        # writer は別の接続なので、run を先に確定させておく
         conn.commit()
+    encoder_desc = f"server={SERVER_URL}" if server is not None else f"processes={max(args.processes, 1)}"
+    print(f"run_id={run_id} ({'new' if created else 'reused'}) model={MODEL_NAME} dim={dim} "
+          f"backend={BACKEND} storage={STORAGE} {encoder_desc}")
+
+    # キャッシュのキーは run と同じ params（storage を除く）。別の run・作り直した chunk でも同じ本文なら当たる
+    cache = open_cache(CACHE, connect_pg, MODEL_NAME, params, dim)
+
+    t0 = time.perf_counter()
+    try:
+        reader, encoder, writer = run_pipeline(run_id, encode_stream, count_tokens=count_tokens, cache=cache)
+    finally:
+        if pool is not None:
+            pool.close()
+        if server is not None:
+            server.close()
+        if cache is not None:
+            cache.close()
+    elapsed = time.perf_counter() - t0
+
+    if writer.items == 0:
+        print("No chunks to embed.")
+        return
 
-    print(f"DONE. inserted={inserted} run_id={run_id}")
+    texts, encoded, total = reader.items, encoder.items, writer.items
+    # 重複・キャッシュ済みの分は encode していないので、1本文あたりの encode 時間 × その数を節約できた時間とみなす
+    saved = encoder.busy / encoded * (total - encoded) if encoded else 0.0
+    print(f"DONE. inserted={total} run_id={run_id} "
+          f"dedup_ratio={1 - texts / total:.1%} encoded={encoded} encode={encoder.busy:.1f}s saved~{saved:.1f}s")
+    if cache is not None:
+        print(cache.report())
+    print(f"throughput: {total / elapsed:.0f} chunks/s in {elapsed:.1f}s; "
+          f"{reader.report()}, {encoder.report()}, {writer.report()}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
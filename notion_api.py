@@ -0,0 +1,207 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+NOTION_BASE_URL = "https://api.notion.com/v1"
+NOTION_VERSION = "2022-06-28"
+
+# Notion の公式上限は平均 3 req/s（統合ごと）
+DEFAULT_RPS = float(os.getenv("NOTION_RPS", "3"))
+DEFAULT_WORKERS = int(os.getenv("NOTION_WORKERS", "4"))
+MAX_RETRIES = int(os.getenv("NOTION_MAX_RETRIES", "5"))
+BACKOFF_BASE = 0.5    # 秒。5xx / 通信エラー時の指数バックオフの起点
+BACKOFF_CAP = 30.0
+
+
+class TokenBucket:
+    """
+    スレッド安全なトークンバケット。
+    acquire() は予約制：トークンを先に引いてから不足分だけ眠るので、
+    何スレッドから呼んでも平均レートは rate を超えない。
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1.0
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class NotionClient:
+    """
+    Notion API 共通クライアント。
+    - requests.Session で TCP/TLS 接続を使い回す
+    - TokenBucket で全スレッド合計のリクエストレートを制限
+    - 429 は Retry-After を守って再試行、5xx / 通信エラーはジッター付き指数バックオフ
+    base_url を差し替えればローカルのスタブサーバに向けられる（bench_notion_client.py）。
+    """
+
+    def __init__(self, token: str, base_url: str = NOTION_BASE_URL,
+                 rps: float = DEFAULT_RPS, max_workers: int = DEFAULT_WORKERS,
+                 max_retries: int = MAX_RETRIES, timeout: int = 30):
+        self.base_url = base_url.rstrip("/")
+        self.bucket = TokenBucket(rps)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.retries = 0      # 統計用：再試行した回数（map_concurrent の各スレッドから足すので lock の中で）
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(max_workers, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Notion-Version": NOTION_VERSION,
+            "Content-Type": "application/json",
+        })
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _count_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                self._count_retry()
+                time.sleep(self._backoff(attempt))
+                continue
+
+            if r.status_code == 429 and attempt < self.max_retries:
+                self._count_retry()
+                try:
+                    wait = float(r.headers.get("Retry-After", "1"))
+                except ValueError:
+                    wait = 1.0
+                time.sleep(wait)
+                continue
+            if r.status_code >= 500 and attempt < self.max_retries:
+                self._count_retry()
+                time.sleep(self._backoff(attempt))
+                continue
+
+            r.raise_for_status()
+            return r.json()
+
+    def get(self, path: str, **kwargs) -> dict:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, payload: dict = None, **kwargs) -> dict:
+        return self.request("POST", path, json=payload or {}, **kwargs)
+
+    # ---------- Notion endpoints ----------
+
+    def query_database(self, database_id: str, payload: dict = None) -> dict:
+        return self.post(f"databases/{database_id}/query", payload)
+
+    def iter_database(self, database_id: str, payload: dict = None):
+        """next_cursor / has_more を最後まで辿って results を yield する。"""
+        body = dict(payload or {})
+        body.setdefault("page_size", 100)
+        while True:
+            data = self.query_database(database_id, body)
+            for p in data.get("results", []):
+                yield p
+            if not data.get("has_more"):
+                break
+            body["start_cursor"] = data.get("next_cursor")
+
+    def retrieve_page(self, page_id: str) -> dict:
+        return self.get(f"pages/{page_id}")
+
+    def block_children(self, block_id: str, start_cursor: str = None, page_size: int = 100) -> dict:
+        params = {"page_size": page_size}
+        if start_cursor:
+            params["start_cursor"] = start_cursor
+        return self.get(f"blocks/{block_id}/children", params=params)
+
+    def iter_block_children(self, block_id: str):
+        """blocks/{id}/children を has_more が尽きるまで辿る。"""
+        cursor = None
+        while True:
+            data = self.block_children(block_id, start_cursor=cursor)
+            for b in data.get("results", []):
+                yield b
+            if not data.get("has_more"):
+                break
+            cursor = data.get("next_cursor")
+
+    def page_body_text(self, page_id: str) -> str:
+        """
+        ページ本文（ブロック）を再帰的に辿ってプレーンテキストにする。
+        rich_text プロパティの文字数上限に引っかからない全文が取れる。
+        """
+        lines = []
+
+        def walk(block_id: str):
+            for b in self.iter_block_children(block_id):
+                text = block_plain_text(b)
+                if text:
+                    lines.append(text)
+                if b.get("has_children") and b.get("type") != "child_page":
+                    walk(b["id"])
+
+        walk(page_id)
+        return "\n".join(lines).strip()
+
+    def map_concurrent(self, fn, items, max_workers: int = None):
+        """
+        fn(item) を最大 max_workers 並列で実行し、入力順に結果を返す。
+        レートはバケットで共有されるので、並列数を上げても rps は超えない。
+        """
+        items = list(items)
+        workers = max_workers or self.max_workers
+        if workers <= 1 or len(items) <= 1:
+            return [fn(x) for x in items]
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            return list(ex.map(fn, items))
+
+    def retrieve_pages(self, page_ids, max_workers: int = None):
+        return self.map_concurrent(self.retrieve_page, page_ids, max_workers)
+
+
+def block_plain_text(block: dict) -> str:
+    """1ブロック分のテキスト。rich_text を持たない種類（画像・区切り線など）は空文字。"""
+    btype = block.get("type")
+    body = block.get(btype) or {}
+    if btype == "child_page":
+        return body.get("title", "")
+    return "".join(x.get("plain_text", "") for x in (body.get("rich_text") or []))
@@ -1,7 +1,8 @@
 import os
-import requests
 from dotenv import load_dotenv
 
+from notion_api import NotionClient
+
 # 実行場所に依存しない .env 読み込み
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
@@ -15,31 +16,9 @@ def require_env(key: str) -> str:
 NOTION_TOKEN = require_env("NOTION_TOKEN")
 NOTION_DATABASE_ID = require_env("NOTION_DATABASE_ID")
 
-headers = {
-    "Authorization": f"Bearer {NOTION_TOKEN}",
-    "Notion-Version": "2022-06-28",
-    "Content-Type": "application/json",
-}
-
-url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-
 count = 0
-has_more = True
-start_cursor = None
-
-while has_more:
-    payload = {"page_size": 100}
-    if start_cursor:
-        payload["start_cursor"] = start_cursor
-
-    r = requests.post(url, headers=headers, json=payload, timeout=30)
-    r.raise_for_status()
-    data = r.json()
-
-    batch = len(data.get("results", []))
-    count += batch
-
-    has_more = data.get("has_more", False)
-    start_cursor = data.get("next_cursor")
+with NotionClient(NOTION_TOKEN) as notion:
+    for _ in notion.iter_database(NOTION_DATABASE_ID, {"page_size": 100}):
+        count += 1
 
 print("TOTAL_PAGES_IN_DB:", count)
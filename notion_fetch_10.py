@@ -1,7 +1,8 @@
 import os
-import requests
 from dotenv import load_dotenv
 
+from notion_api import NotionClient
+
 # 実行場所に依存しない .env 読み込み
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
@@ -14,13 +15,8 @@ def require_env(key: str) -> str:
 
 NOTION_TOKEN = require_env("NOTION_TOKEN")
 NOTION_DATABASE_ID = require_env("NOTION_DATABASE_ID")
-NOTION_VERSION = "2022-06-28"
 
-headers = {
-    "Authorization": f"Bearer {NOTION_TOKEN}",
-    "Notion-Version": NOTION_VERSION,
-    "Content-Type": "application/json",
-}
+notion = NotionClient(NOTION_TOKEN)
 
 def rich_text_to_plain(rt_list):
     return "".join(x.get("plain_text", "") for x in (rt_list or []))
@@ -43,11 +39,8 @@ def get_rich_text(properties, prop_name):
     return ""
 
 def fetch_pages(page_size=10):
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    payload = {"page_size": page_size}
-    res = requests.post(url, headers=headers, json=payload, timeout=30)
-    res.raise_for_status()
-    return res.json().get("results", [])
+    data = notion.query_database(NOTION_DATABASE_ID, {"page_size": page_size})
+    return data.get("results", [])
 
 if __name__ == "__main__":
     pages = fetch_pages(page_size=10)
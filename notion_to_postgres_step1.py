@@ -1,9 +1,12 @@
 import os
 import hashlib
-import requests
+import argparse
 import psycopg2
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+from notion_api import NotionClient
+
 # どこから実行しても .env を見つけられるようにする（VSCodeでcwdがズレても安全）
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
@@ -25,29 +28,37 @@ PG_PASS = require_env("PG_PASS")
 PG_HOST = os.getenv("PG_HOST", "localhost")   # ここだけはデフォルトOK
 PG_PORT = int(os.getenv("PG_PORT", "5433"))
 
-NOTION_VERSION = "2022-06-28"
 MIN_LEN = 50          # 短すぎるものはスキップ（必要なら調整）
-FETCH_LIMIT = 10      # まずは10件
+PAGE_SIZE = 100       # Notion API の page_size 上限
+DB_BATCH = 100        # まとめて upsert する件数（1文で送る）
+SYNC_KEY = f"notion:{NOTION_DATABASE_ID}"   # --blocks のときは f"{SYNC_KEY}:blocks"（モードごとに別の watermark）
 
 def sha256_text(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
-def notion_query_database(limit: int = 10):
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_TOKEN}",
-        "Notion-Version": NOTION_VERSION,
-        "Content-Type": "application/json",
-    }
+def build_query_payload(since=None, page_size: int = PAGE_SIZE) -> dict:
+    """
+    databases/{id}/query の payload。
+    since を渡すと last_edited_time >= since のページだけに絞る。
+    """
     payload = {
-        "page_size": limit,
+        "page_size": page_size,
+        # 古い順に辿る（途中で落ちても watermark が巻き戻らない）
         "sorts": [
-            {"timestamp": "created_time", "direction": "descending"}
+            {"timestamp": "last_edited_time", "direction": "ascending"}
         ]
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=30)
-    r.raise_for_status()
-    return r.json()["results"]
+    if since:
+        # last_edited_time は分単位に丸められるので on_or_after で境界も拾う（再取り込みは冪等）
+        payload["filter"] = {
+            "timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": since},
+        }
+    return payload
+
+def iter_database_pages(notion: NotionClient, since=None):
+    """next_cursor / has_more を最後まで辿って全ページを yield する。"""
+    return notion.iter_database(NOTION_DATABASE_ID, build_query_payload(since))
 
 def extract_title(props: dict) -> str:
     t = props.get("Title", {}).get("title", [])
@@ -94,32 +105,281 @@ def insert_raw_source(cur, raw_document_id: int, notion_page_id: str, notion_cre
     """
     cur.execute(sql, (raw_document_id, notion_page_id, notion_created_time, title))
 
+def upsert_raw_documents_batch(cur, raw_texts) -> dict:
+    """
+    upsert_raw_document の一括版。1文の INSERT ... RETURNING で全件 upsert し、
+    {content_hash: raw_document_id} を返す。
+    同一文の中で同じ行を2回 ON CONFLICT 更新できないので、hash で先に重複を落とす。
+    """
+    by_hash = {}
+    for t in raw_texts:
+        by_hash.setdefault(sha256_text(t), t)
+    if not by_hash:
+        return {}
+    sql = """
+    INSERT INTO plaud.raw_documents (raw_text, content_hash, ingested_at)
+    VALUES %s
+    ON CONFLICT (content_hash) DO UPDATE
+    SET ingested_at = EXCLUDED.ingested_at
+    RETURNING id, content_hash;
+    """
+    rows = execute_values(
+        cur, sql,
+        [(t, h) for h, t in by_hash.items()],
+        template="(%s, %s, now())",
+        page_size=len(by_hash),
+        fetch=True,
+    )
+    return {h: i for i, h in rows}
+
+def insert_raw_sources_batch(cur, rows) -> int:
+    """
+    insert_raw_source の一括版。
+    rows: [(raw_document_id, notion_page_id, notion_created_time, title, notion_last_edited_time, body_source), ...]
+    既存ページは本文（raw_document_id）・タイトル・notion_last_edited_time・body_source を新しいものに付け替える。
+    """
+    if not rows:
+        return 0
+    sql = """
+    INSERT INTO plaud.raw_sources
+        (raw_document_id, notion_page_id, notion_created_time, title, notion_last_edited_time, body_source)
+    VALUES %s
+    ON CONFLICT (notion_page_id) DO UPDATE
+    SET raw_document_id = EXCLUDED.raw_document_id,
+        title = EXCLUDED.title,
+        notion_last_edited_time = EXCLUDED.notion_last_edited_time,
+        body_source = EXCLUDED.body_source;
+    """
+    execute_values(cur, sql, rows, page_size=len(rows))
+    return len(rows)
+
+def load_linked_documents(cur, page_ids) -> dict:
+    """{notion_page_id: raw_document_id}（付け替え前の本文を知るため）"""
+    if not page_ids:
+        return {}
+    cur.execute(
+        "SELECT notion_page_id, raw_document_id FROM plaud.raw_sources WHERE notion_page_id = ANY(%s);",
+        (list(page_ids),),
+    )
+    return dict(cur.fetchall())
+
+def delete_orphan_documents(cur, raw_document_ids) -> int:
+    """
+    付け替えで参照されなくなった raw_documents を、その chunk（と埋め込み）ごと消す。
+    他のページが同じ本文を参照している行と、Gmail の行は残す。
+    """
+    if not raw_document_ids:
+        return 0
+    cur.execute(
+        """
+        SELECT rd.id
+        FROM plaud.raw_documents rd
+        WHERE rd.id = ANY(%s)
+          AND rd.source_type IS DISTINCT FROM 'gmail'
+          AND NOT EXISTS (SELECT 1 FROM plaud.raw_sources s WHERE s.raw_document_id = rd.id);
+        """,
+        (list(raw_document_ids),),
+    )
+    orphans = [r[0] for r in cur.fetchall()]
+    if not orphans:
+        return 0
+    # chunk_embeddings は chunks の削除に連動して消える。
+    # chunks.text_hash と chunk_texts は step2（ensure_chunk_columns）が足すので、step2 を一度も流していない DB には無い
+    cur.execute(
+        """
+        SELECT EXISTS (
+                   SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = 'plaud' AND table_name = 'chunks' AND column_name = 'text_hash'
+               ),
+               to_regclass('plaud.chunk_texts') IS NOT NULL;
+        """
+    )
+    has_text_hash, has_chunk_texts = cur.fetchone()
+    if not has_text_hash:
+        cur.execute("DELETE FROM plaud.chunks WHERE raw_document_id = ANY(%s);", (orphans,))
+        cur.execute("DELETE FROM plaud.raw_documents WHERE id = ANY(%s);", (orphans,))
+        return len(orphans)
+    cur.execute("DELETE FROM plaud.chunks WHERE raw_document_id = ANY(%s) RETURNING text_hash;", (orphans,))
+    hashes = list({r[0] for r in cur.fetchall() if r[0]})
+    if hashes and has_chunk_texts:
+        cur.execute(
+            """
+            DELETE FROM plaud.chunk_texts t
+            WHERE t.text_hash = ANY(%s)
+              AND NOT EXISTS (SELECT 1 FROM plaud.chunks c WHERE c.text_hash = t.text_hash);
+            """,
+            (hashes,),
+        )
+    cur.execute("DELETE FROM plaud.raw_documents WHERE id = ANY(%s);", (orphans,))
+    return len(orphans)
+
+def flush_pending(cur, pending) -> dict:
+    """
+    pending: [(raw_text, notion_page_id, notion_created_time, title, notion_last_edited_time, body_source), ...]
+    raw_documents を1文で upsert → hash で id を引き当て → raw_sources を1文で upsert（本文を付け替え）
+    → 参照されなくなった古い本文を消す。
+    """
+    if not pending:
+        return {"prepared": 0, "replaced": 0}
+    ids = upsert_raw_documents_batch(cur, [x[0] for x in pending])
+    links = {}
+    for raw_text, page_id, created_time, title, edited, body_source in pending:
+        links[page_id] = (ids[sha256_text(raw_text)], page_id, created_time, title, edited, body_source)
+    before = load_linked_documents(cur, links)
+    insert_raw_sources_batch(cur, list(links.values()))
+    replaced = {old for page_id, old in before.items() if old != links[page_id][0]}
+    return {"prepared": len(pending), "replaced": delete_orphan_documents(cur, replaced)}
+
+def ensure_raw_sources_columns(cur):
+    # body_source: 保存している本文の出どころ（property: content プロパティ / blocks: 本文ブロックも見た）
+    cur.execute("""
+        ALTER TABLE plaud.raw_sources
+        ADD COLUMN IF NOT EXISTS notion_last_edited_time timestamptz,
+        ADD COLUMN IF NOT EXISTS body_source text;
+    """)
+
+def select_unchanged_pages(cur, pages, with_blocks: bool) -> set:
+    """
+    前回取り込み時から last_edited_time が変わっておらず、本文も今回のモードで取ったもの
+    （blocks で取った本文は property のモードでも十分）のページIDを1クエリで返す。
+    --blocks 無しで取り込んだページは、後で --blocks を付けたときにブロックを取り直す。
+    """
+    ids = [p["id"] for p in pages if p.get("last_edited_time")]
+    edited = [p["last_edited_time"] for p in pages if p.get("last_edited_time")]
+    if not ids:
+        return set()
+    cur.execute(
+        """
+        SELECT s.notion_page_id
+        FROM plaud.raw_sources s
+        JOIN unnest(%s::text[], %s::timestamptz[]) AS x(page_id, edited)
+          ON s.notion_page_id = x.page_id
+         AND s.notion_last_edited_time = x.edited
+        WHERE NOT %s OR s.body_source = 'blocks';
+        """,
+        (ids, edited, with_blocks),
+    )
+    return {r[0] for r in cur.fetchall()}
+
+def ingest_pages(notion: NotionClient, cur, pages, with_blocks: bool, full: bool = False) -> dict:
+    """
+    Notion ページ1バッチ分を取り込む。
+    変更のないページ（select_unchanged_pages）はブロック取得も書き込みもしない。full=True なら全ページ取り直す。
+    with_blocks=True のときは本文ブロックを並列取得し、
+    プロパティ content より長ければ（＝上限で切れていれば）そちらを使う。
+    """
+    stats = {"prepared": 0, "replaced": 0, "skipped_short": 0, "unchanged": 0, "blocks_fetched": 0}
+
+    if full:
+        # --full でも、編集されていないページのブロック由来の本文を content プロパティで上書きはしない
+        unchanged = set() if with_blocks else select_unchanged_pages(cur, pages, True)
+    else:
+        unchanged = select_unchanged_pages(cur, pages, with_blocks)
+    stats["unchanged"] = len(unchanged)
+    pages = [p for p in pages if p["id"] not in unchanged]
+    if with_blocks:
+        bodies = notion.map_concurrent(notion.page_body_text, [p["id"] for p in pages])
+        stats["blocks_fetched"] = len(pages)
+    else:
+        bodies = [""] * len(pages)
+
+    body_source = "blocks" if with_blocks else "property"
+    pending = []
+    for p, body in zip(pages, bodies):
+        props = p.get("properties", {})
+        title = extract_title(props)
+        raw_text = extract_rich_text(props, "content")  # あなたのDBは content が rich_text
+        if len(body) > len(raw_text):
+            raw_text = body
+
+        if len(raw_text) < MIN_LEN:
+            stats["skipped_short"] += 1
+            continue
+
+        pending.append((raw_text, p["id"], p.get("created_time"), title, p.get("last_edited_time"), body_source))
+
+    stats.update(flush_pending(cur, pending))
+    return stats
+
+def ensure_sync_state_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS plaud.sync_state (
+            sync_key   text PRIMARY KEY,
+            watermark  text,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        );
+    """)
+
+def load_watermark(cur, sync_key: str):
+    cur.execute("SELECT watermark FROM plaud.sync_state WHERE sync_key = %s;", (sync_key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def save_watermark(cur, sync_key: str, watermark: str):
+    cur.execute(
+        """
+        INSERT INTO plaud.sync_state (sync_key, watermark, updated_at)
+        VALUES (%s, %s, now())
+        ON CONFLICT (sync_key) DO UPDATE
+        SET watermark = EXCLUDED.watermark, updated_at = EXCLUDED.updated_at;
+        """,
+        (sync_key, watermark),
+    )
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Notion -> plaud.raw_documents / raw_sources 取り込み")
+    ap.add_argument("--full", action="store_true",
+                    help="watermark を無視して全ページを取り直す")
+    ap.add_argument("--blocks", action="store_true",
+                    help="本文ブロック（blocks/{id}/children）も取得して全文を組み立てる")
+    return ap.parse_args()
+
 def main():
-    pages = notion_query_database(FETCH_LIMIT)
+    args = parse_args()
 
-    prepared = 0
-    skipped_short = 0
+    totals = {"prepared": 0, "replaced": 0, "skipped_short": 0, "unchanged": 0, "blocks_fetched": 0}
+    # --blocks 無しの実行で進んだ watermark で、--blocks の実行がページを取りこぼさないよう別々に持つ
+    sync_key = f"{SYNC_KEY}:blocks" if args.blocks else SYNC_KEY
+    fetched = 0
 
-    with connect_pg() as conn:
+    def add(stats):
+        for k, v in stats.items():
+            totals[k] += v
+
+    with NotionClient(NOTION_TOKEN) as notion, connect_pg() as conn:
         with conn.cursor() as cur:
-            for p in pages:
-                page_id = p["id"]
-                created_time = p.get("created_time")
-                props = p.get("properties", {})
+            ensure_sync_state_table(cur)
+            ensure_raw_sources_columns(cur)
+            since = None if args.full else load_watermark(cur, sync_key)
+            watermark = since
+            batch = []
+
+            for p in iter_database_pages(notion, since=since):
+                fetched += 1
 
-                title = extract_title(props)
-                raw_text = extract_rich_text(props, "content")  # あなたのDBは content が rich_text
+                # ISO8601(UTC, Z付き)なので文字列比較で大小が決まる
+                edited = p.get("last_edited_time")
+                if edited and (watermark is None or edited > watermark):
+                    watermark = edited
 
-                if len(raw_text) < MIN_LEN:
-                    skipped_short += 1
-                    continue
+                batch.append(p)
+                if len(batch) >= DB_BATCH:
+                    add(ingest_pages(notion, cur, batch, args.blocks, args.full))
+                    batch = []
 
-                raw_document_id, _ = upsert_raw_document(cur, raw_text)
-                insert_raw_source(cur, raw_document_id, page_id, created_time, title)
+            add(ingest_pages(notion, cur, batch, args.blocks, args.full))
 
-                prepared += 1
+            # 取り込みと同じトランザクションで進める（失敗時は watermark も進まない）
+            if watermark and watermark != since:
+                save_watermark(cur, sync_key, watermark)
 
-    print(f"Inserted/linked: {prepared} (skipped_short: {skipped_short})")
+    print(
+        f"Inserted/linked: {totals['prepared']} (skipped_short: {totals['skipped_short']}, "
+        f"unchanged: {totals['unchanged']}, replaced_docs: {totals['replaced']}) "
+        f"fetched: {fetched} since: {since or '-'} watermark: {watermark or '-'}"
+    )
+    if args.blocks:
+        print(f"blocks_fetched: {totals['blocks_fetched']}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,117 @@
+"""
+gmail_to_pg の添付抽出の取り直し（retry）のテスト。
+
+    python -m pytest -q test_gmail_retry.py
+
+DB を使うテストは .env の PG_* に繋ぎ、plaud.raw_documents に1行書いてから必ず rollback する
+（繋がらなければ skip）。
+"""
+import io
+import zipfile
+
+import psycopg2
+import pytest
+
+import gmail_to_pg
+from attachment_extract import AttachmentExtractor, is_transient_error
+
+FULL = {
+    "threadId": "t-retry",
+    "payload": {
+        "mimeType": "text/plain",
+        "headers": [
+            {"name": "Subject", "value": "Plaud-AutoFlow retry test"},
+            {"name": "Date", "value": "Mon, 1 Jan 2024 00:00:00 +0000"},
+        ],
+        "body": {"data": ""},
+    },
+}
+PARTS = [
+    ("文字起こし.txt", "text/plain", "att-transcript"),
+    ("要約.txt", "text/plain", "att-summary"),
+]
+
+
+def build(extracted, attempt=1, msg_id="retry-test-msg"):
+    attachments_meta, summary_text = gmail_to_pg.build_attachments(PARTS, extracted)
+    return gmail_to_pg.build_document(msg_id, FULL, attachments_meta, summary_text, attempt=attempt)
+
+
+def retry_flags(doc):
+    return [a.get("retry", False) for a in doc["meta"]["attachments"]]
+
+
+def test_parse_error_is_not_retried():
+    # 壊れた DOCX（zip ではない）はパースの失敗なので、何度やっても同じ
+    with AttachmentExtractor(processes=0, cache_dir=None) as ex:
+        text, error = ex.result(ex.submit("議事録.docx", b"not a zip"))
+    assert text is None and error
+    assert not is_transient_error(error)
+
+    doc = build({"att-transcript": ("本文", None), "att-summary": (None, error)})
+    assert retry_flags(doc) == [False, False]
+    assert "extract_attempts" not in doc["meta"]
+
+
+def test_timeout_is_retried_up_to_the_limit():
+    extracted = {"att-transcript": ("本文", None), "att-summary": (None, "timeout after 60.0s")}
+
+    doc = build(extracted, attempt=1)
+    assert retry_flags(doc) == [False, True]
+    assert doc["meta"]["extract_attempts"] == 1
+
+    doc = build(extracted, attempt=gmail_to_pg.ATTACHMENT_RETRIES + 1)
+    assert retry_flags(doc) == [False, False]
+    assert doc["meta"]["extract_attempts"] == gmail_to_pg.ATTACHMENT_RETRIES + 1
+
+
+@pytest.fixture
+def cur():
+    try:
+        conn = gmail_to_pg.get_pg_conn()
+    except psycopg2.Error as e:
+        pytest.skip(f"Postgres に繋がらない: {e}")
+    try:
+        with conn.cursor() as c:
+            yield c
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_retry_clears_after_success(cur):
+    # 1回目：要約.txt が時間切れ。文字起こし（raw_text / content_hash）は取れている
+    failed = build({"att-transcript": ("本文", None), "att-summary": (None, "timeout after 60.0s")})
+    assert gmail_to_pg.upsert_document(cur, failed) == "new"
+    assert gmail_to_pg.load_retry_ids(cur).get("retry-test-msg") == 1
+    assert "retry-test-msg" not in gmail_to_pg.load_known_hashes(cur, ["retry-test-msg"])
+
+    # 2回目：要約だけ取れた。content_hash は変わらないが、要約と meta が変わるので書き直される
+    ok = build({"att-transcript": ("本文", None), "att-summary": ("要約です", None)}, attempt=2)
+    assert ok["content_hash"] == failed["content_hash"]
+    assert gmail_to_pg.upsert_document(cur, ok) == "changed"
+    assert "retry-test-msg" not in gmail_to_pg.load_retry_ids(cur)
+    assert "retry-test-msg" in gmail_to_pg.load_known_hashes(cur, ["retry-test-msg"])
+
+    cur.execute("SELECT summary_text FROM plaud.raw_documents WHERE source_type = 'gmail' AND source_id = %s;",
+                ("retry-test-msg",))
+    assert cur.fetchone()[0] == "要約です"
+
+
+def test_retry_clears_when_recovered_text_is_empty(cur):
+    failed = build({"att-transcript": ("本文", None), "att-summary": (None, "extractor worker crashed (pid 1)")})
+    gmail_to_pg.upsert_document(cur, failed)
+    ok = build({"att-transcript": ("本文", None), "att-summary": ("", None)}, attempt=2)
+    assert gmail_to_pg.upsert_document(cur, ok) == "changed"
+    assert "retry-test-msg" not in gmail_to_pg.load_retry_ids(cur)
+
+
+def test_docx_extracts(tmp_path):
+    # 正常な DOCX は抽出でき、エラーにならない（パース失敗のテストの対照）
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("word/document.xml",
+                   '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                   "<w:body><w:p><w:r><w:t>こんにちは</w:t></w:r></w:p></w:body></w:document>")
+    with AttachmentExtractor(processes=0, cache_dir=str(tmp_path)) as ex:
+        assert ex.result(ex.submit("議事録.docx", buf.getvalue())) == ("こんにちは", None)
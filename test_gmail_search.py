@@ -1,37 +1,10 @@
-import os
-from dotenv import load_dotenv
-
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-
-SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
-
-def get_gmail_service():
-    load_dotenv()
-    token_path = os.getenv("GMAIL_TOKEN_JSON", "token.json")
-    cred_path = os.getenv("GMAIL_CREDENTIALS_JSON", "credentials.json")
-
-    creds = None
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(cred_path, SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open(token_path, "w", encoding="utf-8") as f:
-            f.write(creds.to_json())
-
-    return build("gmail", "v1", credentials=creds)
-
 import os
 import base64
 from dotenv import load_dotenv
 
+# 認証・discovery キャッシュ・遅延 import は gmail_to_pg と共通
+from gmail_to_pg import get_gmail_service
+
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
 def search_message_ids(service, query: str, max_results: int = 5):